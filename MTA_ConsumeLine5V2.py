@@ -12,6 +12,9 @@ This consumer does the following:
 1. decodes the message from the queue associated with Line-5_queue
 2. splits the original message with ',' to facilitate writing the CSV
 3. Writes the data to a CSV file with only the desired columns from the producer.
+   The CSV is opened once and rows are written in batches, a message is acknowledged once its rows are written.
+4. Records how long messages waited in the queue and took to handle, logged every metrics_interval seconds
+   and served at http://127.0.0.1:<metrics_port>/metrics (see utils/util_metrics.py).
     
     This program listens for work messages contiously. 
     Start multiple versions to add more workers. 
@@ -21,84 +24,107 @@ This consumer does the following:
 
 """
 
-import pika
 import sys
 import time
-import pickle
 from datetime import datetime
-import csv
-from utils.util_logger import setup_logger
+from functools import partial
+from utils.util_batch import BatchConsumer
+from utils.util_logger import RowLogger, setup_logger
+from utils.util_metrics import QueueMetrics, log_summary, start_metrics
+from utils.util_sink import CsvSink
+from utils.util_transport import open_connection
+from utils.util_wire import WireDecoder, fetch_state
 
 # Configuring the Logger:
-logger, logname = setup_logger(__file__)
+# per-row lines go to logs/<name>.jsonl, query them with python -m utils.util_events
+logger, logname = setup_logger(__file__, queued=True, events=True)
 
 # Variables
 csv_file_path = 'Data_MTA_Line5.csv'
 column_headers = ["transit_timestamp", "transit_mode", "station_complex_id", "station_complex", "Line", "borough", "payment_method", "fare_class_category", "ridership", "transfers", "latitude", "longitude", "Georeference"]
+# holds the states (string dictionary and station table) shipped by the producer, see utils/util_wire.py
+decoder = WireDecoder()
+# messages we may hold unacknowledged, the CSV is written at the latest once this many are buffered
+prefetch_count = 100
+# messages handled together, and how long (ms) a smaller batch may wait, see utils/util_batch.py
+batch_size = 50
+batch_wait_ms = 50
+# seconds a row may wait in the buffer before it is written
+flush_delay = 1.0
+# the CSV stays open while the consumer runs, opened in main
+sink = None
+# one log line per record: written by the logger's background thread, and only every row_log_every-th record
+row_log_every = 1
+row_log = RowLogger(logger, sample_every=row_log_every)
+row_log_format = ('%(transit_timestamp)s,%(transit_mode)s,%(station_complex_id)s,%(station_complex)s,%(Line)s,'
+                  '%(borough)s,%(fare_class_category)s,%(ridership)s,%(transfers)s,%(latitude)s,%(longitude)s,'
+                  '%(Georeference)s')
+# queue wait and processing time, a summary is logged every metrics_interval seconds
+# and scraped from metrics_port (None turns the endpoint off)
+metrics = QueueMetrics()
+metrics_interval = 30
+metrics_port = 9303
 
 # Define Program functions
 #--------------------------------------------------------------------------
 
 
-# define a callback function to be called when a message is received
-def callback(ch, method, properties, body):
+# define a callback function to be called for each message received
+def callback(ch, method, properties, body) -> list:
     """ 
-    Define behavior on getting a message.  This process utilizes pickle in order to decode the contents of the message.
-    Message is then added to a CSV specifically for Line Q.
+    Define behavior on getting a message.  This process utilizes the binary wire format in order to decode the contents of the message.
+    Each record in the message is then added to a CSV specifically for this Line.
+    Returns the delivery tags of the messages whose rows are now written to the CSV.
     """
-    # decode the binary message body to a string
-    subway_data = pickle.loads(body)
-    logger.info(f'{subway_data["transit_timestamp"]},'
-                    f'{subway_data["transit_mode"]},'
-                    f'{subway_data["station_complex_id"]},'
-                    f'{subway_data["station_complex"]},'
-                    f'{subway_data["Line"]},'
-                    f'{subway_data["borough"]},'
-                    f'{subway_data["fare_class_category"]},'
-                    f'{subway_data["ridership"]},'
-                    f'{subway_data["transfers"]},'
-                    f'{subway_data["latitude"]},'
-                    f'{subway_data["longitude"]},'
-                    f'{subway_data["Georeference"]}')
-
-
-    # Write the filtered data into a new file
-    with open ('Data_MTA_Line5.csv', 'a', newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=column_headers)
-        if file.tell() == 0:
-            writer.writeheader()
-        # Process each message
-        writer.writerow(subway_data)
-        logger.info(f'Row ingested: {subway_data["transit_timestamp"]},'
-                    f'{subway_data["transit_mode"]},'
-                    f'{subway_data["station_complex_id"]},'
-                    f'{subway_data["station_complex"]},'
-                    f'{subway_data["Line"]},'
-                    f'{subway_data["borough"]},'
-                    f'{subway_data["fare_class_category"]},'
-                    f'{subway_data["ridership"]},'
-                    f'{subway_data["transfers"]},'
-                    f'{subway_data["latitude"]},'
-                    f'{subway_data["longitude"]},'
-                    f'{subway_data["Georeference"]}')
-
-        # when done with task, tell the user
-        print(" [x] Done.")
-        logger.info(" [x] Done.")
-        # acknowledge the message was received and processed 
-        # (now it can be deleted from the queue)
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+    # decode the binary message body into subway_data dicts, a dictionary message holds no rows
+    rows = decoder.decode_rows(body)
+    for subway_data in rows:
+        log_row(subway_data)
+
+    # buffer the rows for the CSV, the message is only acknowledged once they have been written
+    delivery_tags = sink.add(rows, method.delivery_tag)
+
+    # when done with task, tell the user
+    print(" [x] Done.")
+    logger.info(" [x] Done.")
+    return delivery_tags
+
+
+def batch_callback(deliveries: list) -> list:
+    """
+    Handle a batch of messages in the order they arrived.
+    Returns the delivery tags that can be acknowledged (now they can be deleted from the queue),
+    the batch consumer acknowledges them all with one basic_ack.
+    """
+    delivery_tags = []
+    for ch, method, properties, body in deliveries:
+        delivery_tags.extend(callback(ch, method, properties, body))
+    return delivery_tags
+
+
+def flush_on_time(connection, batcher):
+    """Write rows that have waited flush_delay seconds even when no more messages arrive, then check again later."""
+    batcher.ack(sink.poll())
+    connection.call_later(flush_delay, partial(flush_on_time, connection, batcher))
+
+
+def log_row(subway_data: dict):
+    """Log one decoded record, the line is only built when it is written (see row_log)."""
+    row_log(row_log_format, subway_data)
 
 
 # define a main function to run the program
-def main(hn: str = "localhost", qn: str = "Line-5_queue"):
-    """ Continuously listen for task messages on a named queue."""
+def main(hn: str = "localhost", qn: str = "Line-5_queue", batch_size: int = batch_size,
+         batch_wait_ms: int = batch_wait_ms):
+    """ Continuously listen for task messages on a named queue, handling them in batches."""
+    global sink
+    batcher = None
 
     # when a statement can go wrong, use a try-except block
     try:
         # try this code, if it works, keep going
         # create a blocking connection to the RabbitMQ server
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host=hn))
+        connection = open_connection(hn)
 
     # except, if there's an error, do this
     except Exception as e:
@@ -113,6 +139,9 @@ def main(hn: str = "localhost", qn: str = "Line-5_queue"):
     try:
         # use the connection to create a communication channel
         channel = connection.channel()
+        # a state the producer sent before the queue was deleted below is read from the state queue,
+        # on a channel of its own, see utils/util_wire.py
+        decoder.fetch_state = partial(fetch_state, connection.channel(), qn)
 
         # use the channel to declare a durable queue
         # a durable queue will survive a RabbitMQ server restart
@@ -124,17 +153,29 @@ def main(hn: str = "localhost", qn: str = "Line-5_queue"):
         # The QoS level controls the # of messages
         # that can be in-flight (unacknowledged by the consumer)
         # at any given time.
-        # Set the prefetch count to one to limit the number of messages
+        # The prefetch count limits the number of messages
         # being consumed and processed concurrently.
         # This helps prevent a worker from becoming overwhelmed
         # and improve the overall system performance. 
-        # prefetch_count = Per consumer limit of unaknowledged messages      
-        channel.basic_qos(prefetch_count=1) 
+        # prefetch_count = Per consumer limit of unaknowledged messages
+        # Messages stay unacknowledged until their rows are written, so the sink
+        # must write at the latest when prefetch_count messages are buffered
+
+        # Open the CSV once, rows are written in batches (see utils/util_sink.py)
+        sink = CsvSink(csv_file_path, column_headers, max_messages=prefetch_count,
+                       max_delay=flush_delay, logger=logger)
 
         # configure the channel to listen on a specific queue,  
-        # use the callback function named callback,
+        # collect up to batch_size messages or wait batch_wait_ms, hand them to batch_callback,
         # and do not auto-acknowledge the message (let the callback handle it)
-        channel.basic_consume( queue=qn, on_message_callback=callback, auto_ack=False)
+        batcher = BatchConsumer(connection, channel, batch_callback, batch_size, batch_wait_ms, prefetch_count,
+                                metrics=metrics)
+        batcher.start([qn])
+        connection.call_later(flush_delay, partial(flush_on_time, connection, batcher))
+
+        # log how long messages wait and take now and then, and serve the numbers for scraping
+        connection.call_later(metrics_interval, partial(log_summary, connection, metrics, logger, metrics_interval))
+        start_metrics(metrics, metrics_port, logger)
 
         # print a message to the console for the user
         print(" [*] Ready for work. To exit press CTRL+C")
@@ -154,8 +195,17 @@ def main(hn: str = "localhost", qn: str = "Line-5_queue"):
         print()
         print(" User interrupted continuous listening process.")
         logger.info("KeyboardInterrupt. Stopping the Program")
+        # handle the messages still waiting, write what is still buffered and acknowledge them before leaving
+        if batcher:
+            batcher.process()
+            batcher.ack(sink.close())
+        for line in metrics.summary_lines():
+            logger.info(f"[metrics] {line}")
         sys.exit(0)
     finally:
+        # rows of messages that were not acknowledged are written too, the messages are redelivered
+        if sink:
+            sink.close()
         print("\nClosing connection. Goodbye.\n")
         logger.info("\nclosing connection. Goodby\n")
         connection.close()
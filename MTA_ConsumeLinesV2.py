@@ -0,0 +1,358 @@
+"""
+Created by: A. C. Coffin
+Date: 12 June 2024
+
+*** CONSUME EVERY LINE ***
+
+One Consumer for every line queue filled by "MTA_ProducerV2.py", see notes in README about Original Project Concept.
+MTA_ConsumeLine5V2.py, MTA_ConsumeLine7V2.py and MTA_ConsumeLineQV2.py each need their own process and connection
+and differ only in the queue and the CSV. This consumer takes the Line-<X>_queue names to read, or finds them,
+and consumes all of them over one connection. Adding a line only needs its queue name.
+
+This consumer does the following:
+1. finds the line queues: the names given, else the queues on the RabbitMQ Admin API, else the Lines in the data file
+2. opens one channel per queue, each with its own decoder, CSV (Data_MTA_Line<X>.csv) and batch consumer
+3. decodes each message from the queue associated with a Line
+4. Writes the data to that Line's CSV file with only the desired columns from the producer.
+   The CSV is opened once and rows are written in batches, a message is acknowledged once its rows are written.
+5. With --workers, messages are decoded and formatted as CSV in a pool of worker processes and written
+   in the order they arrived (see utils/util_pool.py), so every station's rows stay in order.
+   With --store the records are written as typed NumPy columns partitioned by Line and date instead of
+   the CSVs, readers memory map one column for a time range (see utils/util_store.py).
+6. Records how long messages waited in each queue and took to handle, logged every metrics_interval seconds
+   and served at http://127.0.0.1:<metrics_port>/metrics (see utils/util_metrics.py).
+
+    This program listens for work messages contiously.
+
+    Base Code Author: Denise Case
+    Date: January 15, 2023
+
+"""
+
+import argparse
+import base64
+import json
+import sys
+import urllib.request
+from functools import partial
+from utils.util_batch import BatchConsumer
+from utils.util_logger import RowLogger, setup_logger
+from utils.util_metrics import QueueMetrics, log_summary, start_metrics
+from utils.util_partition import line_from_queue, line_queue_name
+from utils.util_pool import OrderedWorkQueue, make_pool
+from utils.util_reader import read_subway
+from utils.util_sink import CsvSink
+from utils.util_store import ColumnSink, ColumnStore
+from utils.util_transport import get_broker, is_memory, open_connection
+from utils.util_wire import CSV_COLUMNS, WireDecoder, fetch_state
+
+# Configuring the Logger:
+# per-row lines go to logs/<name>.jsonl, query them with python -m utils.util_events
+logger, logname = setup_logger(__file__, queued=True, events=True)
+
+# Variables
+input_file = 'MTA_SubwayW1Feb22.csv'
+# messages we may hold unacknowledged per queue, the CSV is written at the latest once this many are buffered
+prefetch_count = 100
+# messages handled together, and how long (ms) a smaller batch may wait, see utils/util_batch.py
+batch_size = 50
+batch_wait_ms = 50
+# seconds a row may wait in the buffer before it is written
+flush_delay = 1.0
+# worker processes decoding messages, 0 decodes in this process
+workers = 0
+# directory of the columnar store written instead of the CSVs, None writes the CSVs
+store_dir = None
+# RabbitMQ Admin API, used to find the line queues when none are given
+admin_url = "http://{host}:15672/api/queues"
+admin_user = "guest"
+admin_password = "guest"
+# one log line per record: written by the logger's background thread, and only every row_log_every-th record
+row_log_every = 1
+row_log = RowLogger(logger, sample_every=row_log_every)
+row_log_format = ('[Line %(Line)s] %(transit_timestamp)s,%(transit_mode)s,%(station_complex_id)s,%(station_complex)s,'
+                  '%(Line)s,%(borough)s,%(fare_class_category)s,%(ridership)s,%(transfers)s,%(latitude)s,'
+                  '%(longitude)s,%(Georeference)s')
+# queue wait and processing time of every line, a summary is logged every metrics_interval seconds
+# and scraped from metrics_port (None turns the endpoint off)
+metrics = QueueMetrics()
+metrics_interval = 30
+metrics_port = 9305
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+
+class LineQueue:
+    """
+    Everything one line queue needs: its own channel, decoder, CSV and batch consumer.
+
+    Parameters:
+        connection: the shared connection, see utils/util_transport.py
+        queue_name (str): e.g. Line-Q_queue, written to Data_MTA_LineQ.csv
+        pool: optional process pool shared by every line, messages are then decoded in the workers
+        store (ColumnStore): optional, write the records to this columnar store instead of the CSV
+    """
+
+    def __init__(self, connection, queue_name: str, batch_size: int = batch_size, batch_wait_ms: int = batch_wait_ms,
+                 pool=None, store=None):
+        self.queue_name = queue_name
+        self.line = line_from_queue(queue_name)
+        self.csv_file_path = f"Data_MTA_Line{self.line}.csv"
+        # holds the states (string dictionary and station table) shipped by the producer to this queue,
+        # a missed one is read from the queue's state queue on a channel of its own, see utils/util_wire.py
+        self.state_channel = connection.channel()
+        self.decoder = WireDecoder(partial(fetch_state, self.state_channel, queue_name))
+        self.channel = connection.channel()
+        # Open the CSV once, rows are written in batches (see utils/util_sink.py),
+        # or buffer the records for the columnar store (see utils/util_store.py)
+        self.columnar = store is not None
+        if self.columnar:
+            self.sink = ColumnSink(store, self.line, max_messages=prefetch_count, max_delay=flush_delay, logger=logger)
+        else:
+            self.sink = CsvSink(self.csv_file_path, CSV_COLUMNS, max_messages=prefetch_count,
+                                max_delay=flush_delay, logger=logger)
+        self.batcher = BatchConsumer(connection, self.channel, self.batch_callback, batch_size, batch_wait_ms,
+                                     prefetch_count, metrics=metrics)
+        # messages in the worker pool, handed back in the order they arrived
+        self.work = OrderedWorkQueue(pool, queue_name, self.decoder.fetch_state) if pool else None
+
+    def start(self):
+        """Declare the queue and start consuming it."""
+        # use the channel to declare a durable queue
+        # a durable queue will survive a RabbitMQ server restart
+        # and help ensure messages are processed in order
+        # messages will not be deleted until the consumer acknowledges
+        # it is not deleted first, a backlog the producer has already sent is kept and consumed
+        self.channel.queue_declare(queue=self.queue_name, durable=True)
+        self.batcher.start([self.queue_name])
+
+    def batch_callback(self, deliveries: list) -> list:
+        """
+        Handle a batch of messages in the order they arrived.
+        Returns the delivery tags whose rows are now written to the CSV, the batch consumer acknowledges them.
+        """
+        if self.work:
+            return self.pool_batch_callback(deliveries)
+        if self.columnar:
+            return self.store_batch_callback(deliveries)
+        delivery_tags = []
+        for ch, method, properties, body in deliveries:
+            # decode the binary message body into subway_data dicts, a dictionary message holds no rows
+            rows = self.decoder.decode_rows(body)
+            for subway_data in rows:
+                log_row(subway_data)
+            # buffer the rows for the CSV, the message is only acknowledged once they have been written
+            delivery_tags.extend(self.sink.add(rows, method.delivery_tag))
+
+        # when done with task, tell the user
+        print(f" [x] Line {self.line} Done.")
+        logger.info(f" [x] Line {self.line} Done.")
+        return delivery_tags
+
+    def store_batch_callback(self, deliveries: list) -> list:
+        """
+        Buffer a batch of messages' records for the columnar store, as typed arrays without making rows.
+        Returns the delivery tags whose records are now in a written segment.
+        """
+        delivery_tags = []
+        for ch, method, properties, body in deliveries:
+            # the records stay a NumPy view on the message body, None for a dictionary message
+            records = self.decoder.decode(body)
+            if records is not None:
+                # a subway_data dict is only made for the rows the row logger keeps
+                for i in range(len(records)):
+                    if row_log.wanted():
+                        row_log.log(row_log_format, next(self.decoder.rows(records[i:i + 1])))
+            delivery_tags.extend(self.sink.add_records(records, self.decoder.dictionaries, method.delivery_tag))
+        print(f" [x] Line {self.line} Done.")
+        logger.info(f" [x] Line {self.line} Done.")
+        return delivery_tags
+
+    def pool_batch_callback(self, deliveries: list) -> list:
+        """
+        Send a batch of messages to the worker pool and write whatever the workers have finished, in order.
+        Returns the delivery tags whose rows are now written to the CSV.
+        """
+        released = []
+        for ch, method, properties, body in deliveries:
+            released.extend(self.work.submit(body, method.delivery_tag))
+        released.extend(self.work.poll())
+        return self.write_released(released)
+
+    def write_released(self, released: list) -> list:
+        """Buffer (delivery tag, CSV text, row count) results from the pool, returns the tags to acknowledge."""
+        delivery_tags = []
+        for delivery_tag, text, count in released:
+            delivery_tags.extend(self.sink.add_text(text, count, delivery_tag))
+        if released:
+            logger.info(f" [x] Line {self.line}: {sum(count for _, _, count in released)} rows "
+                        f"from {len(released)} messages, {len(self.work)} messages still in the workers")
+        return delivery_tags
+
+    def poll_workers(self):
+        """Write and acknowledge what the workers have finished since the last batch."""
+        if self.work:
+            self.batcher.ack(self.write_released(self.work.poll()))
+
+    def flush_on_time(self):
+        """Write rows that have waited flush_delay seconds even when no more messages arrive."""
+        self.batcher.ack(self.sink.poll())
+
+    def close(self) -> list:
+        """Handle the messages still waiting, write what is buffered and acknowledge it."""
+        self.batcher.process()
+        if self.work:
+            self.batcher.ack(self.write_released(self.work.poll(wait=True)))
+        self.batcher.ack(self.sink.close())
+
+
+def log_row(subway_data: dict):
+    """Log one decoded record, the line is only built when it is written (see row_log)."""
+    row_log(row_log_format, subway_data)
+
+
+def flush_on_time(connection, lines: list):
+    """Check every line's buffered rows, then check again after flush_delay seconds."""
+    for line_queue in lines:
+        line_queue.flush_on_time()
+    connection.call_later(flush_delay, partial(flush_on_time, connection, lines))
+
+
+def poll_workers(connection, lines: list, interval: float):
+    """Collect every line's finished work from the pool, then check again after interval seconds."""
+    for line_queue in lines:
+        line_queue.poll_workers()
+    connection.call_later(interval, partial(poll_workers, connection, lines, interval))
+
+
+def discover_line_queues(hn: str = "localhost", input_file: str = input_file) -> list:
+    """
+    Find the Line-<X>_queue queues: the ones the RabbitMQ Admin API (or the memory broker) lists,
+    or if it cannot be reached, one for every Line in the data file the producer streams.
+    """
+    request = urllib.request.Request(admin_url.format(host=hn))
+    credentials = base64.b64encode(f"{admin_user}:{admin_password}".encode()).decode()
+    request.add_header("Authorization", f"Basic {credentials}")
+    try:
+        if is_memory(hn):
+            names = list(get_broker(hn).stats()["queues"])
+        else:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                names = [queue["name"] for queue in json.load(response)]
+        queue_names = sorted(name for name in names if name.startswith("Line-") and name.endswith("_queue"))
+        if queue_names:
+            return queue_names
+        logger.info("No line queues on the RabbitMQ Admin API yet, using the Lines in the data file")
+    except OSError as e:
+        logger.info(f"RabbitMQ Admin API not reachable ({e}), using the Lines in the data file")
+
+    lines = set()
+    for chunk in read_subway(input_file):
+        lines.update(chunk.dictionaries['Line'].values)
+    return [line_queue_name(line) for line in sorted(lines)]
+
+
+# define a main function to run the program
+def main(hn: str = "localhost", queue_names: list = None, batch_size: int = batch_size,
+         batch_wait_ms: int = batch_wait_ms, workers: int = workers, store_dir: str = store_dir):
+    """ Continuously listen for task messages on every line queue over one connection."""
+    queue_names = queue_names or discover_line_queues(hn)
+    lines = []
+    # one pool of worker processes shared by every line
+    pool = make_pool(workers) if workers else None
+    # one store shared by every line, each line writes only its own partition
+    store = ColumnStore(store_dir) if store_dir else None
+
+    # when a statement can go wrong, use a try-except block
+    try:
+        # try this code, if it works, keep going
+        # create a blocking connection to the RabbitMQ server
+        connection = open_connection(hn)
+
+    # except, if there's an error, do this
+    except Exception as e:
+        print()
+        print("ERROR: connection to RabbitMQ server failed.")
+        print(f"Verify the server is running on host={hn}.")
+        print(f"The error says: {e}")
+        print()
+        logger.error(f"ERROR: connection to RabbitMQ server failed. The error is {e}.")
+        sys.exit(1)
+
+    try:
+        # one channel, decoder, CSV and batch consumer per line queue, all on this connection
+        # The prefetch count limits the number of unacknowledged messages per channel,
+        # messages stay unacknowledged until their rows are written
+        for queue_name in queue_names:
+            line_queue = LineQueue(connection, queue_name, batch_size, batch_wait_ms, pool, store)
+            line_queue.start()
+            lines.append(line_queue)
+        connection.call_later(flush_delay, partial(flush_on_time, connection, lines))
+        if pool:
+            connection.call_later(batch_wait_ms / 1000, partial(poll_workers, connection, lines, batch_wait_ms / 1000))
+
+        # log how long messages wait and take now and then, and serve the numbers for scraping
+        connection.call_later(metrics_interval, partial(log_summary, connection, metrics, logger, metrics_interval))
+        start_metrics(metrics, metrics_port, logger)
+
+        # print a message to the console for the user
+        print(f" [*] Ready for work on {', '.join(queue_names)}. To exit press CTRL+C")
+        logger.info(f" [*] Ready for work on {', '.join(queue_names)}. To exit press CTRL+C")
+
+        # start consuming messages, the connection dispatches the messages of every channel
+        while True:
+            connection.process_data_events(time_limit=None)
+
+    # except, in the event of an error OR user stops the process, do this
+    except Exception as e:
+        print()
+        print("ERROR: something went wrong.")
+        print(f"The error says: {e}")
+        logger.error(f"Error: Something whent wrong. Error: {e}")
+        sys.exit(1)
+    except KeyboardInterrupt:
+        print()
+        print(" User interrupted continuous listening process.")
+        logger.info("KeyboardInterrupt. Stopping the Program")
+        # handle the messages still waiting, write what is still buffered and acknowledge them before leaving
+        for line_queue in lines:
+            line_queue.close()
+        for line in metrics.summary_lines():
+            logger.info(f"[metrics] {line}")
+        sys.exit(0)
+    finally:
+        # rows of messages that were not acknowledged are written too, the messages are redelivered
+        for line_queue in lines:
+            line_queue.sink.close()
+        if pool:
+            pool.shutdown(cancel_futures=True)
+        print("\nClosing connection. Goodbye.\n")
+        logger.info("\nclosing connection. Goodby\n")
+        connection.close()
+
+
+# Standard Python idiom to indicate main program entry point
+# This allows us to import this module and use its functions
+# without executing the code below.
+# If this is the program being run, then execute the code below
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write every line queue from MTA_ProducerV2.py to its own CSV.")
+    parser.add_argument("queues", nargs="*",
+                        help="line queues to consume, e.g. Line-Q_queue Line-5_queue (default: find them)")
+    parser.add_argument("--batch-size", type=int, default=batch_size,
+                        help="messages handled and acknowledged together (default 50)")
+    parser.add_argument("--batch-wait-ms", type=int, default=batch_wait_ms,
+                        help="how long a smaller batch may wait (default 50)")
+    parser.add_argument("--workers", type=int, default=workers,
+                        help="worker processes decoding messages, 0 decodes in this process (default 0)")
+    parser.add_argument("--store", default=store_dir,
+                        help="write NumPy column segments to this directory instead of the CSVs, e.g. Data_MTA_Store")
+    parser.add_argument("--host", default="localhost",
+                        help="RabbitMQ host, or memory://host:port for the broker in utils/util_transport.py (default localhost)")
+    args = parser.parse_args()
+    if args.store and args.workers:
+        parser.error("--workers formats CSV text in the workers, it cannot be used with --store")
+
+    # call the main function with the information needed
+    main(args.host, args.queues, args.batch_size, args.batch_wait_ms, args.workers, args.store)
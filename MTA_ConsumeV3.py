@@ -5,14 +5,16 @@ Date: 12 June 2024
 *** Use with "MTA_ProducerV3.py" ***
 
 This Consumer was designed to generate alerts based on the number of riders within a station using Rolling Window.
-The deque length was desided based on the number of readigns desired ever 3 hours over a 24 hour period.
-This script uses structs.
+The window length was desided based on the number of readigns desired ever 3 hours over a 24 hour period.
+This script uses structs, each message is a frame of several '=QI' readings (see utils/util_wire.py).
 
-1. Establishes Variables + deque length
-2. Decodes the message + adds ridership number to the deque
-3. Based on the data in the deque versus there being a specific number of people for a station to be busy an Alert is generated
+1. Establishes Variables + the alert engine (stations, window length and thresholds from MTA_AlertConfig.json)
+2. Decodes the message + adds the ridership numbers to the station's window
+3. Based on the data in the window versus there being a specific number of people for a station to be busy an Alert is generated
 4. Connection to RabbitMQ
-5. Standard Entry Point
+5. Standard Entry Point, --asyncio runs main_async: every station queue in one asyncio event loop (utils/util_aio.py)
+6. main records how long frames waited in each station queue and took to handle, logged every metrics_interval
+   seconds and served at http://127.0.0.1:<metrics_port>/metrics (see utils/util_metrics.py)
 
 ----
 
@@ -20,118 +22,128 @@ Base Code Author: Denise Case
 Date: January 15, 2023
 """
 
+import argparse
+import asyncio
+import numpy as np
 import pika
 import sys
 import time
-from collections import deque
-import struct
 from datetime import datetime
-from utils.util_logger import setup_logger
+from functools import partial
+from utils.util_batch import BatchConsumer, ack_through
+from utils.util_logger import RowLogger, setup_logger
+from utils.util_metrics import QueueMetrics, log_summary, start_metrics
+from utils.util_aio import connect, stop_event
+from utils.util_transport import is_memory, open_connection
+from utils.util_alerts import AlertEngine, load_alert_config, station_from_queue, station_queue_name
+from utils.util_wire import FRAME_CONTROL_QUEUE, advertise_frame_size, decode_frame, encode_frame_size
 
 # Configuring the Logger:
-logger, logname = setup_logger(__file__)
+# per-row lines go to logs/<name>.jsonl, query them with python -m utils.util_events
+logger, logname = setup_logger(__file__, queued=True, events=True)
 
 # Variables
 # ----------------------------------------------------------------------------
-# define the deque outside of functions, allowing them to be appended
+# One alert engine holds the rolling window for every station.
 # each reading is 1 minute apart to simulate the hourly readings
 # We want to know if the station is busy every three hours
 # 24 hours/3 hours with sleep time of 60 sec
 # 8 readings per interval
-Station447_deque = deque(maxlen=8) 
-Station463_deque = deque(maxlen=8)
-Station447_queue = "Station-447"
-Station463_queue = "Station-463"
+# The stations, window length and busy thresholds are read from MTA_AlertConfig.json
+# window_seconds makes the window the last 3 hours by transit_timestamp so a missing or repeated
+# hour does not skew it, allowed_lateness is how late a reading may arrive
+alert_config = load_alert_config('MTA_AlertConfig.json')
+engine = AlertEngine.from_config(alert_config)
+# largest number of readings we want ProducerV3 to put in one message
+frame_size = 8
+# frames handled together, how long (ms) a smaller batch may wait
+# and how many unacknowledged frames the broker may send us, see utils/util_batch.py
+batch_size = 16
+batch_wait_ms = 50
+prefetch_count = 32
+# one log line per reading: written by the logger's background thread, and only every row_log_every-th reading
+row_log_every = 1
+row_log = RowLogger(logger, sample_every=row_log_every)
+# queue wait and processing time per station queue, a summary is logged every metrics_interval seconds
+# and scraped from metrics_port (None turns the endpoint off)
+metrics = QueueMetrics()
+metrics_interval = 30
+metrics_port = 9306
 
 # Define Program functions
 #--------------------------------------------------------------------------
 
+def batch_callback(deliveries: list) -> list:
+    """
+    Define behavior on getting a batch of messages. Including unpacking the frames of structs.
+    Returns the delivery tags of the batch, the batch consumer acknowledges them all with one basic_ack.
+    """
+    # station id -> the frames for that station in this batch, in the order they arrived
+    frames = {}
+    for ch, method, properties, body in deliveries:
+        # the queue the message came from tells us the station, e.g. Station-447
+        station_id = station_from_queue(method.routing_key)
 
-# define a callback function to be called when a message is received for Station 447
-def Station447_callback(ch, method, properties, body):
-    """ Define behavior on getting a message."""
-    # decode the binary message body to a string
-    #print(f" [x] Received {body.decode()}")
-    
-    # acknowledge the message was received and processed 
-    # (now it can be deleted from the queue)
-    
-
-    # Clean the body of the message to find the temperature:
-    body_decode = struct.unpack('=QI',body)
-    transit_timestamp, Station447 = body_decode
-    
-    # Converst the timestamp back to a string for logging
-    transit_timestamp_str = datetime.fromtimestamp(transit_timestamp).strftime("%m/%d/%y %H:%M")
-    logger.info(f"[Station 447]: {transit_timestamp_str}: {Station447} Passengers")
-
-    # Add new ridership number to deque
-    Station447_deque.append(Station447)
-
-    # Objective, to know if the station is busy, more than 1000 people is busy
-    # in 3 hours, if so a Station Alert is generated
-    if len(Station447_deque) == Station447_deque.maxlen:
-        if Station447_deque[0] - Station447 >= 1000:
-            Station447_change = Station447_deque[0] - Station447
-            logger.info(f'''
-                        ************************ [STATION 447 BUSY ALERT!!!!] *****************************
-                        * Station 447 is busier than normal
-                        * In the past 3 hours ther have been {Station447_change} people
-                        Please Adjsut your commute accordingly.
-                        *************************************************************************
-                        ''')
-    # Acknowlege it was recieved and processed
-    # Can now be deleted from queue
-    ch.basic_ack(delivery_tag=method.delivery_tag)
-
-def Station463_callback(ch, method, properties, body):
-    """ Define behavior on getting a message. Including unpacking struct."""
-    # decode the binary message body to a string
-    #print(f" [x] Received {body.decode()}")
-    logger.info(f"[x] Received")
-    
-    # acknowledge the message was received and processed 
-    # (now it can be deleted from the queue)
-    
-
-    # Clean the body of the message to find the temperature:
-    body_decode = struct.unpack('=QI',body)
-    transit_timestamp, Station463 = body_decode
-    
-    # Converst the timestamp back to a string for logging
-    transit_timestamp_str = datetime.fromtimestamp(transit_timestamp).strftime("%m/%d/%y %H:%M")
-    logger.info(f"[Station 463]: {transit_timestamp_str}: {Station463} Passengers")
-
-    # Add new ridership number to deque
-    Station463_deque.append(Station463)
-
-    # Objective, to know if the station is busy, more than 100 people is busy
-    # in 3 hours, if so a Station Alert is generated
-    if len(Station463_deque) == Station463_deque.maxlen:
-        if Station463_deque[0] - Station463 >= 100:
-            Station463_change = Station463_deque[0] - Station463
-            logger.info(f'''
-                        ************************ [STATION 463 BUSY ALERT!!!!] *****************************
-                        * Station 463 is busier than normal
-                        * In the past 3 hours ther have been {Station463_change} people
-                        Please Adjsut your commute accordingly.
-                        *************************************************************************
-                        ''')
-    # Acknowlege it was recieved and processed
+        # Unpack the frame: a count header followed by (timestamp, ridership) '=QI' readings
+        # decode_frame gives a NumPy view of the body so the readings are not copied
+        readings = decode_frame(body)
+        for transit_timestamp, ridership in zip(readings['transit_timestamp'].tolist(), readings['ridership'].tolist()):
+            if row_log.wanted():
+                # Converst the timestamp back to a string for logging
+                transit_timestamp_str = datetime.fromtimestamp(transit_timestamp).strftime("%m/%d/%y %H:%M")
+                row_log.log("[Station %s]: %s: %s Passengers", station_id, transit_timestamp_str, ridership,
+                            event={"station_complex_id": station_id, "transit_timestamp": transit_timestamp,
+                                   "ridership": ridership})
+        frames.setdefault(station_id, []).append(readings)
+
+    # Add the new ridership numbers to each station's window and check them all at once.
+    # Objective, to know if the station is busy, a change of more than the station's threshold
+    # in 3 hours is busy, if so a Station Alert is generated
+    for station_id, station_frames in frames.items():
+        readings = np.concatenate(station_frames)
+        for alert in engine.push_station(station_id, readings['transit_timestamp'], readings['ridership']):
+            log_alert(alert)
+
+    # Acknowlege the batch was recieved and processed
     # Can now be deleted from queue
-    ch.basic_ack(delivery_tag=method.delivery_tag)
-                       
+    return [method.delivery_tag for ch, method, properties, body in deliveries]
+
+
+def window_description() -> str:
+    """The window the alerts are checked over, for the log."""
+    if engine.window_seconds:
+        if engine.window_seconds % 3600:
+            return f"{engine.window_seconds // 60} minutes"
+        return f"{engine.window_seconds // 3600} hours"
+    return f"{engine.window} readings"
+
+
+def log_alert(alert):
+    """Write a busy alert to the log."""
+    if alert.kind == 'zscore':
+        transit_timestamp_str = datetime.fromtimestamp(alert.transit_timestamp).strftime("%m/%d/%y %H:%M")
+        logger.info(f"[STATION {alert.station_id} SPIKE]: {transit_timestamp_str} ridership is {alert.change} "
+                    f"standard deviations above the mean of the past {window_description()}")
+        return
+    logger.info(f'''
+                ************************ [STATION {alert.station_id} BUSY ALERT!!!!] *****************************
+                * Station {alert.station_id} is busier than normal
+                * In the past {window_description()} ther have been {alert.change} people
+                Please Adjsut your commute accordingly.
+                *************************************************************************
+                ''')
 
 
 # define a main function to run the program
-def main(hn: str = "localhost"):
-    """ Continuously listen for task messages on a named queue."""
+def main(hn: str = "localhost", batch_size: int = batch_size, batch_wait_ms: int = batch_wait_ms):
+    """ Continuously listen for task messages on the station queues, handling them in batches."""
+    batcher = None
 
     # when a statement can go wrong, use a try-except block
     try:
         # try this code, if it works, keep going
         # create a blocking connection to the RabbitMQ server
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host=hn))
+        connection = open_connection(hn)
 
     # except, if there's an error, do this
     except Exception as e:
@@ -151,26 +163,33 @@ def main(hn: str = "localhost"):
         # a durable queue will survive a RabbitMQ server restart
         # and help ensure messages are processed in order
         # messages will not be deleted until the consumer acknowledges
-        channel.queue_delete(Station447_queue)
-        channel.queue_delete(Station463_queue)
-        channel.queue_declare(Station447_queue, durable=True)
-        channel.queue_declare(Station463_queue, durable=True)
+        for station_id in engine.station_ids:
+            channel.queue_delete(station_queue_name(station_id))
+            channel.queue_declare(station_queue_name(station_id), durable=True)
+
+        # tell ProducerV3 how many readings to pack into each frame
+        advertise_frame_size(channel, frame_size)
 
         # The QoS level controls the # of messages
         # that can be in-flight (unacknowledged by the consumer)
         # at any given time.
-        # Set the prefetch count to one to limit the number of messages
+        # The prefetch count limits the number of messages
         # being consumed and processed concurrently.
         # This helps prevent a worker from becoming overwhelmed
         # and improve the overall system performance. 
-        # prefetch_count = Per consumer limit of unaknowledged messages      
-        channel.basic_qos(prefetch_count=1) 
+        # prefetch_count = Per consumer limit of unaknowledged messages
+        # It is larger than batch_size so frames keep arriving while a batch is checked
+
+        # configure the channel to listen on every station queue,  
+        # collect up to batch_size frames or wait batch_wait_ms, hand them to batch_callback,
+        # and do not auto-acknowledge the message (one basic_ack per batch)
+        batcher = BatchConsumer(connection, channel, batch_callback, batch_size, batch_wait_ms, prefetch_count,
+                                metrics=metrics)
+        batcher.start([station_queue_name(station_id) for station_id in engine.station_ids])
 
-        # configure the channel to listen on a specific queue,  
-        # use the callback function named callback,
-        # and do not auto-acknowledge the message (let the callback handle it)
-        channel.basic_consume( queue="Station-447", on_message_callback=Station447_callback, auto_ack=False)
-        channel.basic_consume( queue="Station-463", on_message_callback=Station463_callback, auto_ack=False)
+        # log how long frames wait and take now and then, and serve the numbers for scraping
+        connection.call_later(metrics_interval, partial(log_summary, connection, metrics, logger, metrics_interval))
+        start_metrics(metrics, metrics_port, logger)
 
         # print a message to the console for the user
         print(" [*] Ready for work. To exit press CTRL+C")
@@ -190,6 +209,16 @@ def main(hn: str = "localhost"):
         print()
         print(" User interrupted continuous listening process.")
         logger.info("KeyboardInterrupt. Stopping the Program")
+        # handle and acknowledge the frames still waiting
+        if batcher:
+            batcher.process()
+        # check the readings still waiting for the watermark before stopping
+        for alert in engine.flush():
+            log_alert(alert)
+        for station_id, time_window in engine.windows.items():
+            logger.info(f"[Station {station_id}]: dropped {time_window.late} late and {time_window.duplicates} duplicate readings")
+        for line in metrics.summary_lines():
+            logger.info(f"[metrics] {line}")
         sys.exit(0)
     finally:
         print("\nClosing connection. Goodbye.\n")
@@ -197,10 +226,96 @@ def main(hn: str = "localhost"):
         connection.close()
 
 
+async def consume_station(channel, deliveries: asyncio.Queue, batch_size: int = batch_size):
+    """Check one station's frames as they arrive, a batch at a time, and acknowledge each batch."""
+    while True:
+        batch = [await deliveries.get()]
+        # take whatever else has already arrived, up to batch_size
+        while len(batch) < batch_size and not deliveries.empty():
+            batch.append(deliveries.get_nowait())
+        # each station has its own channel so the multi-ack only covers this station's frames
+        ack_through(channel, batch_callback(batch))
+        for _ in batch:
+            deliveries.task_done()
+
+
+async def main_async(hn: str = "localhost", batch_size: int = batch_size, stop: asyncio.Event = None):
+    """
+    The asyncio version of main: every station queue is consumed concurrently in one event loop.
+
+    Each station gets its own channel, a bounded asyncio.Queue of prefetch_count deliveries
+    (the prefetch count keeps the broker from sending more) and a coroutine checking its frames.
+    Ctrl+C or SIGTERM (or setting stop) cancels the consumers, the frames already received are
+    checked and acknowledged, and the connection is closed.
+    """
+    stop = stop or stop_event()
+    connection = await connect(hn)
+    channels = []
+    workers = []
+    try:
+        control = await connection.channel()
+        channels.append(control)
+        # tell ProducerV3 how many readings to pack into each frame
+        await control.queue_declare(FRAME_CONTROL_QUEUE, durable=True)
+        await control.queue_purge(FRAME_CONTROL_QUEUE)
+        await control.publish(FRAME_CONTROL_QUEUE, encode_frame_size(frame_size))
+
+        consumers = []
+        for station_id in engine.station_ids:
+            queue_name = station_queue_name(station_id)
+            channel = await connection.channel()
+            channels.append(channel)
+            await channel.queue_delete(queue_name)
+            await channel.queue_declare(queue_name, durable=True)
+            await channel.basic_qos(prefetch_count)
+            deliveries = asyncio.Queue(maxsize=prefetch_count)
+            consumers.append((channel, channel.consume(queue_name, deliveries), deliveries))
+            workers.append(asyncio.create_task(consume_station(channel, deliveries, batch_size)))
+
+        print(" [*] Ready for work. To exit press CTRL+C")
+        logger.info(" [*] Ready for work (asyncio). To exit press CTRL+C")
+        await stop.wait()
+
+        logger.info("Stop requested. Checking the frames already received")
+        for channel, consumer_tag, deliveries in consumers:
+            await channel.cancel(consumer_tag)
+            await deliveries.join()
+        # check the readings still waiting for the watermark before stopping
+        for alert in engine.flush():
+            log_alert(alert)
+    finally:
+        for worker in workers:
+            worker.cancel()
+        for channel in channels:
+            await channel.close()
+        await connection.close()
+        print("\nClosing connection. Goodbye.\n")
+        logger.info("\nclosing connection. Goodby\n")
+
+
 # Standard Python idiom to indicate main program entry point
 # This allows us to import this module and use its functions
 # without executing the code below.
 # If this is the program being run, then execute the code below
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Raise busy alerts from the Station queues filled by MTA_ProducerV3.py.")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="consume every station queue in one asyncio event loop (main_async)")
+    parser.add_argument("--host", default="localhost",
+                        help="RabbitMQ host, or memory://host:port for the broker in utils/util_transport.py (default localhost)")
+    args = parser.parse_args()
+    if args.asyncio and is_memory(args.host):
+        parser.error("--asyncio needs RabbitMQ, the memory broker only works with the blocking consumer")
+
     # call the main function with the information needed
-    main("localhost")
+    if args.asyncio:
+        try:
+            asyncio.run(main_async(args.host))
+        except KeyboardInterrupt:
+            logger.info("KeyboardInterrupt. Stopping the Program")
+        except pika.exceptions.AMQPConnectionError as e:
+            print(f"ERROR: connection to RabbitMQ server failed. The error says: {e}")
+            logger.error(f"ERROR: connection to RabbitMQ server failed. The error is {e}.")
+            sys.exit(1)
+    else:
+        main(args.host)
@@ -7,6 +7,8 @@ This consumer does the following:
 1. decodes the message from the queue
 2. splits the original message with ',' to facilitate writing the CSV
 3. Writes the data to a CSV file with only the desired columns from the producer.
+4. Records how long messages waited in the queue and took to handle, logged every metrics_interval seconds
+   and served at http://127.0.0.1:<metrics_port>/metrics (see utils/util_metrics.py).
     
     This program listens for work messages contiously. 
     Start multiple versions to add more workers. 
@@ -16,18 +18,35 @@ This consumer does the following:
 
 """
 
-import pika
 import sys
 import time
 from datetime import datetime
 import csv
-from utils.util_logger import setup_logger
+from functools import partial
+from utils.util_batch import BatchConsumer, ack_through
+from utils.util_logger import RowLogger, setup_logger
+from utils.util_metrics import QueueMetrics, log_summary, start_metrics
+from utils.util_transport import open_connection
 
 # Configuring the Logger:
-logger, logname = setup_logger(__file__)
+# per-row lines go to logs/<name>.jsonl, query them with python -m utils.util_events
+logger, logname = setup_logger(__file__, queued=True, events=True)
 
 # Variables
 csv_file_path = 'Data_MTA_Num7.csv'
+# messages handled together, how long (ms) a smaller batch may wait
+# and how many unacknowledged messages the broker may send us, see utils/util_batch.py
+batch_size = 100
+batch_wait_ms = 50
+prefetch_count = 200
+# one log line per message: written by the logger's background thread, and only every row_log_every-th message
+row_log_every = 1
+row_log = RowLogger(logger, sample_every=row_log_every)
+# queue wait and processing time, a summary is logged every metrics_interval seconds
+# and scraped from metrics_port (None turns the endpoint off)
+metrics = QueueMetrics()
+metrics_interval = 30
+metrics_port = 9301
 
 
 # Define Program functions
@@ -36,44 +55,59 @@ csv_file_path = 'Data_MTA_Num7.csv'
 
 # define a callback function to be called when a message is received
 def callback(ch, method, properties, body):
-    """ Define behavior on getting a message.  This process utilizes JSON in order to filter the contents of the message."""
-    # decode the binary message body to a string
-    print(f" [x] Received {body.decode()}")
-    logger.info(f" [x] Received {body.decode()}")
-    original = body.decode()
-    message = original.split(',')
-
-    # Convert timestamp back to a string:
-    #transit_timestamp_str = datetime.fromtimestamp(transit_timestamp).strftime("%m/%d/%y %H:%M:%S")
-    
-    # filter the data
-    #filter_stations = Line7_filter(body.decode())
-    
-    # Create a list of tuples containing the data
-    #data = [(transit_timestamp_str, transit_mode, station_complex_id, station_complex, borough, ridership)
-    # Write the filtered data into a new file
+    """ Define behavior on getting a single message, handled as a batch of one and acknowledged."""
+    ack_through(ch, batch_callback([(ch, method, properties, body)]))
+
+
+def batch_callback(deliveries: list) -> list:
+    """
+    Define behavior on getting a batch of messages.  This process utilizes JSON in order to filter the contents of the message.
+    Returns the delivery tags of the batch, the batch consumer acknowledges them all with one basic_ack.
+    """
+    # Write the filtered data into a new file, opened once for the whole batch
     with open ('Data_MTA_Num7.csv', 'a', newline='') as file:
         writer = csv.writer(file)
-        writer.writerow(message)
-        logger.info(f'[x] Added to CSV {message}')
-
-        # when done with task, tell the user
-        print(" [x] Done.")
-        logger.info(" [x] Done.")
-        # acknowledge the message was received and processed 
-        # (now it can be deleted from the queue)
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        for ch, method, properties, body in deliveries:
+            # decode the binary message body to a string
+            print(f" [x] Received {body.decode()}")
+            original = body.decode()
+            # both lines of a message are logged, or neither
+            logged = row_log.wanted()
+            if logged:
+                row_log.log(" [x] Received %s", original)
+            message = original.split(',')
+
+            # Convert timestamp back to a string:
+            #transit_timestamp_str = datetime.fromtimestamp(transit_timestamp).strftime("%m/%d/%y %H:%M:%S")
+            
+            # filter the data
+            #filter_stations = Line7_filter(body.decode())
+            
+            # Create a list of tuples containing the data
+            #data = [(transit_timestamp_str, transit_mode, station_complex_id, station_complex, borough, ridership)
+            writer.writerow(message)
+            if logged:
+                row_log.log('[x] Added to CSV %s', message)
+
+    # when done with task, tell the user
+    print(" [x] Done.")
+    logger.info(" [x] Done.")
+    # the whole batch was received and processed
+    # (now it can be deleted from the queue)
+    return [method.delivery_tag for ch, method, properties, body in deliveries]
 
 
 # define a main function to run the program
-def main(hn: str = "localhost", qn: str = "07-Line"):
-    """ Continuously listen for task messages on a named queue."""
+def main(hn: str = "localhost", qn: str = "07-Line", batch_size: int = batch_size,
+         batch_wait_ms: int = batch_wait_ms):
+    """ Continuously listen for task messages on a named queue, handling them in batches."""
+    batcher = None
 
     # when a statement can go wrong, use a try-except block
     try:
         # try this code, if it works, keep going
         # create a blocking connection to the RabbitMQ server
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host=hn))
+        connection = open_connection(hn)
 
     # except, if there's an error, do this
     except Exception as e:
@@ -99,17 +133,23 @@ def main(hn: str = "localhost", qn: str = "07-Line"):
         # The QoS level controls the # of messages
         # that can be in-flight (unacknowledged by the consumer)
         # at any given time.
-        # Set the prefetch count to one to limit the number of messages
+        # The prefetch count limits the number of messages
         # being consumed and processed concurrently.
         # This helps prevent a worker from becoming overwhelmed
         # and improve the overall system performance. 
-        # prefetch_count = Per consumer limit of unaknowledged messages      
-        channel.basic_qos(prefetch_count=1) 
+        # prefetch_count = Per consumer limit of unaknowledged messages
+        # It is larger than batch_size so messages keep arriving while a batch is written
 
         # configure the channel to listen on a specific queue,  
-        # use the callback function named callback,
-        # and do not auto-acknowledge the message (let the callback handle it)
-        channel.basic_consume( queue=qn, on_message_callback=callback, auto_ack=False)
+        # collect up to batch_size messages or wait batch_wait_ms, hand them to batch_callback,
+        # and do not auto-acknowledge the message (one basic_ack per batch)
+        batcher = BatchConsumer(connection, channel, batch_callback, batch_size, batch_wait_ms, prefetch_count,
+                                metrics=metrics)
+        batcher.start([qn])
+
+        # log how long messages wait and take now and then, and serve the numbers for scraping
+        connection.call_later(metrics_interval, partial(log_summary, connection, metrics, logger, metrics_interval))
+        start_metrics(metrics, metrics_port, logger)
 
         # print a message to the console for the user
         print(" [*] Ready for work. To exit press CTRL+C")
@@ -129,6 +169,11 @@ def main(hn: str = "localhost", qn: str = "07-Line"):
         print()
         print(" User interrupted continuous listening process.")
         logger.info("KeyboardInterrupt. Stopping the Program")
+        # handle and acknowledge the messages still waiting before leaving
+        if batcher:
+            batcher.process()
+        for line in metrics.summary_lines():
+            logger.info(f"[metrics] {line}")
         sys.exit(0)
     finally:
         print("\nClosing connection. Goodbye.\n")
@@ -13,6 +13,7 @@
    from specific stations with their attached boroughs. 
    The first part of the script sets up the connection with the RabbitMQ server.
    The second function reads the CSV, selects the desired data, creates the message and then send the message to queue.
+   With --start/--end only that time range is sent, the reader seeks straight to it (see utils/util_index.py).
 
     Base Code Author: Denise Case
     Date: January 15, 2023
@@ -22,20 +23,28 @@
 import pika
 import sys
 import webbrowser
-import csv
-from datetime import datetime
-import time
+import argparse
 
 
-from utils.util_logger import setup_logger
+from utils.util_logger import RowLogger, setup_logger
+from utils.util_publisher import get_publisher
+from utils.util_reader import read_subway
+from utils.util_replay import ReplayClock, parse_speed, parse_timestamp
+from utils.util_transport import is_memory
 
 # Configuring the Logger:
-logger, logname = setup_logger(__file__)
+# per-row lines go to logs/<name>.jsonl, query them with python -m utils.util_events
+logger, logname = setup_logger(__file__, queued=True, events=True)
 
 # Declare Variables:
 host = 'localhost'
 input_file_name = 'MTA_SubwayW1Feb22.csv'
 Num7Sub_queue = '07-Line'
+# 60x replays an hour of data every minute, as the old 60 second sleep intended
+replay_speed = 60
+# one log line per row: written by the logger's background thread, and only every row_log_every-th row
+row_log_every = 1
+row_log = RowLogger(logger, sample_every=row_log_every)
 
 
 # Define Program functions
@@ -52,8 +61,8 @@ def offer_rabbitmq_admin_site():
 
 def send_message(host: str, queue_name: str, message: str):
     """
-    Creates and sends a message to the queue each execution.
-    This process runs and finishes.
+    Sends a message to the queue using the publisher shared by this process.
+    The connection stays open between messages, see utils/util_publisher.py.
 
     Parameters:
         host (str): the host name or IP address of the RabbitMQ server
@@ -62,33 +71,18 @@ def send_message(host: str, queue_name: str, message: str):
     """
 
     try:
-        # create a blocking connection to the RabbitMQ server
-        conn = pika.BlockingConnection(pika.ConnectionParameters(host))
-        # use the connection to create a communication channel
-        ch = conn.channel()
-
-        # Delete existing queus and declares them anew to clear the previous queue.
-        #ch.queue_delete(Num7Sub_queue)
-        
-        # use the channel to declare a durable queue
+        # the shared publisher declares the durable queue the first time it is used
         # a durable queue will survive a RabbitMQ server restart
         # and help ensure messages are processed in order
         # messages will not be deleted until the consumer acknowledges
-        ch.queue_declare(Num7Sub_queue, durable=True)
-        # use the channel to publish a message to the queue
-        # every message passes through an exchange
-        ch.basic_publish(exchange="", routing_key=queue_name, body=message)
-        # print a message to the console for the user
+        get_publisher(host).publish(queue_name, message)
     except pika.exceptions.AMQPConnectionError as e:
         print(f"Error: Connection to RabbitMQ server failed: {e}")
         logger.error(f"Error: Connection to RabbitMQ server failed: {e}")
         sys.exit(1)
-    finally:
-        # close the connection to the server
-        conn.close()
      
 
-def main(host: str, input_file:str):
+def main(host: str, input_file:str, speed: float = replay_speed, start: float = None, end: float = None):
     """
     Open a CSV and iterate through each row of the CSV to trun it to a list of dictionars (JSON format)
     Seperate processes by column and send message by calling the send message function.
@@ -96,50 +90,57 @@ def main(host: str, input_file:str):
     Parameters:
     host (str): Name of host or IP address fo the RabbitMQ server
     input_file_name (str): The location of the input file.
+    speed (float): Replay multiplier for transit_timestamp, 1 is real time, None is as fast as possible.
+    start, end (float): Optional, send only rows with start <= transit_timestamp < end (Unix seconds).
 
     Comments above the code are reffering to the code in the next line and its function.
     """
-try:
-    with open(input_file_name, 'r', newline='', encoding='utf-8') as input_file:
-        reader = csv.reader(input_file, delimiter=',')
-        next(reader)
-        # reading rows from csv
-        for row in reader:
-                # Seperate row into variables by column:
-                #transit_timestamp, transit_mode, station_complex_id, station_complex, borough, payment_method, fare_class_category, ridership, transfers, latitude, longitude, Georeference = row
-                transit_timestamp=row[0]
-                station_complex_id = row[2]
-                station_complex = row[3]
-                borough = row[4]
-                ridership = row[7]
-
-                # logging the row being ingested
-                logger.info(f'{transit_timestamp=} - Row ingested: {station_complex_id=}, {station_complex=}, {borough=}, {ridership=}')
-                # Convert the transit_timestamp_str into a datetime object in Unix:
-                #transit_timestamp = datetime.strptime(transit_timestamp_str, "%m/%d/%y %H:%M:%S"). timestamp()
-                # Pulling the desired info
-                message =(f" {transit_timestamp}, {station_complex_id}, {station_complex}, {borough}, {ridership}").encode() 
-                send_message(host, "07-Line", message)
-                logger.info(f"[x] sent {message} at {transit_timestamp} to {Num7Sub_queue}")
-            
-            
-        # set sleep for 60 seconds before reading next row to simulate an hour.
-        #time.sleep(30)# Time was set to 30 seconds for Producer Test 1.
-        time.sleep(60)
-
-# A Keyboard Interrupt was added as the Process to pull all of the data from the stream is long. 
-# Escape also adds note to the log.            
-except KeyboardInterrupt:
-        print()
-        print(" User interrupted continuous listening process.")
-        logger.info("KeyboardInterrupt. Stopping the Program")
-        sys.exit(0)
-except FileNotFoundError:
-         logger.error("CSV file not found")
-         sys.exit(1)
-except ValueError as e:
-         logger.error(f"An unecpected error has occured: {e}")
-         sys.exit(1)  
+    # paces each row by its transit_timestamp instead of a fixed sleep
+    clock = ReplayClock(speed)
+    try:
+        # the shared reader streams the CSV in typed chunks and handles the BOM and quoted fields
+        for chunk in read_subway(input_file, start=start, end=end):
+            # reading rows from csv
+            for subway_data in chunk.rows():
+                    # Seperate row into variables by column:
+                    transit_timestamp = subway_data['transit_timestamp']
+                    station_complex_id = subway_data['station_complex_id']
+                    station_complex = subway_data['station_complex']
+                    borough = subway_data['borough']
+                    ridership = subway_data['ridership']
+
+                    # wait until this row is due in the replay
+                    clock.wait_until(transit_timestamp)
+
+                    # logging the row being ingested
+                    # both lines of a row are logged, or neither
+                    logged = row_log.wanted()
+                    if logged:
+                        row_log.log('transit_timestamp=%r - Row ingested: station_complex_id=%r, station_complex=%r, '
+                                    'borough=%r, ridership=%r',
+                                    transit_timestamp, station_complex_id, station_complex, borough, ridership,
+                                    event=subway_data)
+                    # Pulling the desired info
+                    message =(f" {transit_timestamp}, {station_complex_id}, {station_complex}, {borough}, {ridership}").encode() 
+                    send_message(host, "07-Line", message)
+                    if logged:
+                        row_log.log("[x] sent %s at %s to %s", message, transit_timestamp, Num7Sub_queue,
+                                    event={"transit_timestamp": transit_timestamp,
+                                           "station_complex_id": station_complex_id, "queue": Num7Sub_queue})
+
+    # A Keyboard Interrupt was added as the Process to pull all of the data from the stream is long. 
+    # Escape also adds note to the log.            
+    except KeyboardInterrupt:
+            print()
+            print(" User interrupted continuous listening process.")
+            logger.info("KeyboardInterrupt. Stopping the Program")
+            sys.exit(0)
+    except FileNotFoundError:
+             logger.error("CSV file not found")
+             sys.exit(1)
+    except ValueError as e:
+             logger.error(f"An unecpected error has occured: {e}")
+             sys.exit(1)  
  
 
 # Standard Python idiom to indicate main program entry point
@@ -147,8 +148,20 @@ except ValueError as e:
 # without executing the code below.
 # If this is the program being run, then execute the code below
 if __name__ == "__main__":  
+    parser = argparse.ArgumentParser(description="Stream MTA_SubwayW1Feb22.csv to the 07-Line queue.")
+    parser.add_argument("--speed", type=parse_speed, default=replay_speed,
+                        help="replay multiplier: realtime, a number such as 3600, or max (default 60)")
+    parser.add_argument("--host", default="localhost",
+                        help="RabbitMQ host, or memory://host:port for the broker in utils/util_transport.py (default localhost)")
+    parser.add_argument("--start", type=parse_timestamp,
+                        help="first transit_timestamp to send, e.g. \"02/03/22 17:00:00\" (default: the start of the file)")
+    parser.add_argument("--end", type=parse_timestamp,
+                        help="transit_timestamp to stop before (default: the end of the file)")
+    args = parser.parse_args()
+
     # ask the user if they'd like to open the RabbitMQ Admin site
-    offer_rabbitmq_admin_site()
+    if not is_memory(args.host):
+        offer_rabbitmq_admin_site()
 
     # send the message to the queue
-    main("localhost", input_file_name)
\ No newline at end of file
+    main(args.host, input_file_name, args.speed, args.start, args.end)
@@ -9,8 +9,17 @@
 
     1. Creates Connection to RabbitMQ server with details on how to create a queue and send a message.
     2. reads the csv
-    3. Creates queues based on Subway Line and then sorts the messages based on Line.
-    4. Pickles "subway_data" and send the message to each of the queues created. 
+    3. Creates queues based on Subway Line and then sorts the messages based on Line, a whole block of rows at a time.
+    4. Packs "subway_data" into binary records (utils/util_wire.py) and send the messages to each of the queues created. 
+    5. With --asyncio, main_async does the same in one asyncio event loop (utils/util_aio.py): the reader fills a
+       bounded asyncio.Queue per Line and one sender per queue publishes from it, all on one channel.
+    6. With --start/--end only that time range is sent, the reader seeks straight to it (see utils/util_index.py).
+    7. Writes a checkpoint of the rows the broker has confirmed every 100 confirmed messages or every second. A run
+       that was stopped resumes there and sends no confirmed row twice, after a crash at most what was confirmed
+       since the last checkpoint is sent again, --restart starts from the top
+       (see utils/util_checkpoint.py, blocking publisher only).
+    8. Every new dictionary and station table (a state) also goes to State-<queue>, where a consumer that restarted
+       or was attached late can read the state its records need (see utils/util_wire.py).
 
     ----
     
@@ -22,24 +31,40 @@
 
 """
 
+import asyncio
 import pika
 import sys
 import webbrowser
-import csv
-import pickle
-from datetime import datetime
-import time
+import argparse
 
 
+from utils.util_aio import connect, stop_event
+from utils.util_checkpoint import ReplayCheckpoint
 from utils.util_logger import setup_logger
+from utils.util_metrics import SendStamper
+from utils.util_publisher import BatchPublisher
+from utils.util_partition import Partitioner, split_runs
+from utils.util_reader import read_subway
+from utils.util_replay import ReplayClock, format_timestamp, parse_speed, parse_timestamp
+from utils.util_transport import is_memory
+from utils.util_wire import WireEncoder, is_state_message, state_queue_name
 
 # Configuring the Logger:
-logger, logname = setup_logger(__file__)
+logger, logname = setup_logger(__file__, queued=True)
 
 # Declare Variables:
 host = 'localhost'
 input_file_name = 'MTA_SubwayW1Feb22.csv'
-
+# Batched publishing: messages per queue per batch, longest wait in ms, unconfirmed message limit
+batch_size = 100
+linger_ms = 50
+max_in_flight = 1000
+# 60x replays an hour of data every minute, as the old 60 second sleep intended
+replay_speed = 60
+# asyncio producer: messages waiting per Line queue before the reader has to wait for its sender
+queue_size = 100
+# replay position, saved as the broker confirms messages (see utils/util_checkpoint.py)
+checkpoint_file = 'MTA_ProducerV2.checkpoint.json'
 
 
 # Define Program functions
@@ -54,112 +79,232 @@ def offer_rabbitmq_admin_site():
         print()
         logger.info()
 
-def send_message(host: str, queue_name: str, message: str):
+def main(host: str, input_file:str, batch_size: int = batch_size, linger_ms: float = linger_ms,
+         max_in_flight: int = max_in_flight, speed: float = replay_speed, start: float = None, end: float = None,
+         restart: bool = False):
     """
-    Creates and sends a message to the queue each execution.
-    This process runs and finishes.
+    Open a CSV and iterate through each row of the CSV to trun it to a list of dictionars (JSON format)
+    Seperate processes by column and send message by calling the send message function.
+    Messages are buffered per Line queue and sent in batches, the broker confirms them as they arrive.
 
     Parameters:
-        host (str): the host name or IP address of the RabbitMQ server
-        queue_name (str): the name of the queue
-        message (str): the message to be sent to the queue
-    """
+    host (str): Name of host or IP address fo the RabbitMQ server
+    input_file_name (str): The location of the input file.
+    batch_size (int): Number of messages per queue sent together.
+    linger_ms (float): Longest time a message waits in the buffer before its batch is sent.
+    max_in_flight (int): Most messages sent and not yet confirmed, across all queues.
+    speed (float): Replay multiplier for transit_timestamp, 1 is real time, None is as fast as possible.
+    start, end (float): Optional, send only rows with start <= transit_timestamp < end (Unix seconds).
+    restart (bool): Ignore the checkpoint of an earlier run and start from the top.
 
+    Comments above the code are reffering to the code in the next line and its function.
+    """
+    # follows which rows the broker has confirmed and resumes an earlier run, see utils/util_checkpoint.py
     try:
-        # create a blocking connection to the RabbitMQ server
-        conn = pika.BlockingConnection(pika.ConnectionParameters(host))
-        # use the connection to create a communication channel
-        channel = conn.channel()
-
-        # use the channel to declare a durable queue
-        # a durable queue will survive a RabbitMQ server restart
-        # and help ensure messages are processed in order
-        # messages will not be deleted until the consumer acknowledges
-        channel.queue_declare(queue= queue_name, durable= True)
-
-        channel.basic_publish(exchange="", routing_key=queue_name, body=message)
-        # print a message to the console for the user
-        logger.info(f"[x] Sent {message}")
-        
-    except pika.exceptions.AMQPConnectionError as e:
-        print(f"Error: Connection to RabbitMQ server failed: {e}")
-        logger.error(f"Error: Connection to RabbitMQ server failed: {e}")
+        checkpoint = ReplayCheckpoint(checkpoint_file, input_file, start, end, logger)
+    except FileNotFoundError:
+        logger.error("CSV file not found")
         sys.exit(1)
-    finally:
-        # close the connection to the server
-        conn.close()
-     
+    if restart:
+        checkpoint.clear()
+    else:
+        checkpoint.load()
+    publisher = BatchPublisher(host, batch_size=batch_size, linger_ms=linger_ms,
+                               max_in_flight=max_in_flight, on_confirm=checkpoint.on_confirm, logger=logger)
+    # paces each row by its transit_timestamp instead of a fixed sleep
+    clock = ReplayClock(speed)
+    # groups each block of rows by Line in one vectorized pass
+    partitioner = Partitioner('Line')
+    # packs rows into the binary wire format, see utils/util_wire.py
+    encoder = WireEncoder()
+    try:
+        # the shared reader streams the CSV in typed chunks and handles the BOM and quoted fields
+        reader = read_subway(input_file, start=checkpoint.read_start(), end=end)
+        for chunk in reader:
+            # row number of the block's first row in the file
+            row = reader.chunk_row
+            # when pacing the replay, split the chunk into one block per transit_timestamp
+            blocks = [chunk] if clock.speed is None else split_runs(chunk, 'transit_timestamp')
+            for block in blocks:
+                if clock.speed is not None:
+                    # wait until this hour is due, the publisher sends the previous hour's batches
+                    # once they have lingered and takes the broker's confirms meanwhile
+                    clock.wait_until(int(block['transit_timestamp'][0]), publisher.sleep)
+
+                # select queue depending on line, one group of rows per Line-<X>_queue
+                for queue, positions in partitioner.groups(block):
+                    # rows the broker confirmed before a restart are not sent again
+                    positions = positions[row + positions >= checkpoint.first_new_row(queue)]
+                    if not len(positions):
+                        continue
+                    rows = block.take(positions)
+                    # pack the group into binary records (plus the string dictionary when it is new)
+                    # and add the messages to the batch for its queue
+                    messages = encoder.encode(queue, rows)
+                    # a new state goes to the state queue first, sent on the same channel before any record that needs it
+                    state = [message for message in messages if is_state_message(message)]
+                    if state:
+                        publisher.publish_batch(state_queue_name(queue), state)
+                        publisher.flush([state_queue_name(queue)])
+                    # the file row each message starts at, the state messages go ahead of the first records
+                    first_rows = (row + positions[::encoder.max_records]).tolist()
+                    checkpoint.sent(queue, first_rows[:1] * len(state) + first_rows, rows['transit_timestamp'][0])
+                    publisher.publish_batch(queue, messages)
+                    logger.info(f"[x] buffered {len(rows)} rows in {len(messages)} messages for {queue}, "
+                                f"{format_timestamp(rows['transit_timestamp'][0])} to {format_timestamp(rows['transit_timestamp'][-1])}")
+                row += len(block)
+                checkpoint.read_through(row, block['transit_timestamp'][-1])
+        # send the last partial batches, wait for the broker to confirm them and close
+        publisher.close()
+        logger.info(f"[x] {publisher.confirmed} messages confirmed by the broker")
+        checkpoint.finish()
+
+    # A Keyboard Interrupt was added as the Process to pull all of the data from the stream is long. 
+    # Escape also adds note to the log.            
+    except KeyboardInterrupt:
+            print()
+            print(" User interrupted streaming process.")
+            logger.info("KeyboardInterrupt. Stopping the Program")
+            # sends anything still buffered before closing the connection, the next run resumes after it
+            publisher.close()
+            checkpoint.save()
+            sys.exit(0)
+    except FileNotFoundError:
+             logger.error("CSV file not found")
+             sys.exit(1)
+    except ValueError as e:
+             logger.error(f"An unecpected error has occured: {e}")
+             sys.exit(1)  
+    except pika.exceptions.AMQPConnectionError as e:
+            print(f"Error: Connection to RabbitMQ server failed: {e}")
+            logger.error(f"Error: Connection to RabbitMQ server failed: {e}")
+            publisher.disconnect()
+            # only confirmed rows are in the checkpoint, the rest is sent again on the next run
+            checkpoint.save()
+            sys.exit(1)
+ 
 
-def main(host: str, input_file:str):
+async def send_queue(channel, queue_name: str, messages: asyncio.Queue, stamper: SendStamper):
+    """Publish everything put on messages to queue_name, until None arrives."""
+    # a durable queue will survive a RabbitMQ server restart
+    await channel.queue_declare(queue_name, durable=True)
+    sent = 0
+    while True:
+        body = await messages.get()
+        if body is None:
+            break
+        # waits here while max_in_flight messages are unconfirmed, stamped first so that counts as queue wait
+        await channel.publish(queue_name, body, stamper.stamp(queue_name))
+        sent += 1
+    logger.info(f"[x] sent {sent} messages to {queue_name}")
+
+
+async def main_async(host: str, input_file: str, queue_size: int = queue_size, max_in_flight: int = max_in_flight,
+                     speed: float = replay_speed, stop: asyncio.Event = None, start: float = None,
+                     end: float = None):
     """
-    Open a CSV and iterate through each row of the CSV to trun it to a list of dictionars (JSON format)
-    Seperate processes by column and send message by calling the send message function.
+    The asyncio version of main: the same reading, partitioning and wire format in one event loop.
+
+    The reader puts each Line's messages on a bounded asyncio.Queue and awaits when it is full,
+    one sender per Line publishes from its queue, and publishing awaits when max_in_flight messages
+    are unconfirmed, so a slow broker slows the reader down instead of filling memory.
+    Ctrl+C or SIGTERM (or setting stop) stops reading, the queued messages are still sent and confirmed.
 
     Parameters:
     host (str): Name of host or IP address fo the RabbitMQ server
-    input_file_name (str): The location of the input file.
-
-    Comments above the code are reffering to the code in the next line and its function.
+    input_file (str): The location of the input file.
+    queue_size (int): Messages waiting per Line queue.
+    max_in_flight (int): Most unconfirmed messages on the channel.
+    speed (float): Replay multiplier for transit_timestamp, 1 is real time, None is as fast as possible.
+    stop (asyncio.Event): optional, set to stop reading.
+    start, end (float): optional, send only rows with start <= transit_timestamp < end (Unix seconds).
     """
-try:
-     with open(input_file_name, 'r', newline='') as input_file:
-        reader = csv.reader(input_file)
-        next(reader)
-        # reading rows from csv
-        for row in reader:
-            subway_data = {
-                'transit_timestamp': row[0],
-                'transit_mode':row[1],
-                'station_complex_id':int(row[2]),
-                'station_complex':row[3],
-                'Line':row[4],
-                'borough':row[5],
-                'payment_method': row[6],
-                'fare_class_category': row[7],
-                'ridership':row[8],
-                'transfers':int(row[9]),
-                'latitude':row[10],
-                'longitude':row[11],
-                'Georeference':row[12]
-
-                }
-                # logging the row being ingested
-            logger.info(f'{subway_data["transit_timestamp"]} - Row ingested: {subway_data["station_complex_id"]}, {subway_data["station_complex"]}, {subway_data["Line"]}, {subway_data["ridership"]}')
-                
-            # select queue depending on line
-            queue = 'Line-' + subway_data['Line'] + '_queue'
-
-            # pack message contents with pickle
-            message = pickle.dumps(subway_data)
-            send_message('localhost', queue, message)
-            logger.info(f"[x] send_message('localhost', {queue}, {subway_data['transit_timestamp']}, {subway_data['station_complex_id']}, {subway_data['Line']}, {subway_data['ridership']})")
-        # set sleep for 60 seconds before reading next row to simulate an hour.
-        #time.sleep(30)# Time was set to 30 seconds for Producer Test 1.
-        time.sleep(60)
-
-# A Keyboard Interrupt was added as the Process to pull all of the data from the stream is long. 
-# Escape also adds note to the log.            
-except KeyboardInterrupt:
-        print()
-        print(" User interrupted streaming process.")
-        logger.info("KeyboardInterrupt. Stopping the Program")
-        sys.exit(0)
-except FileNotFoundError:
-         logger.error("CSV file not found")
-         sys.exit(1)
-except ValueError as e:
-         logger.error(f"An unecpected error has occured: {e}")
-         sys.exit(1)  
- 
+    stop = stop or stop_event()
+    connection = await connect(host)
+    channel = await connection.channel()
+    await channel.confirm_delivery(max_in_flight)
+    clock = ReplayClock(speed)
+    partitioner = Partitioner('Line')
+    encoder = WireEncoder()
+    # send time and sequence number per message, see utils/util_metrics.py
+    stamper = SendStamper()
+    # queue name -> bounded asyncio.Queue of message bodies, and the senders publishing from them
+    queues = {}
+    senders = []
+    try:
+        for chunk in read_subway(input_file, start=start, end=end):
+            blocks = [chunk] if clock.speed is None else split_runs(chunk, 'transit_timestamp')
+            for block in blocks:
+                if stop.is_set():
+                    break
+                # wait until this hour is due, the senders keep publishing meanwhile
+                await asyncio.sleep(clock.delay(int(block['transit_timestamp'][0])))
+                for queue, rows in partitioner.partition(block):
+                    if queue not in queues:
+                        queues[queue] = asyncio.Queue(maxsize=queue_size)
+                        senders.append(asyncio.create_task(send_queue(channel, queue, queues[queue], stamper)))
+                    for message in encoder.encode(queue, rows):
+                        if is_state_message(message):
+                            # published on the same channel before the senders get the records that need it
+                            await channel.queue_declare(state_queue_name(queue), durable=True)
+                            await channel.publish(state_queue_name(queue), message,
+                                                  stamper.stamp(state_queue_name(queue)))
+                        # waits here while the queue is full
+                        await queues[queue].put(message)
+            if stop.is_set():
+                logger.info("Stop requested, sending the queued messages")
+                break
+            # let the senders run between chunks even when no queue is full
+            await asyncio.sleep(0)
+
+        # tell every sender to finish, wait for them and for the broker to confirm everything
+        for messages in queues.values():
+            await messages.put(None)
+        await asyncio.gather(*senders)
+        await channel.wait_for_confirms()
+        logger.info(f"[x] {channel.confirmed} messages confirmed by the broker, {channel.nacked} rejected and sent again")
+    finally:
+        for sender in senders:
+            sender.cancel()
+        await connection.close()
+
 
 # Standard Python idiom to indicate main program entry point
 # This allows us to import this module and use its functions
 # without executing the code below.
 # If this is the program being run, then execute the code below
 if __name__ == "__main__":  
+    parser = argparse.ArgumentParser(description="Stream MTA_SubwayW1Feb22.csv to one queue per subway Line.")
+    parser.add_argument("--speed", type=parse_speed, default=replay_speed,
+                        help="replay multiplier: realtime, a number such as 3600, or max (default 60)")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="publish from one asyncio event loop (main_async) instead of the blocking publisher")
+    parser.add_argument("--host", default="localhost",
+                        help="RabbitMQ host, or memory://host:port for the broker in utils/util_transport.py (default localhost)")
+    parser.add_argument("--start", type=parse_timestamp,
+                        help="first transit_timestamp to send, e.g. \"02/03/22 17:00:00\" (default: the start of the file)")
+    parser.add_argument("--end", type=parse_timestamp,
+                        help="transit_timestamp to stop before (default: the end of the file)")
+    parser.add_argument("--restart", action="store_true",
+                        help=f"ignore {checkpoint_file} from a stopped run and start from the top")
+    args = parser.parse_args()
+    if args.asyncio and is_memory(args.host):
+        parser.error("--asyncio needs RabbitMQ, the memory broker only works with the blocking publisher")
+
     # ask the user if they'd like to open the RabbitMQ Admin site
-    offer_rabbitmq_admin_site()
+    if not is_memory(args.host):
+        offer_rabbitmq_admin_site()
 
     # send the message to the queue
     logger.info(f'Begin process: {__name__}')
-    main("localhost", input_file_name)
\ No newline at end of file
+    if args.asyncio:
+        try:
+            asyncio.run(main_async(args.host, input_file_name, speed=args.speed, start=args.start, end=args.end))
+        except KeyboardInterrupt:
+            logger.info("KeyboardInterrupt. Stopping the Program")
+        except pika.exceptions.AMQPConnectionError as e:
+            print(f"Error: Connection to RabbitMQ server failed: {e}")
+            logger.error(f"Error: Connection to RabbitMQ server failed: {e}")
+            sys.exit(1)
+    else:
+        main(args.host, input_file_name, speed=args.speed, start=args.start, end=args.end, restart=args.restart)
\ No newline at end of file
@@ -7,7 +7,13 @@ Date 12 June 2024
 This producer was designed to read through "Data_MTAAlerts.csv" a file was was modified from a generated output from ConsumerV2. 
 The Producer will offer RabbitMQ, create a connection to RabbitMQ servers, read in the data from the CSV and then set up a message.
 The Timestamps have to be altered because in this case we are using struct encoding. 
+Each message is a frame of several '=QI' readings for one station behind a count header, see utils/util_wire.py.
 Structs were selected because it isn't as sensetive to version issues as pickle, and offered an opportunity to improve on this skill.
+With --start/--end only that time range is sent, the reader seeks straight to it (see utils/util_index.py).
+Frames are sent in batches the broker confirms, and a checkpoint of the confirmed rows is written every 100 confirmed
+frames or every second: a run that was stopped resumes there without sending a confirmed frame twice, after a crash
+at most the frames confirmed since the last checkpoint are sent again, --restart starts from the top
+(see utils/util_checkpoint.py).
 
 ONLY TWO stations are used due to time constraints.
 
@@ -20,21 +26,36 @@ Date: January 15, 2023
 import pika
 import sys
 import webbrowser
-import csv
-import struct
-from utils.util_logger import setup_logger
-from datetime import datetime
-import time
+from utils.util_alerts import station_from_queue
+from utils.util_checkpoint import ReplayCheckpoint
+from utils.util_logger import RowLogger, setup_logger
+from utils.util_publisher import BatchPublisher
+from utils.util_reader import read_alerts
+from utils.util_replay import ReplayClock, parse_speed, parse_timestamp
+from utils.util_transport import is_memory
+from utils.util_wire import encode_frame, negotiate_frame_size
+import argparse
 
 # Configuring the Logger:
-logger, logname = setup_logger(__file__)
+# per-row lines go to logs/<name>.jsonl, query them with python -m utils.util_events
+logger, logname = setup_logger(__file__, queued=True, events=True)
 
 
 # Declaring variables:
 host = 'localhost'
 input_file_name = 'Data_MTAAlerts.csv'
-Station447_queue = "Station-447"
-Station463_queue = "Station-463"
+# readings per frame, ConsumeV3 may ask for fewer
+frame_size = 8
+# 360x replays an hour of data every 10 seconds, as the old time.sleep(10) did
+replay_speed = 360
+# Batched publishing: frames per queue per batch, longest wait in ms
+batch_size = 100
+linger_ms = 50
+# replay position, saved as the broker confirms frames (see utils/util_checkpoint.py)
+checkpoint_file = 'MTA_ProducerV3.checkpoint.json'
+# one log line per frame: written by the logger's background thread, and only every row_log_every-th frame
+row_log_every = 1
+row_log = RowLogger(logger, sample_every=row_log_every)
 
 
 # Define Program functions
@@ -49,112 +70,119 @@ def offer_rabbitmq_admin_site():
         print()
 
 
-
-def send_message(host: str, queue_name: str, message: str):
-    """
-    publish the message the the desired queue.
-
-    Parameters:
-        host (str): the host name or IP address of the RabbitMQ server
-         (str): the name of the first queue
-        foodA_queue (str): the name of the second queue
-        foodB_queue (str): the name of the thrid queue
-        message (str): the message to be sent to the queue
-    """
-    try:
-        """Connect to RabbitMQ Server, return the connection and channel.
-            Creating multiple queues to handle the required data.
-            Queues are durable to ensure messages are delivered in order and queue will restart if disconnected."""
-        # Creating a connection to the RabbitMQ Server:
-        conn = pika.BlockingConnection(pika.ConnectionParameters(host))
-        # Use the connection to create a communication channel
-        ch = conn.channel()
-        
-        # Delete existing queues and declares them anew to clear previous queue information.
-        # use the channel to declare a durable queue for each of the queues.
-        #ch.queue_delete(Station463_queue)
-        #ch.queue_delete(Station447_queue)
-        
-
-        # use the channel to declare a durable queue
-        # a durable queue will survive a RabbitMQ server restart
-        # and help ensure messages are processed in order
-        # messages will not be deleted until the consumer acknowledges
-        ch.queue_declare(Station447_queue, durable=True)
-        ch.queue_declare(Station463_queue, durable=True)
-        
-        # publish to a queue:
-        ch.basic_publish(exchange= "", routing_key=queue_name, body =message)
-        # Exception handling should something go wrong.
-    except KeyboardInterrupt:
-         logger.info("KeyboardInterrupt. Stopping the program.")
-    except pika.exceptions.AMQPConnectionError as e:
-        print(f"Error: Connection to RabbitMQ server failed: {e}")
-        logger.error(f"Error: Connection to RabbitMQ server failed: {e}")
-        sys.exit(1)
-    finally:
-        # close the connection to the server
-        conn.close()   
-
-
-def main(host: str, input_file: str):
+def main(host: str, input_file: str, speed: float = replay_speed, frame_size: int = frame_size,
+         start: float = None, end: float = None, restart: bool = False):
         """
         Open a CSV and iterate through each row of the CSV.
-        Seperate three processes by column and send the individual messages to the corresponding queue, 
-        by calling send_message function.
+        Seperate three processes by column and send the individual messages to the corresponding queue,
+        through a batch publisher whose batches the broker confirms.
+        Readings are sent in frames: one message per station holding up to frame_size hourly readings.
 
         Parameters:
         host (str): The host name or IP address of the RabbitMQ server
         input_file_name (str): the location of the input file.
+        speed (float): Replay multiplier for transit_timestamp, 1 is real time, None is as fast as possible.
+        frame_size (int): Readings per frame this producer would like to send, lowered to what ConsumeV3 advertises.
+        start, end (float): Optional, send only rows with start <= transit_timestamp < end (Unix seconds).
+        restart (bool): Ignore the checkpoint of an earlier run and start from the top.
 
         Comments above the code are reffering to the code in the next line and its function.
         """
-try:
-        with open(input_file_name, 'r', newline='', encoding='utf-8') as input_file:
-            reader = csv.reader(input_file)
-            next(reader)
-            # reading rows from csv
-            for row in reader:
-                transit_timestamp_str = row[0]
-                Station447 = row[1]
-                Station463 = row[2]
-
-                # Converting timestamp to "%m/%d/%y %H:%M"
-                transit_timestamp = datetime.strptime(transit_timestamp_str, "%m/%d/%y %H:%M:%S")
-
-
-                # Using an f string to send data with timestamp to send data to Station447_queue
-                #message = (f"{Station447_queue} Reading = {transit_timestamp}; Ridership = {Station447}").encode()
-                message = struct.pack('=QI', int(transit_timestamp.timestamp()), int(Station447))
-                send_message(host, "Station-447", message)
-                logger.info(f'[x] Sent: {message} to {Station447_queue}')
-
-                # Using an f string to send data to Station463_queue
-                #message = (f"{Station463_queue} Reading = {transit_timestamp}; Ridership = {Station463}").encode()
-                message = struct.pack('=QI', int(transit_timestamp.timestamp()), int(Station463))
-                send_message(host, "Station-463", message)
-                logger.info(f'[x] Sent: {message} to {Station463_queue}')
-
-                # Set sleep for 60 seconds before reading the next row:
-                #time.sleep(60)
-                time.sleep(10) # Altered to Test Connection
-except KeyboardInterrupt:
-        print()
-        print(" User interrupted streaming process.")
-        logger.info("KeyboardInterrupt. Stopping the Program")
-        sys.exit(0)                
-except FileNotFoundError:
-         logger.error("CSV file not found")
-         sys.exit(1)
-except ValueError as e:
-         logger.error(f"An unecpected error has occured: {e}")
-         sys.exit(1)  
+        # follows which rows the broker has confirmed and resumes an earlier run, see utils/util_checkpoint.py
+        try:
+                checkpoint = ReplayCheckpoint(checkpoint_file, input_file, start, end, logger)
+        except FileNotFoundError:
+                logger.error("CSV file not found")
+                sys.exit(1)
+        if restart:
+                checkpoint.clear()
+        else:
+                checkpoint.load()
+        publisher = BatchPublisher(host, batch_size=batch_size, linger_ms=linger_ms,
+                                   on_confirm=checkpoint.on_confirm, logger=logger)
+        # paces each frame by its transit_timestamps instead of a fixed sleep
+        clock = ReplayClock(speed)
+        try:
+                # agree on the frame size with ConsumeV3 before sending anything, on the publisher's own channel
+                frame_size = negotiate_frame_size(publisher.connect(), frame_size)
+                logger.info(f"Sending frames of up to {frame_size} readings per station")
+
+                # the shared reader streams the CSV in typed chunks, timestamps arrive as Unix seconds
+                reader = read_alerts(input_file, start=checkpoint.read_start(), end=end)
+                for chunk in reader:
+                    # every column after the timestamp is a station, named like its queue (Station-447, Station-463)
+                    station_queues = reader.header[1:]
+                    timestamps = chunk['transit_timestamp']
+                    # reading rows from csv, frame_size rows at a time
+                    for first in range(0, len(chunk), frame_size):
+                        last = min(first + frame_size, len(chunk))
+                        if clock.speed is not None:
+                            # wait until the last reading in the frame is due, the publisher sends
+                            # the frames so far once they have lingered
+                            clock.wait_until(int(timestamps[last - 1]), publisher.sleep)
+
+                        for station_queue in station_queues:
+                            # readings the broker confirmed before a restart are not sent again
+                            frame_start = max(first, checkpoint.first_new_row(station_queue) - reader.chunk_row)
+                            if frame_start >= last:
+                                continue
+                            # pack the station's (timestamp, ridership) pairs behind a count header
+                            message = encode_frame(timestamps[frame_start:last], chunk[station_queue][frame_start:last])
+                            checkpoint.sent(station_queue, [reader.chunk_row + frame_start], timestamps[frame_start])
+                            publisher.publish(station_queue, message)
+                            if row_log.wanted():
+                                row_log.log('[x] Sent: %s readings to %s', last - frame_start, station_queue,
+                                            event={"station_complex_id": station_from_queue(station_queue),
+                                                   "transit_timestamp": int(timestamps[last - 1]),
+                                                   "readings": last - frame_start})
+                        checkpoint.read_through(reader.chunk_row + last, timestamps[last - 1])
+                # send the last frames, wait for the broker to confirm them and close
+                publisher.close()
+                logger.info(f"[x] {publisher.confirmed} frames confirmed by the broker")
+                checkpoint.finish()
+        except KeyboardInterrupt:
+                print()
+                print(" User interrupted streaming process.")
+                logger.info("KeyboardInterrupt. Stopping the Program")
+                # sends the frames still buffered, the next run resumes after them
+                publisher.close()
+                checkpoint.save()
+                sys.exit(0)                
+        except FileNotFoundError:
+                 logger.error("CSV file not found")
+                 sys.exit(1)
+        except ValueError as e:
+                 logger.error(f"An unecpected error has occured: {e}")
+                 sys.exit(1)  
+        except pika.exceptions.AMQPConnectionError as e:
+                print(f"Error: Connection to RabbitMQ server failed: {e}")
+                logger.error(f"Error: Connection to RabbitMQ server failed: {e}")
+                publisher.disconnect()
+                # only confirmed rows are in the checkpoint, the rest is sent again on the next run
+                checkpoint.save()
+                sys.exit(1)
  
 # Standard Python idiom to indicate main program entry point
 # This allows us to import this module and use its functions
 # without executing the code below.
 # If this is the program being run, then execute the code below
 if __name__ == "__main__":  
+    parser = argparse.ArgumentParser(description="Stream Data_MTAAlerts.csv to the Station queues.")
+    parser.add_argument("--speed", type=parse_speed, default=replay_speed,
+                        help="replay multiplier: realtime, a number such as 3600, or max (default 360)")
+    parser.add_argument("--frame-size", type=int, default=frame_size,
+                        help="readings per station per message (default 8)")
+    parser.add_argument("--host", default="localhost",
+                        help="RabbitMQ host, or memory://host:port for the broker in utils/util_transport.py (default localhost)")
+    parser.add_argument("--start", type=parse_timestamp,
+                        help="first transit_timestamp to send, e.g. \"02/03/22 17:00:00\" (default: the start of the file)")
+    parser.add_argument("--end", type=parse_timestamp,
+                        help="transit_timestamp to stop before (default: the end of the file)")
+    parser.add_argument("--restart", action="store_true",
+                        help=f"ignore {checkpoint_file} from a stopped run and start from the top")
+    args = parser.parse_args()
+
     # ask the user if they'd like to open the RabbitMQ Admin site
-    offer_rabbitmq_admin_site()
-    main('localhost', input_file_name)
\ No newline at end of file
+    if not is_memory(args.host):
+        offer_rabbitmq_admin_site()
+    main(args.host, input_file_name, args.speed, args.frame_size, args.start, args.end, args.restart)
@@ -0,0 +1,352 @@
+"""
+Created by: A. C. Coffin
+Date: 12 June 2024
+
+*** Use with "MTA_ProducerV2.py" and "MTA_ConsumeV3.py" ***
+
+Data_MTAAlerts.csv, the file MTA_ProducerV3.py streams, was made by summing the ridership of every station
+per hour by hand. This consumer does the same as the records stream in, so ConsumeV3 gets its readings
+straight from ProducerV2's line queues:
+
+1. Consumes every Line-<X>_queue filled by "MTA_ProducerV2.py" over one channel.
+   It takes the place of the line consumers, a message on a line queue goes to one consumer only.
+2. Adds each message's records to an hourly rollup: ridership and transfers summed per (station, hour)
+   in a hash table holding only the open hours (see utils/util_rollup.py).
+3. An hour is closed once every line queue has sent records past its end, a line queue that has sent
+   nothing for idle_seconds is not waited for. Each closed hour is sent to
+   the Station-<id> queues of MTA_AlertConfig.json as V3 frames of '=QI' readings, the format ProducerV3 sends,
+   in frames no bigger than the size ConsumeV3 advertises. With --output the hours are also written in the
+   layout of Data_MTAAlerts.csv.
+4. The Station queues are published to in confirm mode, and a message is acknowledged only once every
+   hour it added to has been sent and confirmed by the broker, so a crash or a lost connection loses
+   no hour. The end of the newest sent hour is saved in MTA_RollupV3.checkpoint.json before the acks:
+   after a restart, records of a redelivered message for hours already sent are dropped instead of
+   being sent again as a partial hour. --restart forgets it, for a new replay.
+   If no message arrives on any queue for idle_seconds (the producer is done, or every unacknowledged
+   message is waiting on an open hour) the open hours are closed and sent.
+5. Records how long messages waited in each line queue and took to handle, logged every metrics_interval
+   seconds and served at http://127.0.0.1:<metrics_port>/metrics (see utils/util_metrics.py).
+
+Start ConsumeV3 first (it creates the Station queues), then this consumer, then ProducerV2.
+
+    Base Code Author: Denise Case
+    Date: January 15, 2023
+
+"""
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from functools import partial
+from utils.util_alerts import load_alert_config, station_queue_name
+from utils.util_batch import BatchConsumer
+from utils.util_checkpoint import write_durable
+from utils.util_logger import RowLogger, setup_logger
+from utils.util_metrics import QueueMetrics, SendStamper, log_summary, start_metrics
+from utils.util_partition import line_queue_name
+from utils.util_reader import read_subway
+from utils.util_replay import format_timestamp
+from utils.util_rollup import HOUR, HourlyRollup
+from utils.util_transport import open_connection
+from utils.util_wire import WireDecoder, encode_frame, fetch_state, negotiate_frame_size
+
+# Configuring the Logger:
+# per-row lines go to logs/<name>.jsonl, query them with python -m utils.util_events
+logger, logname = setup_logger(__file__, queued=True, events=True)
+
+# Variables
+input_file = 'MTA_SubwayW1Feb22.csv'
+# the stations to send hourly readings for, the same ones ConsumeV3 checks
+alert_config = load_alert_config('MTA_AlertConfig.json')
+station_ids = [int(station_id) for station_id in alert_config["stations"]]
+# largest number of hourly readings per frame, lowered to what ConsumeV3 advertises
+frame_size = 8
+# messages handled together, how long (ms) a smaller batch may wait, and how many unacknowledged
+# messages the broker may send us, they stay unacknowledged until their hours are sent
+batch_size = 50
+batch_wait_ms = 50
+prefetch_count = 500
+# seconds a record may be behind the newest of its line queue, and the most hours held open at once
+allowed_lateness = 0
+max_open_hours = 48
+# stop waiting for a line queue that has sent nothing for this many seconds,
+# and close every open hour when no queue has
+idle_seconds = 5.0
+# one log line per station per closed hour: written by the logger's background thread, only every row_log_every-th
+row_log_every = 1
+row_log = RowLogger(logger, sample_every=row_log_every)
+# queue wait and processing time of every line, a summary is logged every metrics_interval seconds
+# and scraped from metrics_port (None turns the endpoint off)
+metrics = QueueMetrics()
+metrics_interval = 30
+metrics_port = 9307
+# the end of the newest hour sent to the Station queues, so a restart does not send an hour twice
+checkpoint_file = 'MTA_RollupV3.checkpoint.json'
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+
+class RollupStage:
+    """
+    Consumes the line queues into an HourlyRollup and sends the closed hours to the Station queues.
+
+    Parameters:
+        connection: the connection, see utils/util_transport.py
+        queue_names (list): the line queues, every one has to pass an hour before it is closed
+        output_file (str): optional CSV written in the layout of Data_MTAAlerts.csv
+        restart (bool): ignore the hours an earlier run sent, for a new replay
+    """
+
+    def __init__(self, connection, queue_names: list, output_file: str = None, restart: bool = False):
+        self.connection = connection
+        self.queue_names = queue_names
+        self.rollup = HourlyRollup(queue_names, allowed_lateness, max_open_hours)
+        self.channel = connection.channel()
+        self.publish_channel = connection.channel()
+        # every basic_publish returns once the broker has the hour, the messages it came from are acked after
+        self.publish_channel.confirm_delivery()
+        # the producer ships a state (string dictionary and station table) to each queue, a missed one
+        # is read from the queue's state queue on the publish channel, see utils/util_wire.py
+        self.decoders = {queue_name: WireDecoder(partial(fetch_state, self.publish_channel, queue_name))
+                         for queue_name in queue_names}
+        self.stamper = SendStamper()
+        self.frame_size = frame_size
+        self.batcher = BatchConsumer(connection, self.channel, self.batch_callback, batch_size, batch_wait_ms,
+                                     prefetch_count, metrics=metrics)
+        # delivery tag -> the last hour its records went into, None for a message without records
+        self.pending = OrderedDict()
+        self.last_delivery = time.monotonic()
+        # line queue -> time.monotonic() of its last message, a queue that has sent nothing yet
+        # is waited for from the first message on any queue
+        self.first_delivery = None
+        self.last_seen = {queue_name: None for queue_name in queue_names}
+        self.hours_sent = 0
+        if restart and os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+        self.load()
+        self.output = None
+        self.writer = None
+        if output_file:
+            # the BOM and header of Data_MTAAlerts.csv, so ProducerV3 can read the file as it is
+            self.output = open(output_file, 'w', newline='', encoding='utf-8-sig')
+            self.writer = csv.writer(self.output, lineterminator='\n')
+            self.writer.writerow(['transit_timestamp'] + [station_queue_name(station_id) for station_id in station_ids])
+
+    def load(self):
+        """Start after the hours an earlier run has sent, its redelivered records for them are dropped as late."""
+        if not os.path.exists(checkpoint_file):
+            return
+        with open(checkpoint_file) as file:
+            self.rollup.closed_through = json.load(file)['closed_through']
+        logger.info(f"Resuming after the hours an earlier run sent, records before "
+                    f"{format_timestamp(self.rollup.closed_through)} are dropped (--restart starts over)")
+
+    def save(self):
+        """Write the end of the newest hour sent, before the messages of that hour are acknowledged."""
+        write_durable(checkpoint_file, {'closed_through': self.rollup.closed_through,
+                                        'saved': datetime.datetime.now().isoformat(timespec='seconds')})
+
+    def start(self):
+        """Declare the queues, agree on the frame size with ConsumeV3 and start consuming."""
+        # the Station queues belong to ConsumeV3, they are only declared in case it has not started yet
+        for station_id in station_ids:
+            self.publish_channel.queue_declare(station_queue_name(station_id), durable=True)
+        self.frame_size = negotiate_frame_size(self.publish_channel, frame_size)
+        logger.info(f"Sending frames of up to {self.frame_size} hourly readings per station")
+        # a durable queue will survive a RabbitMQ server restart
+        # messages will not be deleted until the consumer acknowledges
+        # they are not deleted first, records the producer has already sent are rolled up too
+        for queue_name in self.queue_names:
+            self.channel.queue_declare(queue=queue_name, durable=True)
+        self.batcher.start(self.queue_names)
+        self.connection.call_later(idle_seconds, self.on_idle)
+
+    def batch_callback(self, deliveries: list) -> list:
+        """
+        Add a batch of messages to the rollup and send the hours it closes.
+        Returns the delivery tags whose hours are all sent, the batch consumer acknowledges them.
+        """
+        self.last_delivery = time.monotonic()
+        self.first_delivery = self.first_delivery or self.last_delivery
+        for ch, method, properties, body in deliveries:
+            self.last_seen[method.routing_key] = self.last_delivery
+            records = self.decoders[method.routing_key].decode(body)
+            if records is None or not len(records):
+                self.pending[method.delivery_tag] = None
+                continue
+            self.rollup.add(method.routing_key, records['transit_timestamp'], records['station_complex_id'],
+                            records['ridership'], records['transfers'])
+            newest = int(records['transit_timestamp'].max())
+            self.pending[method.delivery_tag] = newest - newest % HOUR
+        self.send(self.rollup.close_ready())
+        return self.done()
+
+    def done(self) -> list:
+        """Take the delivery tags, oldest first, whose hours are all closed."""
+        delivery_tags = []
+        closed_through = self.rollup.closed_through
+        while self.pending:
+            delivery_tag, hour = next(iter(self.pending.items()))
+            if hour is not None and (closed_through is None or hour >= closed_through):
+                break
+            delivery_tags.append(self.pending.popitem(last=False)[0])
+        return delivery_tags
+
+    def send(self, closed: list):
+        """Send closed hours to the Station queues, frame_size hours per frame, and write them to the CSV."""
+        if not closed:
+            return
+        hours = [hour for hour, stations in closed]
+        for station_id in station_ids:
+            queue_name = station_queue_name(station_id)
+            # a station without records in an hour had no riders
+            ridership = [stations.get(station_id, (0, 0))[0] for hour, stations in closed]
+            for start in range(0, len(hours), self.frame_size):
+                message = encode_frame(hours[start:start + self.frame_size], ridership[start:start + self.frame_size])
+                self.publish_channel.basic_publish(exchange="", routing_key=queue_name, body=message,
+                                                   properties=self.stamper.stamp(queue_name))
+        for hour, stations in closed:
+            for station_id in station_ids:
+                if row_log.wanted():
+                    riders, transfers = stations.get(station_id, (0, 0))
+                    row_log.log("[Station %s]: %s: %s Passengers, %s transfers", station_id,
+                                format_timestamp(hour), riders, transfers,
+                                event={"station_complex_id": station_id, "transit_timestamp": hour,
+                                       "ridership": riders, "transfers": transfers})
+            if self.writer:
+                # left empty like Data_MTAAlerts.csv when the station had no records, read back as 0
+                self.writer.writerow([format_timestamp(hour)] + [stations[station_id][0] if station_id in stations else ''
+                                                                 for station_id in station_ids])
+        if self.output:
+            self.output.flush()
+        self.save()
+        self.hours_sent += len(closed)
+        logger.info(f" [x] Sent {len(closed)} hours to {len(station_ids)} stations, up to {format_timestamp(hours[-1])}, "
+                    f"{len(self.rollup.table)} hours open")
+
+    def on_idle(self):
+        """
+        Stop waiting for line queues that have sent nothing for idle_seconds and send the hours that closes.
+        Once no queue has sent anything for that long every open hour is closed. Checks again later.
+        """
+        now = time.monotonic()
+        if not self.batcher.deliveries:
+            for queue_name, last_seen in self.last_seen.items():
+                last_seen = last_seen or self.first_delivery
+                if last_seen is not None and now - last_seen >= idle_seconds:
+                    self.rollup.quiet(queue_name)
+            if self.rollup.table and now - self.last_delivery >= idle_seconds:
+                logger.info(f"No messages for {idle_seconds} seconds, closing {len(self.rollup.table)} open hours")
+                self.send(self.rollup.close_all())
+            else:
+                self.send(self.rollup.close_ready())
+            self.batcher.ack(self.done())
+        self.connection.call_later(idle_seconds / 2, self.on_idle)
+
+    def close(self):
+        """Handle the messages still waiting, send every open hour and acknowledge everything."""
+        self.batcher.process()
+        self.send(self.rollup.close_all())
+        self.batcher.ack(self.done())
+        logger.info(f"Rolled up {self.rollup.records} records into {self.hours_sent} hours, "
+                    f"dropped {self.rollup.late} late records, closed {self.rollup.forced} hours before every queue passed them")
+        if self.output:
+            self.output.close()
+            self.output = None
+
+
+def line_queues(input_file: str = input_file) -> list:
+    """One Line-<X>_queue for every Line in the data file the producer streams."""
+    lines = set()
+    for chunk in read_subway(input_file):
+        lines.update(chunk.dictionaries['Line'].values)
+    return [line_queue_name(line) for line in sorted(lines)]
+
+
+# define a main function to run the program
+def main(hn: str = "localhost", queue_names: list = None, output_file: str = None, restart: bool = False):
+    """ Continuously roll up the line queues into hourly station readings for ConsumeV3."""
+    queue_names = queue_names or line_queues()
+    stage = None
+
+    # when a statement can go wrong, use a try-except block
+    try:
+        # try this code, if it works, keep going
+        # create a blocking connection to the RabbitMQ server
+        connection = open_connection(hn)
+
+    # except, if there's an error, do this
+    except Exception as e:
+        print()
+        print("ERROR: connection to RabbitMQ server failed.")
+        print(f"Verify the server is running on host={hn}.")
+        print(f"The error says: {e}")
+        print()
+        logger.error(f"ERROR: connection to RabbitMQ server failed. The error is {e}.")
+        sys.exit(1)
+
+    try:
+        stage = RollupStage(connection, queue_names, output_file, restart)
+        stage.start()
+
+        # log how long messages wait and take now and then, and serve the numbers for scraping
+        connection.call_later(metrics_interval, partial(log_summary, connection, metrics, logger, metrics_interval))
+        start_metrics(metrics, metrics_port, logger)
+
+        # print a message to the console for the user
+        print(f" [*] Rolling up {', '.join(queue_names)}. To exit press CTRL+C")
+        logger.info(f" [*] Rolling up {', '.join(queue_names)}. To exit press CTRL+C")
+
+        # start consuming messages, the connection dispatches the messages and the timers
+        while True:
+            connection.process_data_events(time_limit=None)
+
+    # except, in the event of an error OR user stops the process, do this
+    except Exception as e:
+        print()
+        print("ERROR: something went wrong.")
+        print(f"The error says: {e}")
+        logger.error(f"Error: Something whent wrong. Error: {e}")
+        sys.exit(1)
+    except KeyboardInterrupt:
+        print()
+        print(" User interrupted continuous listening process.")
+        logger.info("KeyboardInterrupt. Stopping the Program")
+        # send the hours still open and acknowledge their messages before leaving
+        if stage:
+            stage.close()
+        for line in metrics.summary_lines():
+            logger.info(f"[metrics] {line}")
+        sys.exit(0)
+    finally:
+        if stage and stage.output:
+            stage.output.close()
+        print("\nClosing connection. Goodbye.\n")
+        logger.info("\nclosing connection. Goodby\n")
+        connection.close()
+
+
+# Standard Python idiom to indicate main program entry point
+# This allows us to import this module and use its functions
+# without executing the code below.
+# If this is the program being run, then execute the code below
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Roll the line queues from MTA_ProducerV2.py up into hourly "
+                                                 "station readings for MTA_ConsumeV3.py.")
+    parser.add_argument("queues", nargs="*",
+                        help="line queues to consume, e.g. Line-Q_queue Line-5_queue (default: every Line in the data)")
+    parser.add_argument("--output", help="also write the hours to this CSV, in the layout of Data_MTAAlerts.csv")
+    parser.add_argument("--host", default="localhost",
+                        help="RabbitMQ host, or memory://host:port for the broker in utils/util_transport.py (default localhost)")
+    parser.add_argument("--restart", action="store_true",
+                        help=f"forget the hours an earlier run sent ({checkpoint_file}), for a new replay")
+    args = parser.parse_args()
+
+    # call the main function with the information needed
+    main(args.host, args.queues, args.output, args.restart)
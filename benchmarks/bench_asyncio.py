@@ -0,0 +1,155 @@
+"""
+Benchmark: blocking versus asyncio producer and consumer, messages/sec against a local broker.
+
+Producer: MTA_ProducerV2.main (BatchPublisher) versus MTA_ProducerV2.main_async, both replaying
+the whole dataset as fast as possible (speed max) and waiting for the broker's confirms.
+Consumer: copies of ProducerV3's frames are published to the station queues while the blocking
+batch consumer that MTA_ConsumeV3.main uses, or MTA_ConsumeV3.main_async, handles them. The time
+runs from the first publish until the last frame has been handled.
+
+Requires RabbitMQ running on the host. The line and station queues are purged. Run from the repo root:
+
+    python -m benchmarks.bench_asyncio --copies 50
+
+"""
+
+import argparse
+import asyncio
+import threading
+import time
+
+import pika
+
+import MTA_ConsumeV3
+import MTA_ProducerV2
+from utils.util_alerts import AlertEngine
+from utils.util_batch import BatchConsumer
+from utils.util_reader import read_alerts
+from utils.util_wire import encode_frame
+
+# ConsumeV3's own batch handler, wrapped to count what has been handled
+batch_callback = MTA_ConsumeV3.batch_callback
+
+
+def purge(host: str, queue_names: list):
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+    channel = connection.channel()
+    for queue_name in queue_names:
+        channel.queue_declare(queue=queue_name, durable=True)
+        channel.queue_purge(queue=queue_name)
+    connection.close()
+
+
+def bench_producer(host: str, input_file: str):
+    """Seconds for the blocking and the asyncio producer to send and confirm the dataset."""
+    line_queues = ['Line-5_queue', 'Line-7_queue', 'Line-Q_queue', 'Line-Sterling St (2,5)_queue']
+    purge(host, line_queues)
+    start = time.perf_counter()
+    MTA_ProducerV2.main(host, input_file, speed=None)
+    blocking = time.perf_counter() - start
+
+    purge(host, line_queues)
+    start = time.perf_counter()
+    asyncio.run(MTA_ProducerV2.main_async(host, input_file, speed=None, stop=asyncio.Event()))
+    asynchronous = time.perf_counter() - start
+    purge(host, line_queues)
+    return blocking, asynchronous
+
+
+def fill_stations(host: str, frames: list, copies: int, purge: bool = True):
+    """Publish copies of the frames to their station queues."""
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+    channel = connection.channel()
+    for queue_name in sorted({queue_name for queue_name, _ in frames}):
+        channel.queue_declare(queue=queue_name, durable=True)
+        if purge:
+            channel.queue_purge(queue=queue_name)
+    for _ in range(copies):
+        for queue_name, body in frames:
+            channel.basic_publish(exchange="", routing_key=queue_name, body=body)
+    connection.close()
+
+
+def counted(total: int, done):
+    """Wrap ConsumeV3's batch_callback to call done() once total messages have been handled."""
+    handled = [0]
+
+    def counting_batch_callback(deliveries):
+        handled[0] += len(deliveries)
+        delivery_tags = batch_callback(deliveries)
+        if handled[0] >= total:
+            done()
+        return delivery_tags
+    return counting_batch_callback
+
+
+def drain_blocking(host: str, frames: list, copies: int) -> float:
+    """Seconds from the start of publishing until the blocking batch consumer has handled every frame."""
+    finished = []
+    fill_stations(host, frames, 0)
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+    channel = connection.channel()
+    batcher = BatchConsumer(connection, channel, counted(len(frames) * copies, lambda: finished.append(True)),
+                            MTA_ConsumeV3.batch_size, MTA_ConsumeV3.batch_wait_ms, MTA_ConsumeV3.prefetch_count)
+    batcher.start(sorted({queue_name for queue_name, _ in frames}))
+    start = time.perf_counter()
+    filler = threading.Thread(target=fill_stations, args=(host, frames, copies, False))
+    filler.start()
+    while not finished:
+        connection.process_data_events(time_limit=0.01)
+    elapsed = time.perf_counter() - start
+    filler.join()
+    connection.close()
+    return elapsed
+
+
+async def drain_async(host: str, frames: list, copies: int) -> float:
+    """Seconds from the start of publishing until MTA_ConsumeV3.main_async has handled every frame."""
+    stop = asyncio.Event()
+    MTA_ConsumeV3.batch_callback = counted(len(frames) * copies, stop.set)
+    try:
+        # main_async deletes and declares the station queues itself, publish once it is consuming
+        consumer = asyncio.create_task(MTA_ConsumeV3.main_async(host, stop=stop))
+        await asyncio.sleep(1.0)
+        start = time.perf_counter()
+        await asyncio.to_thread(fill_stations, host, frames, copies, False)
+        await consumer
+        return time.perf_counter() - start
+    finally:
+        MTA_ConsumeV3.batch_callback = batch_callback
+
+
+def bench_consumer(host: str, input_file: str, copies: int):
+    """Frames sent, and seconds for the blocking and the asyncio consumer to handle them."""
+    frames = []
+    for chunk in read_alerts(input_file):
+        for name in chunk.header[1:]:
+            for start in range(0, len(chunk), MTA_ConsumeV3.frame_size):
+                rows = slice(start, start + MTA_ConsumeV3.frame_size)
+                frames.append((name, encode_frame(chunk['transit_timestamp'][rows], chunk[name][rows])))
+
+    # quiet the per reading log lines so the transport is what gets measured
+    MTA_ConsumeV3.logger.setLevel("WARNING")
+    MTA_ConsumeV3.engine = AlertEngine.from_config(MTA_ConsumeV3.alert_config)
+    blocking = drain_blocking(host, frames, copies)
+    MTA_ConsumeV3.engine = AlertEngine.from_config(MTA_ConsumeV3.alert_config)
+    asynchronous = asyncio.run(drain_async(host, frames, copies))
+    return len(frames) * copies, blocking, asynchronous
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--copies", type=int, default=50, help="copies of ProducerV3's frames for the consumer")
+    args = parser.parse_args()
+
+    blocking, asynchronous = bench_producer(args.host, MTA_ProducerV2.input_file_name)
+    print(f"producer  blocking {blocking:7.2f} s   asyncio {asynchronous:7.2f} s   {blocking / asynchronous:5.2f}x")
+
+    total, blocking, asynchronous = bench_consumer(args.host, 'Data_MTAAlerts.csv', args.copies)
+    print(f"consumer  blocking {total / blocking:8.0f} msg/s   asyncio {total / asynchronous:8.0f} msg/s   "
+          f"{blocking / asynchronous:5.2f}x  ({total} frames)")
+
+
+if __name__ == "__main__":
+    main()
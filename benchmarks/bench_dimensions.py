@@ -0,0 +1,104 @@
+"""
+Benchmark: message size and broker memory, full RECORDS versus the station table plus FACTS.
+
+Every record of MTA_SubwayW1Feb22.csv is split by Line, as MTA_ProducerV2.py sends it, and encoded twice:
+
+1. records: each message carries full 50 byte records, the station's name, Line, borough,
+   transit_mode, latitude, longitude and Georeference repeated in every row
+2. stations: each queue gets its station table in a STATIONS message, again only when a station is
+   new or has changed, the messages carry 24 byte FACTS (transit_timestamp, station_complex_id, ridership, transfers and the two fare codes)
+
+Broker memory is what utils/util_transport.py's in-process MemoryBroker holds once every message
+is queued, measured with tracemalloc. RabbitMQ adds its own per-message overhead on top, the bodies
+shrink the same way. Decoding is measured to full record arrays, so it includes the consumer's join,
+and both must decode to the same rows.
+
+No RabbitMQ needed. Run from the repo root:
+
+    python -m benchmarks.bench_dimensions
+
+"""
+
+import argparse
+import time
+import tracemalloc
+
+from utils.util_partition import Partitioner
+from utils.util_reader import read_subway
+from utils.util_transport import MemoryBroker
+from utils.util_wire import WireDecoder, WireEncoder
+
+
+def line_messages(chunks: list, stations: bool, max_records: int) -> dict:
+    """queue -> the message bodies ProducerV2 would publish to it."""
+    encoder = WireEncoder(max_records, stations=stations)
+    partitioner = Partitioner('Line')
+    messages = {}
+    for chunk in chunks:
+        for queue_name, part in partitioner.partition(chunk):
+            messages.setdefault(queue_name, []).extend(encoder.encode(queue_name, part))
+    return messages
+
+
+def broker_memory(chunks: list, stations: bool, max_records: int) -> int:
+    """Bytes a MemoryBroker holds with every message queued, the messages are encoded straight into it."""
+    broker = MemoryBroker()
+    encoder = WireEncoder(max_records, stations=stations)
+    partitioner = Partitioner('Line')
+    tracemalloc.start()
+    for chunk in chunks:
+        for queue_name, part in partitioner.partition(chunk):
+            broker.queue_declare(queue_name)
+            for body in encoder.encode(queue_name, part):
+                broker.publish(queue_name, body)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size
+
+
+def decode(messages: dict) -> tuple:
+    """Seconds to decode every queue's messages, and the decoded rows sorted."""
+    start = time.perf_counter()
+    arrays = []
+    for bodies in messages.values():
+        decoder = WireDecoder()
+        for body in bodies:
+            records = decoder.decode(body)
+            if records is not None:
+                arrays.append((decoder, records))
+    seconds = time.perf_counter() - start
+    rows = [row for decoder, records in arrays for row in decoder.rows(records)]
+    rows.sort(key=lambda row: (row['transit_timestamp'], row['station_complex_id'], row['payment_method'],
+                               row['fare_class_category']))
+    return seconds, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", default="MTA_SubwayW1Feb22.csv")
+    parser.add_argument("--max-records", type=int, default=1000, help="records per RECORDS or FACTS message")
+    args = parser.parse_args()
+
+    chunks = list(read_subway(args.input))
+    count = sum(len(chunk) for chunk in chunks)
+    results = {}
+    for name, stations in (('records', False), ('stations', True)):
+        messages = line_messages(chunks, stations, args.max_records)
+        bodies = [body for queue_bodies in messages.values() for body in queue_bodies]
+        seconds, rows = decode(messages)
+        results[name] = (len(messages), len(bodies), sum(map(len, bodies)),
+                         broker_memory(chunks, stations, args.max_records), seconds, rows)
+    # the join must give back exactly the records sent in full
+    assert results['records'][5] == results['stations'][5]
+
+    print(f"{count} records to {results['records'][0]} Line queues")
+    print(f"{'':<10} {'messages':>9} {'body KB':>9} {'B/record':>9} {'broker KB':>10} {'decode ms':>10}")
+    for name, (_, messages, size, memory, seconds, _) in results.items():
+        print(f"{name:<10} {messages:9d} {size / 1024:9.0f} {size / count:9.1f} {memory / 1024:10.0f} "
+              f"{seconds * 1000:10.2f}")
+    before, after = results['records'], results['stations']
+    print(f"message bytes -{1 - after[2] / before[2]:.0%}, broker memory -{1 - after[3] / before[3]:.0%}")
+
+
+if __name__ == "__main__":
+    main()
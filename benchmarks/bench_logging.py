@@ -0,0 +1,116 @@
+"""
+Benchmark: the cost of a log line per record on the consumer's thread.
+
+The line consumers used to build a 12 field f-string per record and write it through a
+FileHandler and the console before handling the next record. Compared here, every record of
+MTA_SubwayW1Feb22.csv logged with:
+
+1. sync f-string: setup_logger(__file__) and logger.info(f"..."), as before
+2. queued lazy: setup_logger(__file__, queued=True) and a RowLogger with a %-style format,
+   the text is built and written by the listener thread
+3. queued sampled: the same, logging every --sample-every-th record
+4. level off: the rows are logged at DEBUG while the logger is at INFO, nothing is done
+
+"hot us/row" is the time the loop spends per record, what the consumer waits for. "total us/row"
+also waits until the listener has written everything, on a machine with one CPU the background
+thread competes with the loop, so there the queued total is about the sync one. Console output
+goes to os.devnull and the log files to a scratch directory. No RabbitMQ needed. Run from the repo root:
+
+    python -m benchmarks.bench_logging --sample-every 100
+
+"""
+
+import argparse
+import atexit
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from utils.util_logger import RowLogger, setup_logger
+from utils.util_reader import read_subway
+
+ROW_FORMAT = ('%(transit_timestamp)s,%(transit_mode)s,%(station_complex_id)s,%(station_complex)s,%(Line)s,'
+              '%(borough)s,%(fare_class_category)s,%(ridership)s,%(transfers)s,%(latitude)s,%(longitude)s,'
+              '%(Georeference)s')
+
+
+def make_logger(name: str, queued: bool):
+    """A logger from setup_logger with its console on os.devnull."""
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+    try:
+        logger, _ = setup_logger(name, queued=queued)
+    finally:
+        sys.stderr = stderr
+    logger.propagate = False
+    return logger
+
+
+def drain(logger):
+    """Wait until a queued logger has written everything."""
+    for handler in logger.handlers:
+        listener = getattr(handler, 'listener', None)
+        if listener is not None:
+            listener.stop()
+            # stop() twice fails, setup_logger registered it for exit
+            atexit.unregister(listener.stop)
+
+
+def sync_fstring(rows: list) -> tuple:
+    logger = make_logger('bench_sync', queued=False)
+    start = time.perf_counter()
+    for subway_data in rows:
+        logger.info(f'{subway_data["transit_timestamp"]},'
+                    f'{subway_data["transit_mode"]},'
+                    f'{subway_data["station_complex_id"]},'
+                    f'{subway_data["station_complex"]},'
+                    f'{subway_data["Line"]},'
+                    f'{subway_data["borough"]},'
+                    f'{subway_data["fare_class_category"]},'
+                    f'{subway_data["ridership"]},'
+                    f'{subway_data["transfers"]},'
+                    f'{subway_data["latitude"]},'
+                    f'{subway_data["longitude"]},'
+                    f'{subway_data["Georeference"]}')
+    hot = time.perf_counter() - start
+    return hot, hot
+
+
+def row_logger(rows: list, name: str, sample_every: int = 1, level_off: bool = False) -> tuple:
+    logger = make_logger(name, queued=True)
+    row_log = RowLogger(logger, level=logging.DEBUG if level_off else logging.INFO, sample_every=sample_every)
+    if level_off:
+        logger.setLevel(logging.INFO)
+    start = time.perf_counter()
+    for subway_data in rows:
+        row_log(ROW_FORMAT, subway_data)
+    hot = time.perf_counter() - start
+    drain(logger)
+    return hot, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", default="MTA_SubwayW1Feb22.csv")
+    parser.add_argument("--sample-every", type=int, default=100)
+    args = parser.parse_args()
+
+    rows = [subway_data for chunk in read_subway(args.input) for subway_data in chunk.rows()]
+    os.chdir(tempfile.mkdtemp(prefix='bench_logging_'))
+    print(f"{len(rows)} rows, {os.cpu_count()} CPUs, logs in {os.getcwd()}")
+    runs = [
+        ("sync f-string", lambda: sync_fstring(rows)),
+        ("queued lazy", lambda: row_logger(rows, 'bench_queued')),
+        (f"queued sampled 1/{args.sample_every}", lambda: row_logger(rows, 'bench_sampled', args.sample_every)),
+        ("level off", lambda: row_logger(rows, 'bench_off', level_off=True)),
+    ]
+    print(f"{'':<22} {'hot us/row':>11} {'total us/row':>13}")
+    for label, run in runs:
+        hot, total = run()
+        print(f"{label:<22} {hot / len(rows) * 1e6:11.2f} {total / len(rows) * 1e6:13.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Benchmark: routing rows to Line-<X>_queue, per row loop versus the vectorized Partitioner.
+
+The "before" path is the ProducerV2 loop: build a dict per row and concatenate
+'Line-' + subway_data['Line'] + '_queue' for each one.
+The "after" path groups each chunk by its Line codes with utils/util_partition.Partitioner.
+Both read the full CSV; reading time is measured separately so only routing is compared.
+
+No RabbitMQ needed. Run from the repo root:
+
+    python -m benchmarks.bench_partition
+
+"""
+
+import argparse
+import csv
+import time
+
+from utils.util_partition import Partitioner
+from utils.util_reader import read_subway
+
+
+def route_per_row(rows: list) -> dict:
+    """The original loop: one string concatenation per row."""
+    groups = {}
+    for row in rows:
+        subway_data = {'Line': row[4], 'row': row}
+        queue = 'Line-' + subway_data['Line'] + '_queue'
+        groups.setdefault(queue, []).append(subway_data)
+    return groups
+
+
+def route_vectorized(chunks: list) -> dict:
+    """One grouped pass per chunk."""
+    partitioner = Partitioner('Line')
+    groups = {}
+    for chunk in chunks:
+        for queue, rows in partitioner.partition(chunk):
+            groups.setdefault(queue, []).append(rows)
+    return groups
+
+
+def timed(func, *args, repeat: int = 5):
+    """Best of repeat runs, in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", default="MTA_SubwayW1Feb22.csv")
+    parser.add_argument("--chunk-size", type=int, default=4096)
+    args = parser.parse_args()
+
+    with open(args.input, 'r', newline='', encoding='utf-8-sig') as file:
+        reader = csv.reader(file)
+        next(reader)
+        rows = list(reader)
+    chunks = list(read_subway(args.input, args.chunk_size))
+
+    before, groups_before = timed(route_per_row, rows)
+    after, groups_after = timed(route_vectorized, chunks)
+
+    # both paths must agree on how many rows go to each queue
+    counts_before = {queue: len(group) for queue, group in groups_before.items()}
+    counts_after = {queue: sum(len(rows) for rows in group) for queue, group in groups_after.items()}
+    assert counts_before == counts_after, (counts_before, counts_after)
+
+    print(f"rows: {len(rows)}  queues: {len(counts_after)}  chunks: {len(chunks)}")
+    print(f"per row loop   {before * 1000:8.2f} ms  {len(rows) / before:12.0f} rows/s")
+    print(f"vectorized     {after * 1000:8.2f} ms  {len(rows) / after:12.0f} rows/s")
+    print(f"speedup: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+"""
+Benchmark: the whole pipeline, producer -> broker -> consumer, with latency percentiles.
+
+Each pipeline replays its data file at a fixed replay speed:
+
+    v1  MTA_ProducerV1 (MTA_SubwayW1Feb22.csv) -> 07-Line         -> MTA_ConsumerV1
+    v2  MTA_ProducerV2 (MTA_SubwayW1Feb22.csv) -> Line-<X>_queue  -> MTA_ConsumeLinesV2
+    v3  MTA_ProducerV3 (Data_MTAAlerts.csv)    -> Station-<id>    -> MTA_ConsumeV3
+
+The producer, the consumer and the in-memory broker (utils/util_transport.py) each run in their
+own process, started fresh for every run in a scratch directory, so no RabbitMQ is needed and the
+repo's CSVs and logs are left alone. For every run it reports:
+
+1. messages and rows per second, from the first publish to the last ack
+2. p50/p95/p99 publish-to-ack latency, timed by the broker from accepting a message until the
+   consumer acknowledges it (so it includes queueing, batching and the consumer's own flushes)
+3. CPU seconds and peak RSS of the producer, consumer and broker processes (plus any worker
+   processes they started), from resource.getrusage, so Linux or macOS only
+
+The results are written as JSON. --compare reads an earlier file and exits with 1 when a
+pipeline lost more than --tolerance of its throughput or its p99 latency grew by more. Run from
+the repo root:
+
+    python -m benchmarks.bench_pipeline --pipelines v1,v2,v3 --speeds max,36000 --output pipeline.json
+    python -m benchmarks.bench_pipeline --compare pipeline.json
+
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from utils.util_replay import parse_speed
+from utils.util_transport import get_broker, serve_broker
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# files the programs open relative to their working directory
+DATA_FILES = ['MTA_SubwayW1Feb22.csv', 'Data_MTAAlerts.csv', 'MTA_AlertConfig.json']
+# pipeline -> (producer role, consumer role, data file)
+PIPELINES = {
+    'v1': ('producer-v1', 'consumer-v1', 'MTA_SubwayW1Feb22.csv'),
+    'v2': ('producer-v2', 'consumer-v2', 'MTA_SubwayW1Feb22.csv'),
+    'v3': ('producer-v3', 'consumer-v3', 'Data_MTAAlerts.csv'),
+}
+
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+def run_role(role: str, host: str, speed):
+    """Run one program of a pipeline in this process, imported here so only that program loads."""
+    if role == 'broker':
+        serve_broker(host[len('memory://'):])
+    elif role == 'producer-v1':
+        import MTA_ProducerV1
+        MTA_ProducerV1.main(host, MTA_ProducerV1.input_file_name, speed)
+    elif role == 'producer-v2':
+        import MTA_ProducerV2
+        MTA_ProducerV2.main(host, MTA_ProducerV2.input_file_name, speed=speed)
+    elif role == 'producer-v3':
+        import MTA_ProducerV3
+        MTA_ProducerV3.main(host, MTA_ProducerV3.input_file_name, speed)
+    elif role == 'consumer-v1':
+        import MTA_ConsumerV1
+        MTA_ConsumerV1.main(host)
+    elif role == 'consumer-v2':
+        import MTA_ConsumeLinesV2
+        MTA_ConsumeLinesV2.main(host)
+    elif role == 'consumer-v3':
+        import MTA_ConsumeV3
+        MTA_ConsumeV3.main(host)
+    else:
+        raise ValueError(f"unknown role {role}")
+
+
+def role_main(args):
+    """Entry point of a pipeline process: run the role, then write its CPU time and peak RSS."""
+    try:
+        run_role(args.role, args.host, parse_speed(args.speed))
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        usage = {}
+        for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+            used = resource.getrusage(who)
+            usage['cpu_seconds'] = usage.get('cpu_seconds', 0) + used.ru_utime + used.ru_stime
+            # ru_maxrss is kilobytes on Linux and bytes on macOS
+            scale = 1 if sys.platform == 'darwin' else 1024
+            usage['max_rss_mb'] = max(usage.get('max_rss_mb', 0), used.ru_maxrss * scale / 2 ** 20)
+        with open(args.usage, 'w') as file:
+            json.dump(usage, file)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start(role: str, host: str, workdir: str, speed: str = 'max') -> subprocess.Popen:
+    """Start a pipeline process, its console output goes to <role>.out in workdir."""
+    command = [sys.executable, '-m', 'benchmarks.bench_pipeline', '--role', role, '--host', host,
+               '--speed', speed, '--usage', os.path.join(workdir, f'{role}.json')]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    out = open(os.path.join(workdir, f'{role}.out'), 'w')
+    return subprocess.Popen(command, cwd=workdir, env=env, stdout=out, stderr=subprocess.STDOUT)
+
+
+def stop(process: subprocess.Popen, workdir: str, role: str, timeout: float = 30) -> dict:
+    """Ctrl+C a pipeline process, as a user would, and return its usage."""
+    if process.poll() is None:
+        process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    try:
+        with open(os.path.join(workdir, f'{role}.json')) as file:
+            return json.load(file)
+    except OSError:
+        return {}
+
+
+def wait_for(condition, timeout: float, what: str, interval: float = 0.05):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"timed out waiting for {what}")
+        time.sleep(interval)
+
+
+def broker_ready(host: str) -> bool:
+    try:
+        get_broker(host)
+        return True
+    except Exception:
+        return False
+
+
+def percentiles(latencies: list) -> dict:
+    """p50/p95/p99/max of latencies in milliseconds."""
+    if not latencies:
+        return {}
+    p50, p95, p99, top = np.percentile(np.array(latencies) * 1000, [50, 95, 99, 100])
+    return {'p50': round(p50, 3), 'p95': round(p95, 3), 'p99': round(p99, 3), 'max': round(top, 3)}
+
+
+def count_rows(path: str) -> int:
+    with open(path) as file:
+        return sum(1 for _ in file) - 1
+
+
+def run_pipeline(pipeline: str, speed: str, timeout: float) -> dict:
+    """Run one pipeline at one replay speed and return its results."""
+    producer_role, consumer_role, data_file = PIPELINES[pipeline]
+    workdir = tempfile.mkdtemp(prefix=f'bench_{pipeline}_')
+    try:
+        for name in DATA_FILES:
+            os.symlink(os.path.join(ROOT, name), os.path.join(workdir, name))
+        host = f"memory://127.0.0.1:{free_port()}"
+        broker_process = start('broker', host, workdir)
+        processes = {}
+        try:
+            wait_for(lambda: broker_ready(host) or broker_process.poll() is not None, 10, 'the broker')
+            broker = get_broker(host)
+
+            # the consumer declares its queues, wait until it consumes them and stops adding more
+            consumer = start(consumer_role, host, workdir)
+            processes['consumer'] = (consumer_role, consumer)
+            consuming = []
+
+            def settled():
+                now = broker.stats()['consuming']
+                done = bool(now) and now == consuming
+                consuming[:] = now
+                return done or consumer.poll() is not None
+            wait_for(settled, 30, 'the consumer', interval=0.5)
+            broker.reset_stats()
+            broker.take_latencies()
+
+            started = time.monotonic()
+            producer = start(producer_role, host, workdir, speed)
+            processes['producer'] = (producer_role, producer)
+
+            def drained():
+                stats = broker.stats()
+                return producer.poll() is not None and stats['unacked'] == 0 and \
+                    all(stats['queues'].get(queue, 0) == 0 for queue in stats['consuming'])
+            wait_for(drained, timeout, f'{pipeline} to finish', interval=0.1)
+            finished = time.monotonic()
+            stats = broker.stats()
+            latencies = broker.take_latencies()
+        finally:
+            # the producer first, it may still be publishing after a timeout
+            usage = {name: stop(processes[name][1], workdir, processes[name][0])
+                     for name in ('producer', 'consumer') if name in processes}
+            usage['broker'] = stop(broker_process, workdir, 'broker')
+
+        seconds = (stats['last_ack'] or time.monotonic()) - (stats['first_publish'] or started)
+        rows = count_rows(os.path.join(ROOT, data_file))
+        return {
+            'pipeline': pipeline,
+            'speed': speed,
+            'messages': stats['acked'],
+            'rows': rows,
+            'redelivered': stats['redelivered'],
+            'seconds': round(seconds, 3),
+            'wall_seconds': round(finished - started, 3),
+            'messages_per_second': round(stats['acked'] / seconds, 1) if seconds else None,
+            'rows_per_second': round(rows / seconds, 1) if seconds else None,
+            'latency_ms': percentiles(latencies),
+            'processes': {role: {key: round(value, 3) for key, value in used.items()} for role, used in usage.items()},
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Print each run against the same pipeline and speed in baseline, returns the regressions."""
+    earlier = {(run['pipeline'], run['speed']): run for run in baseline['runs']}
+    regressions = []
+    for run in results['runs']:
+        old = earlier.get((run['pipeline'], run['speed']))
+        if old is None:
+            continue
+        throughput = run['messages_per_second'] / old['messages_per_second'] - 1
+        p99 = run['latency_ms']['p99'] / old['latency_ms']['p99'] - 1
+        print(f"{run['pipeline']:<3} {run['speed']:>7}  throughput {throughput:+7.1%}  p99 {p99:+7.1%}")
+        if throughput < -tolerance or p99 > tolerance:
+            regressions.append(f"{run['pipeline']} at {run['speed']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pipelines", default="v1,v2,v3")
+    parser.add_argument("--speeds", default="max", help="replay speeds, e.g. max,36000")
+    parser.add_argument("--repeat", type=int, default=1, help="runs of each pipeline and speed")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds one run may take")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="an earlier --output file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before --compare fails")
+    # used by the processes the benchmark starts
+    parser.add_argument("--role", help=argparse.SUPPRESS)
+    parser.add_argument("--host", help=argparse.SUPPRESS)
+    parser.add_argument("--speed", default="max", help=argparse.SUPPRESS)
+    parser.add_argument("--usage", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.role:
+        return role_main(args)
+
+    results = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'broker': 'memory',
+        'runs': [],
+    }
+    print(f"{'run':<12} {'msgs':>6} {'msg/s':>9} {'rows/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  "
+          f"cpu s / rss MB (producer, consumer, broker)")
+    for pipeline in args.pipelines.split(','):
+        for speed in args.speeds.split(','):
+            for _ in range(args.repeat):
+                run = run_pipeline(pipeline, speed, args.timeout)
+                results['runs'].append(run)
+                latency = run['latency_ms']
+                usage = ", ".join(f"{run['processes'].get(role, {}).get('cpu_seconds', 0):.2f}/"
+                                  f"{run['processes'].get(role, {}).get('max_rss_mb', 0):.0f}"
+                                  for role in ('producer', 'consumer', 'broker'))
+                print(f"{pipeline + ' ' + speed:<12} {run['messages']:>6} {run['messages_per_second']:>9.0f} "
+                      f"{run['rows_per_second']:>9.0f} {latency.get('p50', 0):>8.1f} {latency.get('p95', 0):>8.1f} "
+                      f"{latency.get('p99', 0):>8.1f}  {usage}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
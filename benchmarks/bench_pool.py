@@ -0,0 +1,79 @@
+"""
+Benchmark: decoding RECORDS messages to CSV text in worker processes, the scaling curve.
+
+"in process" decodes and formats every message in one process, as the line consumers do by default.
+"N workers" sends the messages through utils/util_pool.py with a pool of N processes and puts the
+results back in arrival order with the reorder buffer. Every run must give the same text.
+
+The speedup is limited by the number of CPUs (printed first), run it on the box you deploy to.
+No RabbitMQ needed. Run from the repo root:
+
+    python -m benchmarks.bench_pool --workers 1,2,4,8,16
+
+"""
+
+import argparse
+import os
+import time
+
+from utils.util_pool import OrderedWorkQueue, make_pool, records_to_csv
+from utils.util_reader import read_subway
+from utils.util_wire import DICTIONARY, WireEncoder, message_state, read_header
+
+
+def in_process(messages: list) -> tuple:
+    """Seconds and CSV text for formatting every message here."""
+    start = time.perf_counter()
+    texts = []
+    dictionary_body = None
+    for body in messages:
+        if read_header(body)[0] == DICTIONARY:
+            dictionary_body = body
+            continue
+        texts.append(records_to_csv('bench', message_state(body), dictionary_body, body)[0])
+    return time.perf_counter() - start, "".join(texts)
+
+
+def pooled(messages: list, workers: int) -> tuple:
+    """Seconds and CSV text for formatting every message in a pool of workers, in arrival order."""
+    with make_pool(workers) as pool:
+        # start the workers before timing
+        list(pool.map(abs, range(workers)))
+        start = time.perf_counter()
+        work = OrderedWorkQueue(pool, 'bench')
+        released = []
+        for delivery_tag, body in enumerate(messages, 1):
+            released.extend(work.submit(body, delivery_tag))
+        released.extend(work.poll(wait=True))
+        elapsed = time.perf_counter() - start
+    assert [delivery_tag for delivery_tag, _, _ in released] == list(range(1, len(messages) + 1))
+    return elapsed, "".join(text for _, text, _ in released)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", default="MTA_SubwayW1Feb22.csv")
+    parser.add_argument("--max-records", type=int, default=250, help="records per RECORDS message")
+    parser.add_argument("--repeat", type=int, default=4, help="send the dataset this many times")
+    parser.add_argument("--workers", default="1,2,4,8,16")
+    args = parser.parse_args()
+
+    # RECORDS, as the workers get them, the consumer joins FACTS before they go to a worker
+    encoder = WireEncoder(args.max_records, stations=False)
+    chunks = list(read_subway(args.input))
+    messages = [message for _ in range(args.repeat) for chunk in chunks for message in encoder.encode('bench', chunk)]
+    rows = sum(len(chunk) for chunk in chunks) * args.repeat
+
+    print(f"{os.cpu_count()} CPUs, {len(messages)} messages, {rows} rows")
+    baseline, expected = in_process(messages)
+    print(f"{'in process':<12} {baseline * 1000:9.1f} ms  {rows / baseline:10.0f} rows/s")
+    for workers in [int(workers) for workers in args.workers.split(',')]:
+        elapsed, text = pooled(messages, workers)
+        assert text == expected
+        speedup = baseline / elapsed
+        print(f"{workers:>3} workers  {elapsed * 1000:9.1f} ms  {rows / elapsed:10.0f} rows/s  "
+              f"{speedup:5.2f}x  {speedup / workers:5.0%} per worker")
+
+
+if __name__ == "__main__":
+    main()
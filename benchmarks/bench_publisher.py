@@ -0,0 +1,90 @@
+"""
+Benchmark: messages/sec for a connection per message versus the pooled publisher.
+
+The "before" path is the original send_message, which opens a BlockingConnection,
+declares the queue, publishes and closes the connection for every message.
+The "after" path is utils/util_publisher.PooledPublisher.
+
+Requires RabbitMQ running on the host. Run from the repo root:
+
+    python -m benchmarks.bench_publisher --messages 2000
+
+"""
+
+import argparse
+import csv
+import time
+
+import pika
+
+from utils.util_publisher import PooledPublisher
+
+bench_queue = "Bench-publisher_queue"
+
+
+def read_messages(input_file: str, count: int):
+    """Build the same text messages MTA_ProducerV1 sends, for the first count rows."""
+    messages = []
+    with open(input_file, 'r', newline='', encoding='utf-8-sig') as file:
+        reader = csv.reader(file)
+        next(reader)
+        for row in reader:
+            messages.append(f" {row[0]}, {row[2]}, {row[3]}, {row[5]}, {row[8]}".encode())
+            if len(messages) == count:
+                break
+    return messages
+
+
+def send_per_connection(host: str, messages: list):
+    """The original send_message: one connection per message."""
+    for message in messages:
+        conn = pika.BlockingConnection(pika.ConnectionParameters(host))
+        ch = conn.channel()
+        ch.queue_declare(queue=bench_queue, durable=True)
+        ch.basic_publish(exchange="", routing_key=bench_queue, body=message)
+        conn.close()
+
+
+def send_pooled(host: str, messages: list):
+    """The pooled publisher: one connection for all messages."""
+    publisher = PooledPublisher(host)
+    for message in messages:
+        publisher.publish(bench_queue, message)
+    publisher.close()
+
+
+def run(name: str, func, host: str, messages: list):
+    """Time one publish path and print messages/sec."""
+    start = time.perf_counter()
+    func(host, messages)
+    elapsed = time.perf_counter() - start
+    rate = len(messages) / elapsed
+    print(f"{name:<16} {len(messages):>7} messages in {elapsed:8.2f}s = {rate:10.1f} msg/s")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--input", default="MTA_SubwayW1Feb22.csv")
+    parser.add_argument("--messages", type=int, default=2000, help="rows to send, 0 for the full file")
+    args = parser.parse_args()
+
+    messages = read_messages(args.input, args.messages or -1)
+
+    # start from an empty queue so both runs see the same broker state
+    conn = pika.BlockingConnection(pika.ConnectionParameters(args.host))
+    conn.channel().queue_delete(queue=bench_queue)
+    conn.close()
+
+    before = run("per-connection", send_per_connection, args.host, messages)
+    after = run("pooled", send_pooled, args.host, messages)
+    print(f"speedup: {after / before:.1f}x")
+
+    conn = pika.BlockingConnection(pika.ConnectionParameters(args.host))
+    conn.channel().queue_delete(queue=bench_queue)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
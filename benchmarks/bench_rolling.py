@@ -0,0 +1,77 @@
+"""
+Benchmark: cost per reading of RollingStats as the window gets longer.
+
+RollingStats (utils/util_rolling.py) should cost the same per reading whatever the window length.
+For comparison, "recompute" works the statistics out again from the whole window on every
+reading, which is what a naive per message callback would do and grows with the window.
+"EventTimeWindow" is the time based window, one reading an hour and a window of that many hours,
+so it also pays for the watermark and for evicting by timestamp.
+
+No RabbitMQ needed. Run from the repo root:
+
+    python -m benchmarks.bench_rolling
+
+"""
+
+import argparse
+import random
+import statistics
+import time
+from collections import deque
+
+from utils.util_rolling import EventTimeWindow, RollingStats
+
+
+def run_rolling(values: list, window: int) -> float:
+    """Seconds per reading for the incremental statistics."""
+    stats = RollingStats(maxlen=window)
+    start = time.perf_counter()
+    for value in values:
+        stats.add(value)
+        stats.mean, stats.variance, stats.min, stats.max
+    return (time.perf_counter() - start) / len(values)
+
+
+def run_time_window(values: list, window: int) -> float:
+    """Seconds per reading for a time based window holding window hourly readings."""
+    time_window = EventTimeWindow(span=window * 3600, allowed_lateness=3600)
+    start = time.perf_counter()
+    for hour, value in enumerate(values):
+        for transit_timestamp, released in time_window.push(hour * 3600, value):
+            time_window.append(transit_timestamp, released)
+        time_window.stats.mean, time_window.stats.variance, time_window.stats.min, time_window.stats.max
+    return (time.perf_counter() - start) / len(values)
+
+
+def run_recompute(values: list, window: int) -> float:
+    """Seconds per reading when every statistic is recomputed from the window."""
+    items = deque(maxlen=window)
+    start = time.perf_counter()
+    for value in values:
+        items.append(value)
+        sum(items), statistics.fmean(items), min(items), max(items)
+        if len(items) > 1:
+            statistics.variance(items)
+    return (time.perf_counter() - start) / len(values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--readings", type=int, default=20000)
+    parser.add_argument("--windows", default="8,64,512,4096")
+    args = parser.parse_args()
+
+    random.seed(0)
+    values = [random.randint(0, 2500) for _ in range(args.readings)]
+
+    print(f"{'window':>8} {'RollingStats':>16} {'EventTimeWindow':>16} {'recompute':>16}")
+    for window in [int(window) for window in args.windows.split(',')]:
+        rolling = run_rolling(values, window)
+        time_window = run_time_window(values, window)
+        # the recompute path gets slow quickly, time it on fewer readings
+        recompute = run_recompute(values[:max(window * 4, 2000)], window)
+        print(f"{window:>8} {rolling * 1e6:13.2f} us {time_window * 1e6:13.2f} us {recompute * 1e6:13.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Benchmark: writing the line consumers' CSV, open per message versus the buffered CsvSink.
+
+"open per row" is what the V2 line consumers used to do for every record: open the CSV in append
+mode, build a csv.DictWriter, check file.tell() for the header and write one row.
+"CsvSink" is utils/util_sink.py: the file is opened once and rows are written in batches.
+It is fed one message per row and one message per RECORDS message (up to 1000 rows).
+Both write every row of the full dataset and must produce the same file. Logging is left out.
+
+No RabbitMQ needed. Run from the repo root:
+
+    python -m benchmarks.bench_sink
+
+"""
+
+import argparse
+import csv
+import filecmp
+import os
+import tempfile
+import time
+
+from utils.util_reader import read_subway
+from utils.util_sink import CsvSink
+from utils.util_wire import CSV_COLUMNS
+
+
+def open_per_row(path: str, rows: list) -> float:
+    """Seconds to write rows the way the consumers used to."""
+    start = time.perf_counter()
+    for subway_data in rows:
+        with open(path, 'a', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=CSV_COLUMNS)
+            if file.tell() == 0:
+                writer.writeheader()
+            writer.writerow(subway_data)
+    return time.perf_counter() - start
+
+
+def sink(path: str, messages: list, fsync: bool = False) -> float:
+    """Seconds to write every message through a CsvSink, acking as the consumers do."""
+    start = time.perf_counter()
+    acked = 0
+    with CsvSink(path, CSV_COLUMNS, fsync=fsync) as csv_sink:
+        for delivery_tag, rows in enumerate(messages, 1):
+            acked += len(csv_sink.add(rows, delivery_tag))
+        acked += len(csv_sink.close())
+    assert acked == len(messages)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", default="MTA_SubwayW1Feb22.csv")
+    args = parser.parse_args()
+
+    rows = [subway_data for chunk in read_subway(args.input) for subway_data in chunk.rows()]
+    per_row = [[subway_data] for subway_data in rows]
+    per_chunk = [rows[start:start + 1000] for start in range(0, len(rows), 1000)]
+
+    with tempfile.TemporaryDirectory() as folder:
+        def path(name):
+            return os.path.join(folder, name)
+
+        results = [
+            ("open per row", open_per_row(path("baseline.csv"), rows), "baseline.csv"),
+            ("CsvSink, 1 row/msg", sink(path("sink_rows.csv"), per_row), "sink_rows.csv"),
+            ("CsvSink, 1000 rows/msg", sink(path("sink_chunks.csv"), per_chunk), "sink_chunks.csv"),
+            ("CsvSink + fsync", sink(path("sink_fsync.csv"), per_row, fsync=True), "sink_fsync.csv"),
+        ]
+        baseline = results[0][1]
+        for name, seconds, file_name in results:
+            assert filecmp.cmp(path("baseline.csv"), path(file_name), shallow=False)
+            print(f"{name:<24} {seconds * 1000:9.1f} ms  {len(rows) / seconds:10.0f} rows/s  {baseline / seconds:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Benchmark: the line consumers' CSVs versus the columnar store in utils/util_store.py.
+
+Every record of MTA_SubwayW1Feb22.csv is split by Line into RECORDS messages, as MTA_ProducerV2.py
+sends them, and written the way MTA_ConsumeLinesV2.py does:
+
+1. CsvSink: each message decoded into subway_data dicts and written to Data_MTA_Line<X>.csv
+2. ColumnSink: each message's records buffered as arrays and written as .npy segments
+
+Then the same question is asked of both: the total ridership of Line 7 in a three hour window.
+The CSV has to be read and parsed whole, the store memory maps the ridership column of the
+segments in the window. Both must give the same answer. Logging is left out.
+
+No RabbitMQ needed. Run from the repo root:
+
+    python -m benchmarks.bench_store --line 7 --start "02/03/22 6:00:00" --end "02/03/22 9:00:00"
+
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from utils.util_partition import line_queue_name
+from utils.util_reader import read_subway
+from utils.util_replay import parse_timestamp
+from utils.util_sink import CsvSink
+from utils.util_store import ColumnSink, ColumnStore
+from utils.util_wire import CSV_COLUMNS, WireDecoder, WireEncoder
+
+
+def line_messages(path: str) -> dict:
+    """Line -> the message bodies its queue would get."""
+    encoder = WireEncoder()
+    messages = {}
+    for chunk in read_subway(path):
+        lines = chunk.dictionaries['Line'].values
+        for code in np.unique(chunk['Line']).tolist():
+            part = chunk.take(np.flatnonzero(chunk['Line'] == code))
+            messages.setdefault(lines[code], []).extend(encoder.encode(line_queue_name(lines[code]), part))
+    return messages
+
+
+def write_csv(folder: str, messages: dict) -> float:
+    """Seconds to decode and write every Line's messages to its CSV."""
+    start = time.perf_counter()
+    for line, bodies in messages.items():
+        decoder = WireDecoder()
+        with CsvSink(os.path.join(folder, f"Data_MTA_Line{line}.csv"), CSV_COLUMNS) as csv_sink:
+            for delivery_tag, body in enumerate(bodies, 1):
+                csv_sink.add(decoder.decode_rows(body), delivery_tag)
+    return time.perf_counter() - start
+
+
+def write_store(folder: str, messages: dict) -> float:
+    """Seconds to decode and write every Line's messages to the columnar store."""
+    start = time.perf_counter()
+    store = ColumnStore(folder)
+    for line, bodies in messages.items():
+        decoder = WireDecoder()
+        column_sink = ColumnSink(store, line)
+        for delivery_tag, body in enumerate(bodies, 1):
+            column_sink.add_records(decoder.decode(body), decoder.dictionaries, delivery_tag)
+        column_sink.close()
+    return time.perf_counter() - start
+
+
+def folder_size(folder: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(folder) for name in names)
+
+
+def query_csv(folder: str, line: str, start: float, end: float) -> int:
+    """Ridership of line in [start, end) from its CSV."""
+    total = 0
+    for chunk in read_subway(os.path.join(folder, f"Data_MTA_Line{line}.csv")):
+        timestamps = chunk['transit_timestamp']
+        total += int(chunk['ridership'][(timestamps >= start) & (timestamps < end)].sum())
+    return total
+
+
+def query_store(folder: str, line: str, start: float, end: float) -> int:
+    """Ridership of line in [start, end) from the store, a new ColumnStore so the manifest is read too."""
+    return int(ColumnStore(folder).read_column('ridership', line, start, end).sum())
+
+
+def timed(function, *args, repeat: int = 5) -> tuple:
+    """(best seconds, result) of repeat calls."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", default="MTA_SubwayW1Feb22.csv")
+    parser.add_argument("--line", default="7")
+    parser.add_argument("--start", default="02/03/22 6:00:00")
+    parser.add_argument("--end", default="02/03/22 9:00:00")
+    args = parser.parse_args()
+
+    messages = line_messages(args.input)
+    start, end = parse_timestamp(args.start), parse_timestamp(args.end)
+    with tempfile.TemporaryDirectory() as csv_folder, tempfile.TemporaryDirectory() as store_folder:
+        csv_write = write_csv(csv_folder, messages)
+        store_write = write_store(store_folder, messages)
+        csv_query, csv_total = timed(query_csv, csv_folder, args.line, start, end)
+        store_query, store_total = timed(query_store, store_folder, args.line, start, end)
+        assert csv_total == store_total, (csv_total, store_total)
+
+        print(f"{sum(len(bodies) for bodies in messages.values())} messages for {len(messages)} Lines, "
+              f"Line {args.line} ridership {args.start} to {args.end}: {store_total}")
+        print(f"{'':<12} {'write ms':>9} {'disk KB':>9} {'query ms':>9}")
+        print(f"{'CSV':<12} {csv_write * 1000:9.1f} {folder_size(csv_folder) / 1024:9.0f} {csv_query * 1000:9.2f}")
+        print(f"{'columnar':<12} {store_write * 1000:9.1f} {folder_size(store_folder) / 1024:9.0f} "
+              f"{store_query * 1000:9.2f}")
+
+
+if __name__ == "__main__":
+    main()
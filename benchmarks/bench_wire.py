@@ -0,0 +1,79 @@
+"""
+Benchmark: bytes per record and encode/decode rate, pickle versus the binary wire format.
+
+"pickle" is what ProducerV2 used to send: one pickled 13 key dict per message.
+"wire" is utils/util_wire.py: FACTS messages of up to 1000 records plus one DICTIONARY and the
+STATIONS messages, see benchmarks/bench_dimensions.py for FACTS against full RECORDS.
+Decoding is measured both to a NumPy record view and all the way back to subway_data dicts.
+
+No RabbitMQ needed. Run from the repo root:
+
+    python -m benchmarks.bench_wire
+
+"""
+
+import argparse
+import pickle
+import time
+
+from utils.util_reader import read_subway
+from utils.util_wire import WireDecoder, WireEncoder
+
+
+def timed(func, repeat: int = 3):
+    """Best of repeat runs, returns (seconds, result)."""
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def report(name: str, rows: int, size: int, encode: float, decode: float):
+    print(f"{name:<22} {size / rows:8.1f} B/record  "
+          f"encode {rows / encode:12.0f} rec/s  decode {rows / decode:12.0f} rec/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", default="MTA_SubwayW1Feb22.csv")
+    parser.add_argument("--max-records", type=int, default=1000, help="records per RECORDS message")
+    args = parser.parse_args()
+
+    chunks = list(read_subway(args.input))
+    rows = [subway_data for chunk in chunks for subway_data in chunk.rows()]
+    count = len(rows)
+
+    # pickle, one message per row
+    encode, messages = timed(lambda: [pickle.dumps(subway_data) for subway_data in rows])
+    decode, _ = timed(lambda: [pickle.loads(message) for message in messages])
+    report("pickle (per row)", count, sum(map(len, messages)), encode, decode)
+
+    # binary wire format, one queue so the dictionary is shipped once
+    def encode_chunks():
+        encoder = WireEncoder(args.max_records)
+        return [message for chunk in chunks for message in encoder.encode('bench', chunk)]
+
+    encode, messages = timed(encode_chunks)
+
+    def decode_records():
+        decoder = WireDecoder()
+        return [decoder.decode(message) for message in messages]
+
+    def decode_rows():
+        decoder = WireDecoder()
+        return [row for message in messages for row in decoder.decode_rows(message)]
+
+    decode, _ = timed(decode_records)
+    report("wire (record view)", count, sum(map(len, messages)), encode, decode)
+    decode, decoded = timed(decode_rows)
+    report("wire (to dicts)", count, sum(map(len, messages)), encode, decode)
+
+    # the round trip must give back exactly what was sent
+    assert decoded == rows
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+asyncio AMQP transport for the asyncio producer and consumer.
+
+Everything else uses pika.BlockingConnection, so a process does one blocking thing at a time.
+This module wraps pika's own AsyncioConnection (no extra dependency) so that one event loop can
+publish to and consume from many queues at once:
+
+1. connect() and AsyncConnection.channel() return once the broker has opened them.
+2. AsyncChannel turns pika's callbacks into awaitables: queue_declare, queue_delete, queue_purge,
+   basic_qos and confirm_delivery.
+3. publish() waits while max_in_flight messages are unconfirmed, so a fast producer is slowed
+   down to the rate the broker confirms at instead of filling memory. A message the broker
+   nacks is published again, like utils/util_publisher.py's BatchPublisher does.
+4. consume() puts each delivery on a bounded asyncio.Queue. The prefetch count is set to the
+   queue size, so the broker never sends more than the queue can hold.
+5. stop_event() returns an asyncio.Event set by Ctrl+C or SIGTERM, for a graceful shutdown.
+
+"""
+
+import asyncio
+import collections
+import itertools
+import signal
+
+import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+def _future_callback(future: asyncio.Future):
+    """A pika callback that completes future with the first argument pika passes it."""
+    def callback(*args):
+        if not future.done():
+            future.set_result(args[0] if args else None)
+    return callback
+
+
+async def connect(host: str = "localhost") -> "AsyncConnection":
+    """Open an AsyncioConnection on the running event loop and wait for the broker to accept it."""
+    loop = asyncio.get_running_loop()
+    opened = loop.create_future()
+
+    def on_open_error(connection, error):
+        if not opened.done():
+            if not isinstance(error, pika.exceptions.AMQPConnectionError):
+                error = pika.exceptions.AMQPConnectionError(error)
+            opened.set_exception(error)
+
+    def on_close(connection, reason):
+        if not opened.done():
+            opened.set_exception(pika.exceptions.AMQPConnectionError(reason))
+
+    connection = AsyncioConnection(pika.ConnectionParameters(host=host), on_open_callback=_future_callback(opened),
+                                   on_open_error_callback=on_open_error, on_close_callback=on_close,
+                                   custom_ioloop=loop)
+    await opened
+    return AsyncConnection(connection)
+
+
+def stop_event() -> asyncio.Event:
+    """
+    An Event set on Ctrl+C or SIGTERM so coroutines can finish their work and close cleanly.
+    Where the loop cannot handle signals (Windows) Ctrl+C still raises KeyboardInterrupt.
+    """
+    loop = asyncio.get_running_loop()
+    event = asyncio.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    return event
+
+
+class AsyncConnection:
+    """An open AsyncioConnection."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.closed = asyncio.get_running_loop().create_future()
+        connection.add_on_close_callback(self.on_close)
+
+    def on_close(self, connection, reason):
+        if not self.closed.done():
+            self.closed.set_result(reason)
+
+    async def channel(self) -> "AsyncChannel":
+        """Open a new channel and wait for it."""
+        opened = asyncio.get_running_loop().create_future()
+        self.connection.channel(on_open_callback=_future_callback(opened))
+        return AsyncChannel(await opened)
+
+    async def close(self):
+        """Close the connection and wait until it is closed."""
+        if self.connection.is_open:
+            self.connection.close()
+        await self.closed
+
+
+class AsyncChannel:
+    """
+    Awaitable wrapper around a pika Channel opened on an AsyncioConnection.
+
+    Parameters:
+        channel: the pika Channel
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        # publisher confirms, see confirm_delivery
+        self.window = None
+        self.next_tag = 1
+        # delivery tag -> (queue, body, properties) of every message not yet confirmed
+        self.outstanding = collections.OrderedDict()
+        self.all_confirmed = asyncio.Event()
+        self.all_confirmed.set()
+        self.confirmed = 0
+        self.nacked = 0
+
+    async def call(self, method, *args, **kwargs):
+        """Call a pika Channel method that takes a completion callback and wait for it."""
+        done = self.loop.create_future()
+        method(*args, callback=_future_callback(done), **kwargs)
+        return await done
+
+    async def queue_declare(self, queue: str, durable: bool = True):
+        return await self.call(self.channel.queue_declare, queue=queue, durable=durable)
+
+    async def queue_delete(self, queue: str):
+        return await self.call(self.channel.queue_delete, queue=queue)
+
+    async def queue_purge(self, queue: str):
+        return await self.call(self.channel.queue_purge, queue=queue)
+
+    async def basic_qos(self, prefetch_count: int):
+        return await self.call(self.channel.basic_qos, prefetch_count=prefetch_count)
+
+    async def confirm_delivery(self, max_in_flight: int = 1000):
+        """Turn on publisher confirms and allow at most max_in_flight unconfirmed messages."""
+        self.window = asyncio.Semaphore(max_in_flight)
+        await self.call(self.channel.confirm_delivery, self.on_confirm)
+
+    def on_confirm(self, frame):
+        """
+        pika callback for Basic.Ack and Basic.Nack: free a window slot for every acked message.
+        A nacked message is published again and keeps its slot until that copy is acked.
+        """
+        method = frame.method
+        if method.multiple:
+            tags = list(itertools.takewhile(lambda tag: tag <= method.delivery_tag, self.outstanding))
+        else:
+            tags = [method.delivery_tag] if method.delivery_tag in self.outstanding else []
+        messages = [self.outstanding.pop(tag) for tag in tags]
+        if isinstance(method, pika.spec.Basic.Nack):
+            self.nacked += len(messages)
+            for message in messages:
+                self.send(*message)
+            return
+        self.confirmed += len(messages)
+        for _ in messages:
+            self.window.release()
+        if not self.outstanding:
+            self.all_confirmed.set()
+
+    def send(self, queue: str, body: bytes, properties=None):
+        """Publish under the channel's next delivery tag and keep the message until it is confirmed."""
+        self.outstanding[self.next_tag] = (queue, body, properties)
+        self.next_tag += 1
+        self.channel.basic_publish(exchange="", routing_key=queue, body=body, properties=properties)
+
+    async def publish(self, queue: str, body: bytes, properties=None):
+        """Publish to a queue, waiting first if max_in_flight messages are still unconfirmed."""
+        if self.window is None:
+            self.channel.basic_publish(exchange="", routing_key=queue, body=body, properties=properties)
+            return
+        await self.window.acquire()
+        self.all_confirmed.clear()
+        self.send(queue, body, properties)
+
+    async def wait_for_confirms(self):
+        """Wait until the broker has confirmed every message published so far."""
+        await self.all_confirmed.wait()
+
+    def consume(self, queue: str, deliveries: asyncio.Queue) -> str:
+        """
+        Start consuming queue into deliveries as (channel, method, properties, body) tuples.
+        Set basic_qos to at most deliveries.maxsize first so the queue cannot overflow.
+        Returns the consumer tag for cancel.
+        """
+        def on_message(channel, method, properties, body):
+            deliveries.put_nowait((self, method, properties, body))
+        return self.channel.basic_consume(queue=queue, on_message_callback=on_message, auto_ack=False)
+
+    async def cancel(self, consumer_tag: str):
+        """Stop a consumer, deliveries already on its asyncio.Queue stay there."""
+        return await self.call(self.channel.basic_cancel, consumer_tag)
+
+    def basic_ack(self, delivery_tag: int, multiple: bool = False):
+        self.channel.basic_ack(delivery_tag=delivery_tag, multiple=multiple)
+
+    async def close(self):
+        """Close the channel and wait until it is closed."""
+        if self.channel.is_open:
+            closed = self.loop.create_future()
+            self.channel.add_on_close_callback(_future_callback(closed))
+            self.channel.close()
+            await closed
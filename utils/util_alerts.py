@@ -0,0 +1,316 @@
+"""
+Rolling window busy alerts for any number of stations.
+
+ConsumeV3 used to have one copy pasted callback per station, each with its own module level
+deque(maxlen=8) and a hard coded threshold. The AlertEngine keeps every station's window in
+one preallocated NumPy ring buffer of shape (stations, window) instead:
+
+1. Stations, the window length and each station's threshold come from a JSON config file
+   (MTA_AlertConfig.json), so adding a station is a config change.
+2. A batch of readings (a ProducerV3 frame, or readings for many stations at once) is written
+   into the ring buffer and every reading in it is checked in one vectorized step, per station
+   with push_station or for every station together with push_batch:
+   the oldest reading in the window minus the newest, compared with the station's threshold.
+   This is the same check the old callbacks made after every single message.
+3. busy() evaluates the current window of every station in one vectorized step.
+4. Each station also has a RollingStats (utils/util_rolling.py) over the same window, updated in
+   O(1) per reading. A reading more than zscore_threshold standard deviations above the window
+   mean raises a "zscore" spike alert.
+5. With window_seconds set the window is the last window_seconds of transit_timestamp instead of
+   the last window readings. Each station gets an EventTimeWindow (utils/util_rolling.py) which
+   puts readings up to allowed_lateness seconds out of order back in order, drops late readings
+   and duplicates, and evicts by timestamp. Readings are checked one at a time as the watermark
+   releases them, once the station's window spans the full window_seconds.
+
+"""
+
+import json
+from collections import namedtuple
+
+import numpy as np
+
+from utils.util_partition import group_indices
+from utils.util_rolling import EventTimeWindow, RollingStats
+
+# Config used when MTA_AlertConfig.json is missing: the two stations and thresholds ConsumeV3 started with
+DEFAULT_CONFIG = {
+    "window": 8,
+    "default_threshold": 1000,
+    "zscore_threshold": 3.0,
+    "window_seconds": None,
+    "allowed_lateness": 0,
+    "stations": {"447": 1000, "463": 100},
+}
+
+# One alert: which station, the timestamp of the newest reading and the value that set it off.
+# kind is "change" (oldest minus newest reading in the window) or "zscore" (a spike above the window mean)
+Alert = namedtuple('Alert', ['station_id', 'transit_timestamp', 'change', 'kind'], defaults=('change',))
+
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+def load_alert_config(path: str = 'MTA_AlertConfig.json') -> dict:
+    """Read the station list, window length and thresholds, falling back to DEFAULT_CONFIG."""
+    try:
+        with open(path, 'r', encoding='utf-8') as config_file:
+            config = json.load(config_file)
+    except FileNotFoundError:
+        config = {}
+    return {**DEFAULT_CONFIG, **config}
+
+
+def station_queue_name(station_id: int) -> str:
+    """Queue for a station, e.g. 447 -> Station-447"""
+    return f"Station-{station_id}"
+
+
+def station_from_queue(queue_name: str) -> int:
+    """Station id from a queue name, e.g. Station-447 -> 447"""
+    return int(queue_name.rsplit('-', 1)[1])
+
+
+class AlertEngine:
+    """
+    Holds a rolling window of ridership for every station and raises busy alerts.
+
+    Parameters:
+        station_ids (list): the stations to track
+        window (int): readings per window, 8 readings is the original deque(maxlen=8)
+        window_seconds (int): use a time based window of this many seconds of transit_timestamp instead
+        allowed_lateness (int): with window_seconds, how far out of order a reading may arrive
+        thresholds (dict): station id -> change across the window that counts as busy
+        default_threshold (int): threshold for stations missing from thresholds
+        zscore_threshold (float): z-score that counts as a spike, None to turn spike alerts off
+    """
+
+    def __init__(self, station_ids: list, window: int = 8, thresholds: dict = None,
+                 default_threshold: int = 1000, zscore_threshold: float = None,
+                 window_seconds: int = None, allowed_lateness: int = 0):
+        thresholds = thresholds or {}
+        self.station_ids = [int(station_id) for station_id in station_ids]
+        # station id -> row in the ring buffer
+        self.index = {station_id: row for row, station_id in enumerate(self.station_ids)}
+        self.window = window
+        self.thresholds = np.array([thresholds.get(station_id, default_threshold)
+                                    for station_id in self.station_ids], dtype=np.int64)
+
+        # the ring buffer: one row per station, head is the oldest reading, size how many are held
+        stations = len(self.station_ids)
+        self.values = np.zeros((stations, window), dtype=np.int64)
+        self.times = np.zeros((stations, window), dtype=np.int64)
+        self.head = np.zeros(stations, dtype=np.int64)
+        self.size = np.zeros(stations, dtype=np.int64)
+
+        # running statistics over the same window, one per station
+        self.zscore_threshold = zscore_threshold
+        self.stats = {station_id: RollingStats(maxlen=window) for station_id in self.station_ids}
+
+        # time based windows replace the ring buffer and share their statistics with self.stats
+        self.window_seconds = window_seconds
+        self.windows = {}
+        if window_seconds:
+            self.windows = {station_id: EventTimeWindow(window_seconds, allowed_lateness)
+                            for station_id in self.station_ids}
+            self.stats = {station_id: time_window.stats for station_id, time_window in self.windows.items()}
+
+    @classmethod
+    def from_config(cls, config: dict) -> "AlertEngine":
+        """Build an engine from a config as returned by load_alert_config."""
+        thresholds = {int(station_id): threshold for station_id, threshold in config["stations"].items()}
+        return cls(list(thresholds), config["window"], thresholds, config["default_threshold"],
+                   config.get("zscore_threshold"), config.get("window_seconds"), config.get("allowed_lateness", 0))
+
+    def window_of(self, row: int):
+        """Return (timestamps, values) held for a ring buffer row, oldest first."""
+        positions = (self.head[row] + np.arange(self.size[row])) % self.window
+        return self.times[row, positions], self.values[row, positions]
+
+    def push_station(self, station_id: int, timestamps, values) -> list:
+        """
+        Add a station's readings, oldest first, and return the alerts they raise.
+
+        Every new reading is compared with the reading window - 1 places before it, using the
+        readings already in the window followed by the new ones, all in one vectorized step.
+        With time based windows the readings go through the station's EventTimeWindow instead.
+        """
+        if self.windows:
+            return self.push_time_window(station_id, timestamps, values)
+        row = self.index[int(station_id)]
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        values = np.asarray(values, dtype=np.int64)
+        held_times, held_values = self.window_of(row)
+        size = int(self.size[row])
+        count = len(values)
+        window = self.window
+
+        # sliding check over the held readings followed by the new ones
+        series = np.concatenate((held_values, values))
+        series_times = np.concatenate((held_times, timestamps))
+        alerts = []
+        if len(series) >= window:
+            # skip the comparison for a full window whose newest reading was already checked
+            first = max(0, size - window + 1)
+            changes = series[first:len(series) - window + 1] - series[first + window - 1:]
+            for offset in np.flatnonzero(changes >= self.thresholds[row]).tolist():
+                newest = first + offset + window - 1
+                alerts.append(Alert(int(station_id), int(series_times[newest]), int(changes[offset])))
+
+        # update the running statistics, checking each reading against the window before it
+        stats = self.stats[int(station_id)]
+        for transit_timestamp, value in zip(timestamps.tolist(), values.tolist()):
+            alerts.extend(self.check_spike(station_id, stats, transit_timestamp, value))
+            stats.add(value)
+
+        # write the new readings into the ring, overwriting the oldest ones
+        if count >= window:
+            self.values[row] = values[-window:]
+            self.times[row] = timestamps[-window:]
+            self.head[row] = 0
+            self.size[row] = window
+        elif count:
+            positions = (self.head[row] + size + np.arange(count)) % window
+            self.values[row, positions] = values
+            self.times[row, positions] = timestamps
+            new_size = min(window, size + count)
+            self.head[row] = (self.head[row] + size + count - new_size) % window
+            self.size[row] = new_size
+        return alerts
+
+    def check_spike(self, station_id: int, stats: RollingStats, transit_timestamp: int, value) -> list:
+        """Return a zscore Alert if value is a spike against the window in stats, before value is added."""
+        if not self.zscore_threshold or len(stats) < 2:
+            return []
+        zscore = stats.zscore(value)
+        if zscore < self.zscore_threshold:
+            return []
+        return [Alert(int(station_id), transit_timestamp, round(zscore, 2), 'zscore')]
+
+    def push_time_window(self, station_id: int, timestamps, values) -> list:
+        """Add a station's readings, in arrival order, to its time based window and return the alerts."""
+        time_window = self.windows[int(station_id)]
+        alerts = []
+        for transit_timestamp, value in zip(np.asarray(timestamps).tolist(), np.asarray(values).tolist()):
+            alerts.extend(self.append_released(station_id, time_window.push(transit_timestamp, value)))
+        return alerts
+
+    def append_released(self, station_id: int, readings: list) -> list:
+        """Put readings released by a station's watermark into its window, checking each one as it goes in."""
+        time_window = self.windows[int(station_id)]
+        stats = time_window.stats
+        row = self.index[int(station_id)]
+        alerts = []
+        for transit_timestamp, value in readings:
+            alerts.extend(self.check_spike(station_id, stats, transit_timestamp, value))
+            time_window.append(transit_timestamp, value)
+            change = stats.oldest - stats.newest
+            # a window that does not span window_seconds yet would compare readings closer together
+            if time_window.full and len(time_window) >= 2 and change >= self.thresholds[row]:
+                alerts.append(Alert(int(station_id), transit_timestamp, int(change)))
+        return alerts
+
+    def flush(self) -> list:
+        """Release and check the readings still waiting for the watermark, for shutdown. Count based windows hold none."""
+        alerts = []
+        for station_id, time_window in self.windows.items():
+            alerts.extend(self.append_released(station_id, time_window.flush()))
+        return alerts
+
+    def push_batch(self, station_ids, timestamps, values) -> list:
+        """
+        Add readings for many stations at once, e.g. a whole hour for every station.
+
+        The readings are sorted by station, keeping their order, and scattered behind each station's
+        held window into one series. Every new reading is compared with the reading window - 1 places
+        before it in its station's series, for all stations in one array expression, and the last
+        window readings of each series become the station's ring. Time based windows take their
+        readings one at a time anyway, so they go through push_time_window per station.
+        """
+        station_ids = np.asarray(station_ids, dtype=np.int64)
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        values = np.asarray(values, dtype=np.int64)
+        if self.windows:
+            alerts = []
+            for station_id, positions in group_indices(station_ids):
+                alerts.extend(self.push_time_window(station_id, timestamps[positions], values[positions]))
+            return alerts
+        if not len(station_ids):
+            return []
+
+        # ring buffer row of every reading, in one lookup
+        known = np.asarray(self.station_ids, dtype=np.int64)
+        sorter = np.argsort(known)
+        rows = sorter[np.minimum(np.searchsorted(known, station_ids, sorter=sorter), len(known) - 1)]
+        unknown = known[rows] != station_ids
+        if unknown.any():
+            raise KeyError(int(station_ids[unknown][0]))
+        order = np.argsort(rows, kind='stable')
+        rows, timestamps, values = rows[order], timestamps[order], values[order]
+
+        # one series per station that has new readings: its held window, oldest first, then the new readings
+        window = self.window
+        counts = np.bincount(rows, minlength=len(known))
+        touched = np.flatnonzero(counts)
+        held = self.size[touched]
+        totals = held + counts[touched]
+        starts = np.cumsum(totals) - totals
+        series = np.empty(int(totals.sum()), dtype=np.int64)
+        series_times = np.empty_like(series)
+        slots = np.arange(window)
+        ring = (self.head[touched, None] + slots) % window
+        held_mask = slots < held[:, None]
+        held_at = (starts[:, None] + slots)[held_mask]
+        series[held_at] = np.take_along_axis(self.values[touched], ring, axis=1)[held_mask]
+        series_times[held_at] = np.take_along_axis(self.times[touched], ring, axis=1)[held_mask]
+        # each new reading goes after its station's held readings and the station's earlier new readings
+        station = np.repeat(np.arange(len(touched)), counts[touched])
+        first_new = np.cumsum(counts[touched]) - counts[touched]
+        places = held[station] + np.arange(len(rows)) - first_new[station]
+        series[starts[station] + places] = values
+        series_times[starts[station] + places] = timestamps
+
+        # oldest minus newest across the window ending at every new reading, and which of them are busy
+        checked = places >= window - 1
+        changes = np.where(checked, series[np.maximum(starts[station] + places - window + 1, 0)] - values, 0)
+        hits = np.flatnonzero(checked & (changes >= self.thresholds[rows]))
+        alerts = [Alert(self.station_ids[rows[hit]], int(timestamps[hit]), int(changes[hit])) for hit in hits.tolist()]
+
+        # update the running statistics, checking each reading against the window before it
+        for row, transit_timestamp, value in zip(rows.tolist(), timestamps.tolist(), values.tolist()):
+            station_id = self.station_ids[row]
+            stats = self.stats[station_id]
+            alerts.extend(self.check_spike(station_id, stats, transit_timestamp, value))
+            stats.add(value)
+
+        # the last window readings of each series become its station's ring, oldest first
+        kept = np.minimum(totals, window)
+        keep_mask = slots < kept[:, None]
+        keep_at = np.minimum((starts + totals - kept)[:, None] + slots, len(series) - 1)
+        self.values[touched] = np.where(keep_mask, series[keep_at], 0)
+        self.times[touched] = np.where(keep_mask, series_times[keep_at], 0)
+        self.head[touched] = 0
+        self.size[touched] = kept
+        return alerts
+
+    def busy(self) -> list:
+        """
+        Check every station's current window, in one vectorized step for count based windows.
+        Returns the Alerts for the stations that are busy right now.
+        """
+        if self.windows:
+            alerts = []
+            for row, station_id in enumerate(self.station_ids):
+                time_window = self.windows[station_id]
+                if time_window.full and len(time_window) >= 2:
+                    change = time_window.stats.oldest - time_window.stats.newest
+                    if change >= self.thresholds[row]:
+                        alerts.append(Alert(station_id, time_window.times[-1], int(change)))
+            return alerts
+        rows = np.arange(len(self.station_ids))
+        full = self.size == self.window
+        oldest = self.values[rows, self.head]
+        newest_positions = (self.head + self.size - 1) % self.window
+        changes = oldest - self.values[rows, newest_positions]
+        hits = np.flatnonzero(full & (changes >= self.thresholds))
+        return [Alert(self.station_ids[row], int(self.times[row, newest_positions[row]]), int(changes[row]))
+                for row in hits.tolist()]
@@ -0,0 +1,113 @@
+"""
+Batch consumption with one acknowledgement per batch.
+
+Every consumer used to set prefetch_count=1 and basic_ack each message, one network round trip
+per message, and the broker could not send the next message until the last one was acked.
+BatchConsumer sits between the channel and the consumer's processing:
+
+1. basic_qos allows prefetch_count unacknowledged messages, so deliveries keep arriving while
+   a batch is processed.
+2. Deliveries are collected until batch_size have arrived or the oldest has waited max_wait_ms
+   (checked with connection.call_later), then the consumer handles them as one batch.
+3. The batch handler returns the delivery tags that are done and they are acknowledged with a
+   single basic_ack(multiple=True) on the highest tag. Delivery tags count up per channel and
+   batches are handled in arrival order, so every earlier message on the channel is done too.
+
+batch_size=1 with prefetch_count=1 is the old one message at a time behaviour.
+
+With a QueueMetrics (utils/util_metrics.py) every delivery's queue wait is recorded as it arrives,
+and its processing time once it is acknowledged through ack().
+"""
+
+import time
+from collections import OrderedDict
+
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+def ack_through(channel, delivery_tags: list):
+    """Acknowledge every message on channel up to the highest of delivery_tags in one basic_ack."""
+    if delivery_tags:
+        channel.basic_ack(delivery_tag=max(delivery_tags), multiple=True)
+
+
+class BatchConsumer:
+    """
+    Collects deliveries from one channel, any number of queues, and hands them over in batches.
+
+    Parameters:
+        connection: the pika BlockingConnection, used for the max_wait_ms timer
+        channel: the channel the queues are consumed on
+        on_batch: called with a list of (channel, method, properties, body) deliveries,
+            returns the delivery tags to acknowledge
+        batch_size (int): handle a batch once this many deliveries are waiting
+        max_wait_ms (int): handle a smaller batch once its oldest delivery has waited this long
+        prefetch_count (int): unacknowledged messages the broker may send, at least batch_size
+        logger: optional logger for a line per batch
+        metrics (QueueMetrics): optional, records queue wait and processing time per queue
+    """
+
+    def __init__(self, connection, channel, on_batch, batch_size: int = 100, max_wait_ms: int = 50,
+                 prefetch_count: int = None, logger=None, metrics=None):
+        self.connection = connection
+        self.channel = channel
+        self.on_batch = on_batch
+        self.batch_size = batch_size
+        self.max_wait_ms = max_wait_ms
+        self.prefetch_count = max(prefetch_count or 2 * batch_size, batch_size)
+        self.logger = logger
+        self.metrics = metrics
+        # delivery tag -> (queue name, time.monotonic() received) until acknowledged, with metrics only
+        self.unacked = OrderedDict()
+        self.deliveries = []
+        # time.monotonic() when the oldest waiting delivery arrived
+        self.first_delivery = None
+        self.batches = 0
+
+    def start(self, queue_names: list):
+        """Set the prefetch window, consume from every queue and start the max_wait_ms timer."""
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
+        for queue_name in queue_names:
+            self.channel.basic_consume(queue=queue_name, on_message_callback=self.on_message, auto_ack=False)
+        self.connection.call_later(self.max_wait_ms / 1000, self.on_timer)
+
+    def on_message(self, ch, method, properties, body):
+        """pika callback: add the delivery to the batch and handle the batch if it is full."""
+        if not self.deliveries:
+            self.first_delivery = time.monotonic()
+        if self.metrics is not None:
+            self.metrics.received(method.routing_key, properties)
+            self.unacked[method.delivery_tag] = (method.routing_key, time.monotonic())
+        self.deliveries.append((ch, method, properties, body))
+        if len(self.deliveries) >= self.batch_size:
+            self.process()
+
+    def on_timer(self):
+        """Handle a batch that has waited max_wait_ms, then check again later."""
+        if self.deliveries and (time.monotonic() - self.first_delivery) * 1000 >= self.max_wait_ms:
+            self.process()
+        self.connection.call_later(self.max_wait_ms / 1000, self.on_timer)
+
+    def process(self):
+        """Hand the waiting deliveries to on_batch and acknowledge what it returns."""
+        deliveries = self.deliveries
+        self.deliveries = []
+        self.first_delivery = None
+        if not deliveries:
+            return
+        delivery_tags = self.on_batch(deliveries)
+        self.ack(delivery_tags)
+        self.batches += 1
+        if self.logger:
+            self.logger.info(f"Batch {self.batches}: {len(deliveries)} messages, acknowledged {len(delivery_tags or [])}")
+
+    def ack(self, delivery_tags: list):
+        """Acknowledge every message up to the highest of delivery_tags, see ack_through."""
+        ack_through(self.channel, delivery_tags)
+        if self.metrics is not None and delivery_tags:
+            highest = max(delivery_tags)
+            now = time.monotonic()
+            while self.unacked and next(iter(self.unacked)) <= highest:
+                queue_name, received = self.unacked.popitem(last=False)[1]
+                self.metrics.processed(queue_name, now - received)
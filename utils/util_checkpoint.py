@@ -0,0 +1,210 @@
+"""
+Durable replay position for the producers, so a stopped or crashed run can pick up where it left off.
+
+Without it a producer that stops after 10k rows can only start over from row 1, and every
+consumer gets those 10k rows again. ReplayCheckpoint follows what the broker has confirmed:
+
+1. The producer numbers the rows of the source CSV (0 is the first row after the header) and
+   tells the checkpoint the first row of every message it hands to a queue's publisher.
+2. The publisher reports the messages the broker has confirmed ({queue: messages}, see
+   BatchPublisher.on_confirm), each queue's in the order they were sent. So per queue every row
+   before its oldest unconfirmed message is known to be in the broker, also when only some of
+   the messages made from one group of rows are confirmed.
+3. The checkpoint holds the row to resume reading from (the oldest row not yet confirmed on
+   every queue), its byte offset and transit_timestamp from the sparse index (util_index.py),
+   and per queue the row before which everything is confirmed. A queue that is ahead keeps
+   its own row, so on resume none of its confirmed rows are sent a second time.
+4. Confirmations are only recorded in memory as they arrive. The checkpoint is written once
+   save_every messages have been confirmed or save_interval seconds have passed since the last
+   write, at the next confirmation, and when the producer is interrupted or loses the broker.
+   Each write goes through a temporary file that is flushed to disk and renamed over the old one,
+   so a crash leaves either the old or the new checkpoint, never half of one. A crash can send
+   again what was confirmed since the last write: at most save_every messages, or the messages
+   of save_interval seconds, about 100 messages or one second with the defaults.
+5. A checkpoint belongs to one source file and replay range. It is ignored when the CSV has
+   changed (size or modification time) or the producer is given another --start/--end, and it
+   is removed when a run finishes, so the next run starts from the top again.
+
+Resuming needs a source sorted by transit_timestamp (both data files are), for an unsorted file
+the checkpoint is disabled.
+
+"""
+
+import datetime
+import json
+import os
+import time
+from collections import deque
+
+from utils.util_index import time_index
+from utils.util_replay import format_timestamp
+
+CHECKPOINT_VERSION = 1
+# the checkpoint is written after this many confirmed messages, or this many seconds, whichever comes first
+SAVE_EVERY = 100
+SAVE_INTERVAL = 1.0
+
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+def write_durable(path: str, payload: dict):
+    """Write JSON to a temporary file, flush it to disk and rename it over path."""
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as file:
+        json.dump(payload, file, indent=1)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+
+class ReplayCheckpoint:
+    """
+    Tracks which source rows the broker has confirmed per queue and saves the position to resume from.
+
+    Parameters:
+        path (str): the checkpoint file, e.g. MTA_ProducerV2.checkpoint.json
+        source (str): the CSV being replayed
+        start, end (float): the replay range the producer was given, None for the whole file
+        logger: optional logger for loading and saving
+        save_every (int): write the checkpoint once this many messages are confirmed since the last write
+        save_interval (float): or once this many seconds have passed since the last write
+    """
+
+    def __init__(self, path: str, source: str, start: float = None, end: float = None, logger=None,
+                 save_every: int = SAVE_EVERY, save_interval: float = SAVE_INTERVAL):
+        self.path = path
+        self.source = source
+        self.start = start
+        self.end = end
+        self.logger = logger
+        self.index = time_index(source)
+        self.enabled = self.index.is_sorted
+        if not self.enabled and logger:
+            logger.warning(f"{source} is not sorted by transit_timestamp, no checkpoints are written")
+        # queue -> (first row, a transit_timestamp at or before it) of every message sent and not yet confirmed
+        self.pending = {}
+        # queue -> rows before this are confirmed, from this run or the one being resumed
+        self.confirmed_rows = {}
+        # queue -> messages confirmed, over every run since the replay began
+        self.confirmed_messages = {}
+        # the next row to read, and the transit_timestamp of the last row read
+        self.next_row = 0
+        self.last_timestamp = None
+        # where a resumed run starts reading, None when starting from the top
+        self.resume_row = None
+        self.resume_timestamp = None
+        self.saves = 0
+        self.save_every = save_every
+        self.save_interval = save_interval
+        # messages confirmed since the last write, and when it was
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+
+    def load(self) -> bool:
+        """Read the checkpoint if there is one for this source and range, True if the run resumes."""
+        if not self.enabled or not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path) as file:
+                state = json.load(file)
+        except ValueError as e:
+            if self.logger:
+                self.logger.warning(f"Ignoring unreadable checkpoint {self.path}: {e}")
+            return False
+        expected = {'version': CHECKPOINT_VERSION, 'source': os.path.abspath(self.source), 'size': self.index.size,
+                    'mtime_ns': self.index.mtime_ns, 'start': self.start, 'end': self.end}
+        changed = [name for name, value in expected.items() if state.get(name) != value]
+        if changed:
+            if self.logger:
+                self.logger.warning(f"Ignoring checkpoint {self.path}, {', '.join(changed)} changed since it was written")
+            return False
+        self.resume_row = state['row']
+        self.resume_timestamp = state['transit_timestamp']
+        self.next_row = self.resume_row
+        self.confirmed_rows = dict(state['queues'])
+        self.confirmed_messages = dict(state['confirmed'])
+        if self.logger:
+            self.logger.info(f"Resuming {self.source} at row {self.resume_row} "
+                             f"({format_timestamp(self.resume_timestamp)}), {sum(self.confirmed_messages.values())} "
+                             f"messages were confirmed before")
+        return True
+
+    def read_start(self):
+        """The transit_timestamp to start reading at, the producer's own start when not resuming."""
+        return self.resume_timestamp if self.resume_row is not None else self.start
+
+    def first_new_row(self, queue: str) -> int:
+        """Rows of queue before this one are in the broker already and must not be sent again."""
+        return max(self.confirmed_rows.get(queue, 0), self.resume_row or 0)
+
+    def sent(self, queue: str, first_rows: list, transit_timestamp: int):
+        """
+        Messages went to queue's publisher, first_rows holds the first row of each one, in order.
+        A message without rows of its own (a state message) takes the row of the message after it.
+        transit_timestamp is the timestamp of the first of these rows.
+        """
+        pending = self.pending.setdefault(queue, deque())
+        pending.extend((int(first_row), int(transit_timestamp)) for first_row in first_rows)
+
+    def read_through(self, next_row: int, transit_timestamp: int):
+        """Every row before next_row has been read and handed on, or skipped."""
+        self.next_row = next_row
+        self.last_timestamp = int(transit_timestamp)
+
+    def on_confirm(self, confirmed: dict):
+        """Publisher callback, {queue: messages} the broker has just confirmed, oldest messages first."""
+        for queue, messages in confirmed.items():
+            self.confirmed_messages[queue] = self.confirmed_messages.get(queue, 0) + messages
+            self.unsaved += messages
+            pending = self.pending.get(queue, ())
+            for _ in range(min(messages, len(pending))):
+                pending.popleft()
+        if self.unsaved >= self.save_every or time.monotonic() - self.saved_at >= self.save_interval:
+            self.save()
+
+    def position(self) -> tuple:
+        """(row to resume from, a transit_timestamp at or before it, {queue: rows before this are confirmed})."""
+        row, timestamp = self.next_row, self.last_timestamp
+        queues = {}
+        for queue in set(self.pending) | set(self.confirmed_rows):
+            pending = self.pending.get(queue)
+            if pending:
+                # everything of this queue before its oldest unconfirmed message is in the broker
+                first_row, first_timestamp = pending[0]
+                queues[queue] = max(first_row, self.confirmed_rows.get(queue, 0))
+                if first_row < row:
+                    row, timestamp = first_row, first_timestamp
+            else:
+                queues[queue] = max(self.next_row, self.confirmed_rows.get(queue, 0))
+        return row, timestamp, queues
+
+    def save(self):
+        """Write the position, nothing is written before the first row is read."""
+        row, timestamp, queues = self.position()
+        if timestamp is None:
+            timestamp = self.resume_timestamp
+        if not self.enabled or timestamp is None:
+            return
+        offset, _ = self.index.position(timestamp)
+        write_durable(self.path, {
+            'version': CHECKPOINT_VERSION, 'source': os.path.abspath(self.source), 'size': self.index.size,
+            'mtime_ns': self.index.mtime_ns, 'start': self.start, 'end': self.end,
+            'row': row, 'offset': offset, 'transit_timestamp': timestamp,
+            'queues': queues, 'confirmed': self.confirmed_messages,
+            'saved': datetime.datetime.now().isoformat(timespec='seconds')})
+        self.saves += 1
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+
+    def finish(self):
+        """The whole range was sent and confirmed, remove the checkpoint so the next run starts over."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        if self.logger:
+            self.logger.info(f"Replay complete after {self.saves} checkpoints, removed {self.path}")
+
+    def clear(self):
+        """Forget a checkpoint on disk, for a run that should start from the top."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,259 @@
+"""
+Structured event log for the per-row log lines, and a tool to query it.
+
+The per-row lines (see RowLogger in util_logger) made the .log files grow by a line or two per
+row, as text that had to be parsed back with regular expressions. With setup_logger(__file__, events=True):
+
+1. RowLogger lines go to logs/<name>.jsonl, one JSON object per line, instead of logs/<name>.log.
+   The console still shows them and every other line still goes to the .log file.
+2. A line logged with a dict, like row_log(row_log_format, subway_data), is written as the dict's
+   fields. Other lines keep their text in "msg" plus any fields passed as event={...}.
+   Every line has "time" (when it was logged), "level" and "logger".
+3. EventLogHandler writes through a large buffer instead of flushing every line. A line is written
+   within flush_interval seconds, by a timer thread when no later line comes to flush it, and the
+   file is rotated by size like RotatingFileHandler:
+   <name>.jsonl.1 is the newest backup, <name>.jsonl.<backup_count> the oldest. Unlike the .log
+   files a run appends to the log of the last run, rotation keeps it from growing without bound.
+
+Query a log, oldest backup first, one line at a time so the file is never loaded whole:
+
+    python -m utils.util_events logs/MTA_ConsumeLinesV2.jsonl --line 7 --start "02/01/22 6:00:00" --end "02/01/22 9:00:00"
+    python -m utils.util_events logs/MTA_ConsumeV3.jsonl --station 447 --count
+
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import logging.handlers
+import pathlib
+import sys
+import threading
+import time
+
+from utils.util_replay import parse_timestamp
+
+# a file is rotated when it would grow past this many bytes
+MAX_BYTES = 64 * 1024 * 1024
+BACKUP_COUNT = 5
+# bytes written per write call, and the longest a line stays only in memory
+BUFFER_SIZE = 1024 * 1024
+FLUSH_INTERVAL = 1.0
+
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+def is_event(record) -> bool:
+    """True for records logged by a RowLogger, they carry an event attribute."""
+    return hasattr(record, "event")
+
+
+def not_event(record) -> bool:
+    """The filter for the .log file once events go to the .jsonl."""
+    return not hasattr(record, "event")
+
+
+def _json_default(value):
+    """NumPy numbers become plain numbers, anything else its str()."""
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+class EventFormatter(logging.Formatter):
+    """Formats a record as one line of JSON."""
+
+    def format(self, record) -> str:
+        event = {"time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+                 "level": record.levelname, "logger": record.name}
+        fields = getattr(record, "event", None)
+        # a message made only from a dict of fields is just those fields, without the text
+        if not (fields and record.args is fields):
+            event["msg"] = record.getMessage()
+        if fields:
+            event.update(fields)
+        if record.exc_info:
+            event["exc"] = self.formatException(record.exc_info)
+        return json.dumps(event, default=_json_default, separators=(",", ":"))
+
+
+class EventLogHandler(logging.handlers.RotatingFileHandler):
+    """
+    Writes JSON lines through a buffer and rotates the file by size.
+
+    Parameters:
+        filename: the .jsonl file
+        max_bytes (int): rotate before the file grows past this, 0 never rotates
+        backup_count (int): rotated files to keep
+        buffer_size (int): bytes held in memory before they are written
+        flush_interval (float): seconds a line may stay in the buffer, a crash loses at most that much
+    """
+
+    def __init__(self, filename, max_bytes: int = MAX_BYTES, backup_count: int = BACKUP_COUNT,
+                 buffer_size: int = BUFFER_SIZE, flush_interval: float = FLUSH_INTERVAL):
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.flushed = time.monotonic()
+        # writes the buffer flush_interval seconds after the last write, while lines are waiting in it
+        self.timer = None
+        self.size = 0
+        super().__init__(filename, "a", maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+        self.setFormatter(EventFormatter())
+
+    def _open(self):
+        stream = open(self.baseFilename, self.mode, encoding=self.encoding, buffering=self.buffer_size)
+        self.size = stream.tell()
+        return stream
+
+    def emit(self, record):
+        """
+        Write one line. RotatingFileHandler formats every record twice and seeks to the end of
+        the file, which flushes the buffer, to decide on a rollover. Here the size is counted instead.
+        """
+        try:
+            line = self.format(record) + "\n"
+            if self.stream is None:
+                self.stream = self._open()
+            # EventFormatter escapes everything to ASCII, so characters are bytes
+            if self.maxBytes > 0 and self.size and self.size + len(line) > self.maxBytes:
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+            self.stream.write(line)
+            self.size += len(line)
+            self.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        """
+        Write the buffer if it is older than flush_interval, otherwise start the timer that writes it
+        once it is. close() always writes it.
+        """
+        now = time.monotonic()
+        if now - self.flushed >= self.flush_interval:
+            self.flushed = now
+            super().flush()
+        elif self.timer is None:
+            self.timer = threading.Timer(self.flushed + self.flush_interval - now, self.on_timer)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def on_timer(self):
+        """Timer thread: write the buffer, under the handler's lock like emit."""
+        with self.lock:
+            self.timer = None
+            self.flushed = time.monotonic()
+            super().flush()
+
+    def close(self):
+        """Write and close the file, and stop the timer."""
+        super().close()
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+
+def log_files(path) -> list:
+    """The log and its rotated backups, oldest first."""
+    path = pathlib.Path(path)
+    backups = []
+    for backup in path.parent.glob(path.name + ".*"):
+        suffix = backup.name[len(path.name) + 1:]
+        if suffix.isdigit():
+            backups.append((int(suffix), backup))
+    files = [backup for _, backup in sorted(backups, reverse=True)]
+    if path.exists():
+        files.append(path)
+    return files
+
+
+def event_time(value) -> float:
+    """A transit_timestamp as Unix seconds, whether logged as seconds or as CSV text."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = str(value).strip()
+    if value.isdigit():
+        return float(value)
+    return parse_timestamp(value)
+
+
+def read_events(path, station: str = None, line: str = None, start: float = None, end: float = None,
+                since: str = None, until: str = None):
+    """
+    Yield the events of a log and its backups that match every filter given.
+
+    Parameters:
+        path: the .jsonl log
+        station (str): a station_complex_id, or part of a station_complex name (any case)
+        line (str): a subway Line, e.g. 7 or Q
+        start, end (float): transit_timestamp range in Unix seconds, end excluded
+        since, until (str): range of the time an event was logged, ISO text like 2024-06-07T14:15
+    """
+    station_text = station.lower() if station else None
+    for file_path in log_files(path):
+        with open(file_path, encoding="utf-8") as file:
+            for text in file:
+                # skip most lines without parsing them, every value appears in its line's text
+                if station_text and station_text not in text.lower():
+                    continue
+                if line and line not in text:
+                    continue
+                try:
+                    event = json.loads(text)
+                except ValueError:
+                    # the last line of a log that is still being written
+                    continue
+                if station_text and not (str(event.get("station_complex_id", "")).lower() == station_text
+                                         or station_text in str(event.get("station_complex", "")).lower()):
+                    continue
+                if line and str(event.get("Line", "")) != line:
+                    continue
+                if since and event["time"] < since:
+                    continue
+                if until and event["time"] >= until:
+                    continue
+                if start is not None or end is not None:
+                    if "transit_timestamp" not in event:
+                        continue
+                    seconds = event_time(event["transit_timestamp"])
+                    if (start is not None and seconds < start) or (end is not None and seconds >= end):
+                        continue
+                yield event
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Filter a .jsonl event log written by setup_logger(events=True).")
+    parser.add_argument("path", help="the log, e.g. logs/MTA_ConsumeLinesV2.jsonl, its rotated backups are read too")
+    parser.add_argument("--station", help="station_complex_id, or part of a station name")
+    parser.add_argument("--line", help="subway Line, e.g. 7")
+    parser.add_argument("--start", help="first transit_timestamp, e.g. \"02/01/22 6:00:00\"")
+    parser.add_argument("--end", help="transit_timestamp to stop before")
+    parser.add_argument("--since", help="logged at or after, ISO time e.g. 2024-06-07T14:15")
+    parser.add_argument("--until", help="logged before, ISO time")
+    parser.add_argument("--count", action="store_true", help="print only the number of matching events")
+    parser.add_argument("--limit", type=int, help="stop after this many events")
+    args = parser.parse_args()
+
+    if not log_files(args.path):
+        parser.error(f"{args.path} not found")
+    start = parse_timestamp(args.start) if args.start else None
+    end = parse_timestamp(args.end) if args.end else None
+    count = 0
+    for event in read_events(args.path, args.station, args.line, start, end, args.since, args.until):
+        count += 1
+        if not args.count:
+            sys.stdout.write(json.dumps(event, separators=(",", ":")) + "\n")
+        if args.limit and count >= args.limit:
+            break
+    if args.count:
+        print(count)
+
+
+if __name__ == "__main__":
+    main()
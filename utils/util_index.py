@@ -0,0 +1,171 @@
+"""
+Sparse transit_timestamp index over a source CSV, so a replay can start at any hour.
+
+To replay "Feb 3 from 17:00" the producers used to parse every row from the top of the file.
+TimeIndex maps transit_timestamps to byte offsets instead:
+
+1. The file is scanned once, as bytes, and the offset and row number of the first row of every
+   new transit_timestamp are kept. Rows with the same timestamp share one entry, so
+   MTA_SubwayW1Feb22.csv (18,647 rows over 168 hours) needs 168 entries.
+2. The index is cached next to the CSV as <file>.tsidx (JSON) and rebuilt when the CSV's size or
+   modification time no longer match the ones it was built from.
+3. byte_range(start, end) finds the rows in [start, end) with a binary search on the entries.
+   The reader (ColumnReader with start/end, see util_reader.py) memory maps the CSV and parses only
+   those bytes. If the file is not sorted by transit_timestamp the range is the whole file and the
+   reader's own filter does the work, so the result is the same, just not faster.
+
+Quoted fields may hold commas ("Queensboro Plaza (7,N,W)"), a row only starts on a line that is
+not inside quotes, and transit_timestamp is always the first column, never quoted.
+
+Usage:
+
+    python -m utils.util_index MTA_SubwayW1Feb22.csv --start "02/03/22 17:00:00" --end "02/03/22 18:00:00"
+
+"""
+
+import argparse
+import bisect
+import json
+import os
+
+from utils.util_replay import parse_timestamp
+
+INDEX_SUFFIX = '.tsidx'
+INDEX_VERSION = 2
+
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+def index_path(path: str) -> str:
+    """The sidecar file of a CSV, e.g. MTA_SubwayW1Feb22.csv.tsidx"""
+    return path + INDEX_SUFFIX
+
+
+class TimeIndex:
+    """
+    Byte offsets of the first row of every transit_timestamp in a CSV.
+
+    Parameters:
+        path (str): the CSV, transit_timestamp must be its first column
+        size, mtime_ns (int): the CSV's size and modification time when it was indexed
+        data_start (int): byte offset of the first row after the header
+        timestamps, offsets, rows (list): Unix seconds, byte offset and row number (0 is the first
+            row after the header) of the first row of each new timestamp, in file order
+        is_sorted (bool): True if transit_timestamp never goes down in the file
+    """
+
+    def __init__(self, path: str, size: int, mtime_ns: int, data_start: int, timestamps: list, offsets: list,
+                 rows: list, is_sorted: bool):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.data_start = data_start
+        self.timestamps = timestamps
+        self.offsets = offsets
+        self.rows = rows
+        self.is_sorted = is_sorted
+
+    @classmethod
+    def build(cls, path: str) -> "TimeIndex":
+        """Scan the CSV once and record where each transit_timestamp starts."""
+        stat = os.stat(path)
+        timestamps = []
+        offsets = []
+        rows = []
+        row = 0
+        is_sorted = True
+        with open(path, 'rb') as file:
+            header = file.readline()
+            offset = data_start = len(header)
+            in_quotes = False
+            previous = None
+            for line in file:
+                if not in_quotes:
+                    text = line[:line.find(b',')].decode('utf-8').strip()
+                    if text:
+                        seconds = parse_timestamp(text)
+                        if seconds != previous:
+                            if previous is not None and seconds < previous:
+                                is_sorted = False
+                            timestamps.append(seconds)
+                            offsets.append(offset)
+                            rows.append(row)
+                            previous = seconds
+                        row += 1
+                # an odd number of quotes leaves a quoted field open across the newline
+                if line.count(b'"') % 2:
+                    in_quotes = not in_quotes
+                offset += len(line)
+        return cls(path, stat.st_size, stat.st_mtime_ns, data_start, timestamps, offsets, rows, is_sorted)
+
+    @classmethod
+    def load(cls, path: str):
+        """The cached index of a CSV, None if there is none or the CSV has changed since."""
+        try:
+            with open(index_path(path)) as file:
+                payload = json.load(file)
+        except (OSError, ValueError):
+            return None
+        stat = os.stat(path)
+        if (payload.get('version') != INDEX_VERSION or payload['size'] != stat.st_size
+                or payload['mtime_ns'] != stat.st_mtime_ns):
+            return None
+        return cls(path, payload['size'], payload['mtime_ns'], payload['data_start'], payload['timestamps'],
+                   payload['offsets'], payload['rows'], payload['sorted'])
+
+    def save(self):
+        """Write the sidecar file through a temporary file, a reader never sees half of it."""
+        payload = {'version': INDEX_VERSION, 'size': self.size, 'mtime_ns': self.mtime_ns,
+                   'data_start': self.data_start, 'sorted': self.is_sorted,
+                   'timestamps': self.timestamps, 'offsets': self.offsets, 'rows': self.rows}
+        temporary = index_path(self.path) + '.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(payload, file, separators=(',', ':'))
+        os.replace(temporary, index_path(self.path))
+
+    def position(self, seconds: float) -> tuple:
+        """(byte offset, row number) of the first row with transit_timestamp >= seconds, the end of the file if none."""
+        i = bisect.bisect_left(self.timestamps, seconds)
+        if i < len(self.offsets):
+            return self.offsets[i], self.rows[i]
+        return self.size, None
+
+    def byte_range(self, start: float = None, end: float = None) -> tuple:
+        """(first, last) byte offsets holding every row with start <= transit_timestamp < end."""
+        if not self.is_sorted:
+            return self.data_start, self.size
+        first = self.data_start if start is None else self.position(start)[0]
+        last = self.size if end is None else self.position(end)[0]
+        return first, max(first, last)
+
+
+def time_index(path: str) -> TimeIndex:
+    """The index of a CSV, from its sidecar file, or built and cached if missing or out of date."""
+    index = TimeIndex.load(path)
+    if index is None:
+        index = TimeIndex.build(path)
+        try:
+            index.save()
+        except OSError:
+            # a read-only folder, the index still works for this run
+            pass
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the transit_timestamp index of a CSV and show a byte range.")
+    parser.add_argument("path", help="the CSV, e.g. MTA_SubwayW1Feb22.csv")
+    parser.add_argument("--start", help="first transit_timestamp, e.g. \"02/03/22 17:00:00\"")
+    parser.add_argument("--end", help="transit_timestamp to stop before")
+    args = parser.parse_args()
+
+    index = time_index(args.path)
+    first, last = index.byte_range(parse_timestamp(args.start) if args.start else None,
+                                   parse_timestamp(args.end) if args.end else None)
+    print(f"{index_path(args.path)}: {len(index.offsets)} timestamps, sorted={index.is_sorted}")
+    print(f"bytes {first} to {last} of {index.size}")
+
+
+if __name__ == "__main__":
+    main()
@@ -30,6 +30,19 @@ In your code file, instead of print(), use logger.info().
 
 Levels include: debug, info, warning, error, and critical.
 
+HOT LOOPS:
+- setup_logger(__file__, queued=True) hands records to a background thread, which formats them
+  and writes the file and console. logger.info then only puts the record on a queue.
+- RowLogger is for a line per row or message: it logs only every sample_every-th call, skips
+  all work when its level is off, and takes %-style arguments so the text is only built
+  (on the background thread) for lines that are written:
+
+  row_log = RowLogger(logger, sample_every=100)
+  row_log("%(station_complex)s: %(ridership)s riders", subway_data)
+
+- setup_logger(__file__, events=True) writes the RowLogger lines to logs/<name>.jsonl as JSON
+  instead of to the .log file, see utils/util_events.py to write and query them.
+
 @Author: Denise Case
 @Updated: 2021-08
 
@@ -38,9 +51,13 @@ Levels include: debug, info, warning, error, and critical.
 
 # Import some helpful modules from the Python Standard Library
 
+import atexit
 import logging
+import logging.handlers
 import pathlib
+import queue
 import platform
+from collections.abc import Mapping
 import sys
 import os
 import datetime
@@ -52,10 +69,12 @@ DIVIDER = "=" * 50  # A string divider for cleaner output formatting
 # Define program functions (reusable bits of code)
 
 
-def setup_logger(current_file):
+def setup_logger(current_file, queued=False, events=False):
     """
     Setup a logger to automatically record useful information.
     @param current_file: the name of the file requesting a logger.
+    @param queued: write the file and console from a background thread (see HOT LOOPS above).
+    @param events: write RowLogger lines to a .jsonl event log instead of the .log file.
     @returns: the logger object and the name of the logfile.
     """
     logs_dir = pathlib.Path("logs")
@@ -79,10 +98,29 @@ def setup_logger(current_file):
     formatter = logging.Formatter("%(asctime)s.%(name)s.%(levelname)s %(message)s")
     file_handler.setFormatter(formatter)
     console_handler.setFormatter(formatter)
-
-    # Add the handlers to the logger.
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    handlers = [file_handler, console_handler]
+
+    # Move the per-row lines out of the text log into a structured one.
+    if events:
+        from utils.util_events import EventLogHandler, is_event, not_event
+        event_handler = EventLogHandler(logs_dir.joinpath(module_name + ".jsonl"))
+        event_handler.addFilter(is_event)
+        file_handler.addFilter(not_event)
+        handlers.append(event_handler)
+
+    # Add the handlers to the logger, or to a listener thread fed by a queue.
+    if queued:
+        records = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+        listener.start()
+        # write what is still queued when the program exits
+        atexit.register(listener.stop)
+        queue_handler = DeferredQueueHandler(records)
+        queue_handler.listener = listener
+        logger.addHandler(queue_handler)
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
 
     python_version_string = platform.python_version()
     today = datetime.date.today()
@@ -96,3 +134,54 @@ def setup_logger(current_file):
     logger.info(f"{DIVIDER}")
 
     return logger, log_file_name
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler that leaves formatting to the listener thread.
+    The standard one formats every record before queueing it, on the caller's thread.
+    Records stay in this process, so arguments must not be changed after they are logged.
+    setup_logger sets listener to the QueueListener writing the records, listener.stop() writes them all.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class RowLogger:
+    """
+    Logs a line per row or message without slowing the loop down.
+
+    Parameters:
+        logger: the logger to write to
+        level (int): the level of the lines, nothing is done at all when it is off
+        sample_every (int): log only every sample_every-th line, 1 logs them all
+    """
+
+    def __init__(self, logger, level=logging.INFO, sample_every=1):
+        self.logger = logger
+        self.level = level
+        self.sample_every = max(1, sample_every)
+        self.seen = 0
+
+    def wanted(self):
+        """Count one line, True if it should be logged. Check this before building costly arguments."""
+        self.seen += 1
+        if self.sample_every > 1 and self.seen % self.sample_every:
+            return False
+        return self.logger.isEnabledFor(self.level)
+
+    def log(self, msg, *args, event=None):
+        """
+        Log a line that wanted() allowed.
+        event is a dict of fields for the event log, a single dict argument is its own event.
+        """
+        if event is None:
+            event = args[0] if len(args) == 1 and isinstance(args[0], Mapping) else {}
+        self.logger.log(self.level, msg, *args, extra={"event": event})
+
+    def __call__(self, msg, *args, event=None):
+        """Log a %-style line if it is wanted, the text is built only when it is written."""
+        if self.wanted():
+            self.log(msg, *args, event=event)
+
@@ -0,0 +1,254 @@
+"""
+Send stamps and per-queue latency metrics.
+
+A consumer could not tell how long a message had waited in its queue. Now:
+
+1. Producers stamp every message with AMQP headers (SendStamper): the producer's
+   time.monotonic_ns() when it handed the message over (x-sent-ns), a sequence number that counts
+   up per queue (x-seq) and a producer id (x-producer). The message bodies do not change.
+2. Consumers keep two histograms per queue in QueueMetrics:
+   - queue wait: from the producer's send to the consumer receiving the message
+   - processing: from receiving the message to acknowledging it (batching, handling and writing)
+   and count messages without a stamp and gaps or repeats in the sequence numbers.
+3. summary_lines() gives one line per queue for the log, MetricsServer serves the same numbers at
+   http://localhost:<port>/metrics in the Prometheus text format, so any scraper can read them.
+
+time.monotonic_ns() is only comparable on one machine, so queue wait needs the producer and the
+consumer on the same host, as they are in this project. Elsewhere it is left out (wait_skipped).
+"""
+
+import bisect
+import http.server
+import os
+import socket
+import threading
+import time
+from functools import partial
+
+import pika
+
+SENT_HEADER = "x-sent-ns"
+SEQUENCE_HEADER = "x-seq"
+PRODUCER_HEADER = "x-producer"
+# the producer id holds the host, a consumer on another host does not compare monotonic clocks
+HOST_NAME = socket.gethostname()
+
+# histogram bucket upper bounds in seconds, the last bucket catches everything slower
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+class SendStamper:
+    """
+    Stamps messages for the queues one producer sends to.
+    Sequence numbers start at 1 per queue and producer process.
+    """
+
+    def __init__(self):
+        self.producer = f"{HOST_NAME}:{os.getpid()}"
+        self.sequences = {}
+
+    def stamp(self, queue_name: str) -> pika.BasicProperties:
+        """Properties for the next message to queue_name, sent now."""
+        sequence = self.sequences.get(queue_name, 0) + 1
+        self.sequences[queue_name] = sequence
+        return pika.BasicProperties(headers={SENT_HEADER: time.monotonic_ns(), SEQUENCE_HEADER: sequence,
+                                             PRODUCER_HEADER: self.producer})
+
+
+def read_stamp(properties) -> tuple:
+    """Returns (sent ns, sequence number, producer id) from a message's properties, or None if unstamped."""
+    headers = getattr(properties, "headers", None) or {}
+    if SENT_HEADER not in headers:
+        return None
+    producer = headers.get(PRODUCER_HEADER, b"")
+    if isinstance(producer, bytes):
+        producer = producer.decode()
+    return headers[SENT_HEADER], headers.get(SEQUENCE_HEADER), producer
+
+
+class Histogram:
+    """Counts of observed seconds in the BUCKETS, with their sum and the largest value."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q: float) -> float:
+        """The upper bound of the bucket holding the q quantile, the largest value for the last bucket."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class QueueMetrics:
+    """
+    Queue wait and processing histograms, and stamp counters, for every queue of one consumer.
+    Thread safe so MetricsServer can read while the consumer records.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # queue name -> {"wait": Histogram, "processing": Histogram, counters...}
+        self.queues = {}
+        # (queue name, producer id) -> last sequence number seen
+        self.last_sequence = {}
+
+    def queue(self, queue_name: str) -> dict:
+        """The metrics of one queue, lock held."""
+        if queue_name not in self.queues:
+            self.queues[queue_name] = {"wait": Histogram(), "processing": Histogram(), "messages": 0,
+                                       "unstamped": 0, "wait_skipped": 0, "missing": 0, "repeated": 0}
+        return self.queues[queue_name]
+
+    def received(self, queue_name: str, properties, now_ns: int = None):
+        """Record a delivery's queue wait and check its sequence number."""
+        now_ns = now_ns or time.monotonic_ns()
+        stamp = read_stamp(properties)
+        with self.lock:
+            metrics = self.queue(queue_name)
+            metrics["messages"] += 1
+            if stamp is None:
+                metrics["unstamped"] += 1
+                return
+            sent_ns, sequence, producer = stamp
+            if producer.rpartition(":")[0] == HOST_NAME:
+                metrics["wait"].observe(max(now_ns - sent_ns, 0) / 1e9)
+            else:
+                metrics["wait_skipped"] += 1
+            if sequence is None:
+                return
+            key = (queue_name, producer)
+            last = self.last_sequence.get(key, 0)
+            if sequence > last:
+                metrics["missing"] += sequence - last - 1
+                self.last_sequence[key] = sequence
+            else:
+                # a redelivery, or a message that overtook an earlier one
+                metrics["repeated"] += 1
+
+    def processed(self, queue_name: str, seconds: float):
+        """Record the time from receiving a message to acknowledging it."""
+        with self.lock:
+            self.queue(queue_name)["processing"].observe(seconds)
+
+    def summary_lines(self) -> list:
+        """One line per queue: message count, wait and processing p50/p95/p99 in ms."""
+        lines = []
+        with self.lock:
+            for queue_name, metrics in sorted(self.queues.items()):
+                wait, processing = metrics["wait"], metrics["processing"]
+                line = (f"{queue_name}: {metrics['messages']} messages, "
+                        f"wait ms p50 {wait.quantile(0.5) * 1000:.1f} p95 {wait.quantile(0.95) * 1000:.1f} "
+                        f"p99 {wait.quantile(0.99) * 1000:.1f} max {wait.max * 1000:.1f}, "
+                        f"processing ms p50 {processing.quantile(0.5) * 1000:.1f} "
+                        f"p95 {processing.quantile(0.95) * 1000:.1f} p99 {processing.quantile(0.99) * 1000:.1f}")
+                problems = [f"{metrics[name]} {name}" for name in ("unstamped", "missing", "repeated") if metrics[name]]
+                if problems:
+                    line += ", " + ", ".join(problems)
+                lines.append(line)
+        return lines
+
+    def exposition(self) -> str:
+        """Every metric in the Prometheus text exposition format."""
+        out = []
+        with self.lock:
+            for name, key, help_text in (
+                    ("mta_queue_wait_seconds", "wait", "Time from the producer sending a message to the consumer receiving it"),
+                    ("mta_processing_seconds", "processing", "Time from the consumer receiving a message to acknowledging it")):
+                out.append(f"# HELP {name} {help_text}")
+                out.append(f"# TYPE {name} histogram")
+                for queue_name, metrics in sorted(self.queues.items()):
+                    histogram = metrics[key]
+                    label = f'queue="{queue_name}"'
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS, histogram.counts):
+                        cumulative += count
+                        out.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                    out.append(f'{name}_bucket{{{label},le="+Inf"}} {histogram.count}')
+                    out.append(f"{name}_sum{{{label}}} {histogram.sum}")
+                    out.append(f"{name}_count{{{label}}} {histogram.count}")
+            for counter, help_text in (("messages", "Messages received"),
+                                       ("unstamped", "Messages received without a send stamp"),
+                                       ("missing", "Sequence numbers skipped, messages never received"),
+                                       ("repeated", "Messages received again or out of order")):
+                name = f"mta_{counter}_total"
+                out.append(f"# HELP {name} {help_text}")
+                out.append(f"# TYPE {name} counter")
+                for queue_name, metrics in sorted(self.queues.items()):
+                    out.append(f'{name}{{queue="{queue_name}"}} {metrics[counter]}')
+        return "\n".join(out) + "\n"
+
+
+class MetricsServer:
+    """
+    Serves QueueMetrics.exposition() at http://<host>:<port>/metrics from a daemon thread.
+
+    Parameters:
+        metrics (QueueMetrics): the metrics to serve
+        port (int): the local port, 0 picks a free one
+        host (str): the address to listen on, only this machine by default
+    """
+
+    def __init__(self, metrics: QueueMetrics, port: int, host: str = "127.0.0.1"):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.exposition().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def start_metrics(metrics: QueueMetrics, port: int, logger=None):
+    """Start a MetricsServer, or log a warning and carry on without one if the port is taken."""
+    if port is None:
+        return None
+    try:
+        server = MetricsServer(metrics, port)
+    except OSError as e:
+        if logger:
+            logger.warning(f"Metrics endpoint not started on port {port}: {e}")
+        return None
+    if logger:
+        logger.info(f"Metrics at http://127.0.0.1:{server.port}/metrics")
+    return server
+
+
+def log_summary(connection, metrics: QueueMetrics, logger, interval: float):
+    """Log the summary lines every interval seconds, driven by connection.call_later."""
+    for line in metrics.summary_lines():
+        logger.info(f"[metrics] {line}")
+    connection.call_later(interval, partial(log_summary, connection, metrics, logger, interval))
@@ -0,0 +1,92 @@
+"""
+Vectorized routing of ColumnChunks to queues.
+
+ProducerV2 used to pick a queue for every row with 'Line-' + subway_data['Line'] + '_queue'.
+Here a whole chunk is grouped by its dictionary encoded Line column in one NumPy pass:
+
+1. A stable argsort of the Line codes puts the rows of each line next to each other,
+   keeping the original row order inside each line.
+2. np.diff finds where one line's rows end and the next line's start.
+3. Each group is handed on as one sub chunk together with its queue name.
+
+Queue names are built once per Line value and cached by dictionary code, so the Python work
+per chunk grows with the number of lines and not with the number of rows.
+"""
+
+import numpy as np
+
+from utils.util_reader import ColumnChunk
+
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+def line_queue_name(line: str) -> str:
+    """Queue for a subway Line, e.g. 7 -> Line-7_queue"""
+    return 'Line-' + line + '_queue'
+
+
+def line_from_queue(queue_name: str) -> str:
+    """Line of a line queue, e.g. Line-7_queue -> 7"""
+    return queue_name[len('Line-'):-len('_queue')]
+
+
+def group_indices(codes: np.ndarray):
+    """
+    Group row positions by code in one vectorized pass.
+    Returns a list of (code, row positions) with the positions in their original order.
+    """
+    if len(codes) == 0:
+        return []
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    bounds = np.flatnonzero(sorted_codes[1:] != sorted_codes[:-1]) + 1
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(codes)]))
+    return [(int(sorted_codes[start]), order[start:end]) for start, end in zip(starts, ends)]
+
+
+def split_runs(chunk: ColumnChunk, column: str):
+    """
+    Split a chunk wherever the value in column changes, e.g. into one block per transit_timestamp.
+    The blocks are slices (views) of the chunk's arrays, nothing is copied.
+    """
+    values = chunk[column]
+    if len(values) == 0:
+        return
+    bounds = np.flatnonzero(values[1:] != values[:-1]) + 1
+    start = 0
+    for end in [*bounds.tolist(), len(values)]:
+        yield chunk.take(slice(start, end))
+        start = end
+
+
+class Partitioner:
+    """
+    Splits chunks into one group per value of a category column.
+
+    Parameters:
+        column (str): the dictionary encoded column to route by, Line for ProducerV2
+        name_for (callable): turns a column value into a queue name
+    """
+
+    def __init__(self, column: str = 'Line', name_for=line_queue_name):
+        self.column = column
+        self.name_for = name_for
+        # dictionary code -> queue name, filled in as new values appear
+        self.queue_names = []
+
+    def queue_name(self, chunk: ColumnChunk, code: int) -> str:
+        """Queue name for a dictionary code, built the first time the code is seen."""
+        values = chunk.dictionaries[self.column].values
+        while len(self.queue_names) < len(values):
+            self.queue_names.append(self.name_for(values[len(self.queue_names)]))
+        return self.queue_names[code]
+
+    def groups(self, chunk: ColumnChunk) -> list:
+        """Return a list of (queue name, row positions) pairs, one per value found in the chunk."""
+        return [(self.queue_name(chunk, code), positions) for code, positions in group_indices(chunk[self.column])]
+
+    def partition(self, chunk: ColumnChunk) -> list:
+        """Return a list of (queue name, sub chunk) pairs, one per value found in the chunk."""
+        return [(queue_name, chunk.take(positions)) for queue_name, positions in self.groups(chunk)]
@@ -0,0 +1,139 @@
+"""
+Worker processes for the line consumers, with output kept in order.
+
+At full replay speed one process cannot keep up with turning RECORDS messages back into rows
+and CSV text. The work is spread over a pool of worker processes instead:
+
+1. Every message taken from a queue gets the next sequence number of that queue.
+2. Each RECORDS message is decoded and formatted as CSV text in a worker process. The worker is
+   sent the message body and the DICTIONARY message it needs. It parses each dictionary once
+   and keeps it, one per queue, keyed by the queue name and the state id (see utils/util_wire.py).
+   Queues share the pool, so the state alone does not say which queue's dictionary is cached.
+3. Workers finish in any order. A ReorderBuffer holds results until every earlier sequence number
+   is in, then hands them on in the order the messages arrived. So every station's rows are
+   written in their original order, and delivery tags can still be acked with one multi-ack.
+4. DICTIONARY and STATIONS messages are handled in the consumer itself and go straight into the
+   buffer with no rows, keeping their place in the sequence.
+5. The consumer's WireDecoder holds the states, and reads a missed one from the state queue.
+   FACTS messages are joined with the station table there and go to the worker as a RECORDS
+   message. The join is a few array copies, the formatting stays in the workers.
+
+"""
+
+import csv
+import heapq
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.util_wire import CSV_COLUMNS, FACTS, WireDecoder, encode_records_array, is_state_message, read_header
+
+# worker process cache: queue name -> (state id, WireDecoder holding that state's dictionary)
+_decoders = {}
+
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+def records_to_csv(queue_name: str, state: int, dictionary_body: bytes, body: bytes):
+    """
+    Worker side: decode a RECORDS message of queue_name and format its rows as CSV text.
+    Returns (CSV text, row count), the text is exactly what csv.DictWriter writes for the rows.
+    """
+    cached_state, decoder = _decoders.get(queue_name, (None, None))
+    if cached_state != state:
+        decoder = WireDecoder()
+        decoder.decode(dictionary_body)
+        # a new state replaces the queue's old one, only the newest dictionary is used again
+        _decoders[queue_name] = (state, decoder)
+    text = io.StringIO()
+    writer = csv.DictWriter(text, fieldnames=CSV_COLUMNS)
+    count = 0
+    for subway_data in decoder.rows(decoder.decode(body)):
+        writer.writerow(subway_data)
+        count += 1
+    return text.getvalue(), count
+
+
+def make_pool(workers: int = None) -> ProcessPoolExecutor:
+    """A process pool with one worker per CPU unless workers is given."""
+    return ProcessPoolExecutor(max_workers=workers or os.cpu_count())
+
+
+class ReorderBuffer:
+    """
+    Holds results that arrive out of order until every earlier sequence number has arrived.
+
+    Parameters:
+        next_sequence (int): the first sequence number to hand on
+    """
+
+    def __init__(self, next_sequence: int = 0):
+        self.next_sequence = next_sequence
+        # heap of (sequence number, item)
+        self.waiting = []
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def add(self, sequence: int, item) -> list:
+        """Add one result and return every item that is now in order, oldest first."""
+        heapq.heappush(self.waiting, (sequence, item))
+        released = []
+        while self.waiting and self.waiting[0][0] == self.next_sequence:
+            released.append(heapq.heappop(self.waiting)[1])
+            self.next_sequence += 1
+        return released
+
+
+class OrderedWorkQueue:
+    """
+    Sends one queue's messages to a shared process pool and hands the results back in arrival order.
+
+    Parameters:
+        pool: a ProcessPoolExecutor, shared by every queue
+        queue_name (str): the queue the messages come from, names its dictionaries in the workers
+        fetch_state (callable): optional, reads a missed state, see WireDecoder
+    """
+
+    def __init__(self, pool, queue_name: str, fetch_state=None):
+        self.pool = pool
+        self.queue_name = queue_name
+        self.reorder = ReorderBuffer()
+        self.next_sequence = 0
+        # sequence number -> (future, delivery tag) for messages still in a worker
+        self.running = {}
+        # holds the states, the station table joins FACTS messages
+        self.decoder = WireDecoder(fetch_state)
+
+    def __len__(self):
+        return len(self.running) + len(self.reorder)
+
+    def submit(self, body: bytes, delivery_tag) -> list:
+        """
+        Start on one message. Returns the (delivery tag, CSV text, row count) results now in order,
+        a DICTIONARY or STATIONS message can release results straight away.
+        """
+        sequence = self.next_sequence
+        self.next_sequence += 1
+        if is_state_message(body):
+            self.decoder.decode(body)
+            return self.reorder.add(sequence, (delivery_tag, "", 0))
+        # finds the records' state, fetching it if it was missed
+        records = self.decoder.decode(body)
+        if read_header(body)[0] == FACTS:
+            body = encode_records_array(records, self.decoder.state)
+        future = self.pool.submit(records_to_csv, self.queue_name, self.decoder.state, self.decoder.dictionary_body,
+                                  bytes(body))
+        self.running[sequence] = (future, delivery_tag)
+        return []
+
+    def poll(self, wait: bool = False) -> list:
+        """Collect finished work, waiting for all of it if wait, and return the results now in order."""
+        released = []
+        for sequence, (future, delivery_tag) in list(self.running.items()):
+            if wait or future.done():
+                text, count = future.result()
+                del self.running[sequence]
+                released.extend(self.reorder.add(sequence, (delivery_tag, text, count)))
+        return released
@@ -0,0 +1,389 @@
+"""
+A long lived publisher shared by the producers.
+
+The original producers opened a new pika.BlockingConnection for every message,
+declared the queue, published and then closed the connection again. With ~18.6k rows in
+"MTA_SubwayW1Feb22.csv" that is a full TCP + AMQP handshake per row.
+
+This module keeps ONE connection and channel open per process:
+1. The connection and channel are created the first time something is published.
+2. Each queue is declared once, the declared queue names are cached.
+3. publish(queue, body) sends the message on the open channel.
+4. If the connection drops the publisher reconnects and re-declares the queues it needs.
+5. Every message carries a send stamp (send time and per-queue sequence number) in its
+   AMQP headers, see utils/util_metrics.py.
+
+BatchPublisher adds a batched mode on top of this. Messages are buffered per queue and sent
+together when a queue holds batch_size messages or its oldest message is linger_ms old.
+The broker confirms them asynchronously, many delivery tags per ack, while at most
+max_in_flight messages wait for their confirmation.
+
+Usage:
+
+    from utils.util_publisher import get_publisher
+    get_publisher('localhost').publish('Line-7_queue', message)
+
+"""
+
+import atexit
+import itertools
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+
+import pika
+
+from utils.util_metrics import SendStamper
+from utils.util_transport import confirm_channel, open_connection
+
+# Errors that mean the connection or channel is gone and a reconnect is worth trying.
+RECONNECT_ERRORS = (
+    pika.exceptions.AMQPConnectionError,
+    pika.exceptions.AMQPChannelError,
+)
+
+# One publisher per (process id, host), see get_publisher.
+_publishers = {}
+
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+class PooledPublisher:
+    """
+    Keeps a single connection and channel open and publishes messages on it.
+
+    Parameters:
+        host (str): the host name or IP address of the RabbitMQ server, or a memory:// broker
+        durable (bool): declare the queues as durable (survive a RabbitMQ restart)
+        retries (int): how many times to reconnect before giving up on a message
+        retry_delay (float): seconds to wait between reconnect attempts
+        logger (logging.Logger): logger used for connection events
+    """
+
+    def __init__(self, host: str = "localhost", durable: bool = True, retries: int = 3,
+                 retry_delay: float = 1.0, logger: logging.Logger = None):
+        self.host = host
+        self.durable = durable
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.logger = logger or logging.getLogger(__name__)
+        self.connection = None
+        self.channel = None
+        # queues already declared on the current channel
+        self.declared = set()
+        self.stamper = SendStamper()
+
+    def connect(self):
+        """Open the connection and channel if they are not already open."""
+        if self.connection is not None and self.connection.is_open and self.channel.is_open:
+            return self.channel
+        self.disconnect()
+        self.connection = open_connection(self.host)
+        self.channel = self.connection.channel()
+        # a new channel knows nothing about the queues declared on the old one
+        self.declared.clear()
+        self.logger.info(f"Publisher connected to RabbitMQ on {self.host}")
+        return self.channel
+
+    def declare(self, queue_name: str):
+        """Declare a queue once per channel, later calls are a set lookup."""
+        if queue_name not in self.declared:
+            self.channel.queue_declare(queue=queue_name, durable=self.durable)
+            self.declared.add(queue_name)
+
+    def publish(self, queue_name: str, body: bytes):
+        """
+        Publish one message to a queue, reconnecting if the connection was lost.
+
+        Parameters:
+            queue_name (str): the name of the queue
+            body (bytes): the message to be sent to the queue
+        """
+        # stamped once, a retry sends the same sequence number
+        properties = self.stamper.stamp(queue_name)
+        attempt = 0
+        while True:
+            try:
+                self.connect()
+                self.declare(queue_name)
+                self.channel.basic_publish(exchange="", routing_key=queue_name, body=body, properties=properties)
+                return
+            except RECONNECT_ERRORS as e:
+                attempt += 1
+                self.logger.warning(f"Publish to {queue_name} failed ({e}), reconnect attempt {attempt}")
+                self.disconnect()
+                if attempt > self.retries:
+                    raise
+                time.sleep(self.retry_delay)
+
+    def disconnect(self):
+        """Close the connection, ignoring errors from a connection that is already gone."""
+        if self.connection is not None and self.connection.is_open:
+            try:
+                self.connection.close()
+            except RECONNECT_ERRORS:
+                pass
+        self.connection = None
+        self.channel = None
+        self.declared.clear()
+
+    def close(self):
+        """Close the publisher at the end of a run."""
+        self.disconnect()
+
+
+class BatchPublisher(PooledPublisher):
+    """
+    Buffers messages per queue and sends them in batches, with a window of unconfirmed messages.
+
+    The channel runs in publisher confirm mode: every message is published straight away under the
+    channel's next delivery tag, and the broker acknowledges the tags as it takes the messages,
+    usually many at once with multiple=True. At most max_in_flight messages are unconfirmed,
+    sending waits for acks while the window is full. pika's BlockingChannel.confirm_delivery()
+    would wait for the ack of every single basic_publish, so confirms are turned on for the
+    channel underneath it (see utils/util_transport.confirm_channel), which keeps the same
+    window as utils/util_aio.py's AsyncChannel.
+
+    A queue's buffer is sent once it holds batch_size messages, or by a connection.call_later timer
+    once its oldest message has waited linger_ms. Timers and acks are handled while the publisher
+    sends, waits for the window or sleeps, so a producer that waits should use sleep().
+
+    Parameters:
+        host (str): the host name or IP address of the RabbitMQ server
+        batch_size (int): send a queue's buffer once it holds this many messages
+        linger_ms (float): send a queue's buffer once its oldest message has waited this long
+        max_in_flight (int): most messages sent but not yet confirmed by the broker
+        on_confirm (callable): called with {queue name: messages} as messages are confirmed,
+            each queue's messages in the order they were published
+        **kwargs: passed on to PooledPublisher
+    """
+
+    # longest single wait for acks while the window is full
+    confirm_wait = 0.01
+
+    def __init__(self, host: str = "localhost", batch_size: int = 100, linger_ms: float = 50,
+                 max_in_flight: int = 1000, on_confirm=None, **kwargs):
+        super().__init__(host, **kwargs)
+        self.batch_size = batch_size
+        self.linger = linger_ms / 1000
+        self.max_in_flight = max_in_flight
+        self.on_confirm = on_confirm
+        # queue name -> list of (message body, send stamp) waiting to be sent
+        self.buffers = {}
+        # queue name -> monotonic time the oldest buffered message arrived
+        self.first_buffered = {}
+        # the pending call_later timer, None while no buffer is waiting on one
+        self.linger_timer = None
+        # messages taken from the buffers, each a [queue name, body, send stamp, acked] list, to publish in order
+        self.outbox = deque()
+        # delivery tag -> message, for every message published on this channel and not yet confirmed
+        self.unconfirmed = OrderedDict()
+        # queue name -> its published messages in order, until the oldest ones are confirmed
+        self.sent = {}
+        self.confirm_channel = None
+        self.next_tag = 1
+        self.sending = False
+        self.confirmed = 0
+
+    def connect(self):
+        """
+        Open the connection, put the new channel in confirm mode and queue up again
+        whatever the old channel left unconfirmed.
+        """
+        if self.connection is not None and self.connection.is_open and self.channel.is_open:
+            return self.channel
+        super().connect()
+        self.confirm_channel = confirm_channel(self.channel)
+        selected = []
+        self.confirm_channel.confirm_delivery(ack_nack_callback=self.on_delivery_confirmed, callback=selected.append)
+        while not selected:
+            self.connection.process_data_events(time_limit=self.confirm_wait)
+        # delivery tags start again at 1, the unconfirmed messages go out first on the new channel
+        self.next_tag = 1
+        self.outbox.extendleft(reversed(self.unconfirmed.values()))
+        self.unconfirmed.clear()
+        self.arm_linger()
+        return self.channel
+
+    def disconnect(self):
+        """Close the connection, its linger timer goes with it."""
+        super().disconnect()
+        self.linger_timer = None
+
+    def publish(self, queue_name: str, body: bytes):
+        """Buffer one message, sending the queue's batch once it is full."""
+        self.publish_batch(queue_name, [body])
+
+    def publish_batch(self, queue_name: str, bodies: list):
+        """
+        Buffer several messages for one queue at once.
+
+        Parameters:
+            queue_name (str): the name of the queue
+            bodies (list): the message bodies, in the order they should be delivered
+        """
+        buffer = self.buffers.setdefault(queue_name, [])
+        if not buffer:
+            self.first_buffered[queue_name] = time.monotonic()
+        # stamped as they are handed over, so the time spent lingering counts as queue wait
+        buffer.extend((body, self.stamper.stamp(queue_name)) for body in bodies)
+
+        if len(buffer) >= self.batch_size:
+            self.flush([queue_name])
+        else:
+            self.with_reconnect(self.arm_linger, f"Publish to {queue_name}")
+
+    def arm_linger(self):
+        """Start the timer for the oldest buffered message, unless one is running already."""
+        if self.linger_timer is None and self.first_buffered and self.connection is not None:
+            delay = max(min(self.first_buffered.values()) + self.linger - time.monotonic(), 0)
+            self.linger_timer = self.connection.call_later(delay, self.on_linger)
+
+    def on_linger(self):
+        """Timer callback: send the batches whose oldest message has waited longer than linger_ms."""
+        self.linger_timer = None
+        now = time.monotonic()
+        self.flush([queue_name for queue_name, first in self.first_buffered.items()
+                    if now - first >= self.linger])
+
+    def flush(self, queue_names: list = None):
+        """
+        Send the buffered messages for the given queues (all queues by default), without waiting
+        for the broker to confirm them. Messages on one channel reach the broker in the order they
+        were sent, whether or not they are confirmed yet.
+        """
+        for queue_name in (list(self.buffers) if queue_names is None else queue_names):
+            buffer = self.buffers.pop(queue_name, None)
+            if not buffer:
+                continue
+            del self.first_buffered[queue_name]
+            messages = [[queue_name, body, properties, False] for body, properties in buffer]
+            self.sent.setdefault(queue_name, deque()).extend(messages)
+            self.outbox.extend(messages)
+        # a timer that fires while the outbox is being sent only adds to it
+        if self.outbox and not self.sending:
+            self.with_reconnect(self.send, f"Batch of {len(self.outbox)}")
+        self.arm_linger()
+
+    def send(self):
+        """Publish the outbox in order, waiting for acks whenever max_in_flight messages are unconfirmed."""
+        self.sending = True
+        try:
+            while self.outbox:
+                while len(self.unconfirmed) >= self.max_in_flight:
+                    self.connection.process_data_events(time_limit=self.confirm_wait)
+                message = self.outbox[0]
+                self.declare(message[0])
+                self.publish_message(message)
+                self.outbox.popleft()
+            # hand the messages to the socket and take whatever acks have arrived
+            self.connection.process_data_events(time_limit=0)
+        finally:
+            self.sending = False
+
+    def publish_message(self, message: list):
+        """Publish one message on the confirm channel under the next delivery tag."""
+        queue_name, body, properties, _ = message
+        self.confirm_channel.basic_publish(exchange="", routing_key=queue_name, body=body, properties=properties)
+        self.unconfirmed[self.next_tag] = message
+        self.next_tag += 1
+
+    def on_delivery_confirmed(self, frame):
+        """
+        Ack/Nack callback of the confirm channel. An ack confirms one delivery tag, or every tag up to it
+        with multiple=True, a nacked message is published again.
+        """
+        method = frame.method
+        if method.multiple:
+            tags = list(itertools.takewhile(lambda tag: tag <= method.delivery_tag, self.unconfirmed))
+        else:
+            tags = [method.delivery_tag] if method.delivery_tag in self.unconfirmed else []
+        messages = [self.unconfirmed.pop(tag) for tag in tags]
+        if isinstance(method, pika.spec.Basic.Nack):
+            self.logger.warning(f"Broker rejected {len(messages)} messages, sending them again")
+            for message in messages:
+                self.publish_message(message)
+            return
+        for message in messages:
+            message[3] = True
+
+        # report each queue's confirmed messages only up to its oldest unconfirmed one,
+        # so on_confirm always counts from the start of what was sent
+        confirmed = {}
+        for queue_name, sent in self.sent.items():
+            count = 0
+            while sent and sent[0][3]:
+                sent.popleft()
+                count += 1
+            if count:
+                confirmed[queue_name] = count
+        if confirmed:
+            self.confirmed += sum(confirmed.values())
+            if self.on_confirm is not None:
+                self.on_confirm(confirmed)
+
+    def with_reconnect(self, action, what: str):
+        """
+        Run action on an open connection. On a lost connection the messages the broker has not
+        confirmed are sent again on a new channel, see connect.
+        """
+        attempt = 0
+        while True:
+            try:
+                self.connect()
+                return action()
+            except RECONNECT_ERRORS as e:
+                attempt += 1
+                self.logger.warning(f"{what} failed ({e}), reconnect attempt {attempt}")
+                self.disconnect()
+                if attempt > self.retries:
+                    raise
+                time.sleep(self.retry_delay)
+
+    def sleep(self, seconds: float):
+        """Wait on the connection, so acks and linger timers are handled meanwhile, instead of time.sleep."""
+        deadline = time.monotonic() + seconds
+        self.with_reconnect(lambda: self.connection.sleep(max(deadline - time.monotonic(), 0)), "Sleep")
+
+    def wait_for_confirms(self):
+        """Wait until the broker has confirmed every message sent."""
+        while self.outbox or self.unconfirmed:
+            self.with_reconnect(self.confirm_step, "Waiting for confirms")
+
+    def confirm_step(self):
+        """Send the outbox, which a reconnect refills with the unconfirmed messages, or wait for acks."""
+        if self.outbox:
+            self.send()
+        else:
+            self.connection.process_data_events(time_limit=self.confirm_wait)
+
+    def close(self):
+        """Send whatever is still buffered, wait for the broker to confirm it, then close the connection."""
+        if self.buffers or self.outbox or self.unconfirmed:
+            self.flush()
+            self.wait_for_confirms()
+        self.disconnect()
+
+
+def get_publisher(host: str = "localhost") -> PooledPublisher:
+    """
+    Return the publisher shared by this process for a host.
+    A forked child gets its own publisher, connections are never shared across processes.
+    """
+    key = (os.getpid(), host)
+    if key not in _publishers:
+        _publishers[key] = PooledPublisher(host)
+    return _publishers[key]
+
+
+def close_publishers():
+    """Close every publisher opened by this process."""
+    pid = os.getpid()
+    for key in [key for key in _publishers if key[0] == pid]:
+        _publishers.pop(key).close()
+
+
+# make sure buffered frames are flushed and the connection is closed cleanly on exit
+atexit.register(close_publishers)
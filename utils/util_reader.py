@@ -0,0 +1,256 @@
+"""
+Streaming columnar reader for the MTA CSV files.
+
+Instead of every producer indexing row[0..12] by hand and calling int() row by row, this
+reader streams a CSV in chunks and turns each chunk into typed NumPy column arrays:
+
+1. Integer columns (ids, ridership, transfers) become int32/int64 arrays.
+2. latitude and longitude become float64 arrays.
+3. Repeated strings (station names, fare classes, Line, ...) are dictionary encoded,
+   the column holds integer codes and a Dictionary shared by every chunk holds the strings.
+   Codes never change during a read, so a code means the same string in every chunk.
+4. Numbers written with a thousands separator ("1,031") are read as plain integers, empty cells as 0.
+5. transit_timestamp becomes int64 Unix seconds, format_timestamp turns it back into the CSV text.
+6. With start and/or end only the rows with start <= transit_timestamp < end are read. The sparse
+   index in util_index.py gives their byte range and only those bytes of the memory mapped file are parsed.
+
+The file is opened with utf-8-sig so the byte order mark at the start of the header is dropped,
+and the csv module handles quoted station names that contain commas, e.g. "Queensboro Plaza (7,N,W)".
+
+Usage:
+
+    from utils.util_reader import read_subway
+    for chunk in read_subway('MTA_SubwayW1Feb22.csv'):
+        ridership = chunk['ridership']          # numpy int64 array
+        for subway_data in chunk.rows():        # or one dict per row
+            ...
+    for chunk in read_subway('MTA_SubwayW1Feb22.csv', start=parse_timestamp('02/03/22 17:00:00')):
+        ...
+
+"""
+
+import csv
+import mmap
+from itertools import islice
+
+import numpy as np
+
+from utils.util_index import time_index
+from utils.util_replay import format_timestamp, parse_timestamp
+
+# Column types for MTA_SubwayW1Feb22.csv
+SUBWAY_SCHEMA = {
+    'transit_timestamp': 'timestamp',
+    'transit_mode': 'category',
+    'station_complex_id': 'int32',
+    'station_complex': 'category',
+    'Line': 'category',
+    'borough': 'category',
+    'payment_method': 'category',
+    'fare_class_category': 'category',
+    'ridership': 'int64',
+    'transfers': 'int64',
+    'latitude': 'float64',
+    'longitude': 'float64',
+    'Georeference': 'category',
+}
+
+# Number of rows turned into arrays at a time
+DEFAULT_CHUNK_SIZE = 4096
+
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+def parse_int(text: str) -> int:
+    """
+    int() that also accepts the quoted thousands separators in the ridership column, e.g. "1,031".
+    An empty cell (a station with no riders recorded that hour in Data_MTAAlerts.csv) reads as 0.
+    """
+    try:
+        return int(text)
+    except ValueError:
+        return int(text.replace(',', '') or 0)
+
+
+def alerts_schema(header: list) -> dict:
+    """Column types for Data_MTAAlerts.csv: a timestamp followed by one ridership column per station."""
+    schema = {header[0]: 'timestamp'}
+    for name in header[1:]:
+        schema[name] = 'int64'
+    return schema
+
+
+class Dictionary:
+    """Maps repeated strings to small integer codes and back."""
+
+    def __init__(self, values: list = None):
+        self.values = []
+        self.codes = {}
+        for value in values or []:
+            self.encode(value)
+
+    def encode(self, value: str) -> int:
+        """Return the code for a string, adding it if it has not been seen before."""
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+    def decode(self, code: int) -> str:
+        """Return the string for a code."""
+        return self.values[code]
+
+    def __len__(self):
+        return len(self.values)
+
+
+class ColumnChunk:
+    """
+    A block of rows held as one NumPy array per column.
+
+    Parameters:
+        columns (dict): column name -> numpy array, all the same length
+        schema (dict): column name -> column type
+        dictionaries (dict): column name -> Dictionary for the category columns
+    """
+
+    def __init__(self, columns: dict, schema: dict, dictionaries: dict):
+        self.columns = columns
+        self.schema = schema
+        self.dictionaries = dictionaries
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def decoded(self, name: str) -> list:
+        """Return a column as Python values, strings for category columns and timestamps."""
+        kind = self.schema[name]
+        column = self.columns[name]
+        if kind == 'category':
+            values = self.dictionaries[name].values
+            return [values[code] for code in column.tolist()]
+        if kind == 'timestamp':
+            return [format_timestamp(seconds) for seconds in column.tolist()]
+        return column.tolist()
+
+    def rows(self):
+        """Yield each row as a dict keyed by column name, with the same values as the CSV."""
+        names = list(self.columns)
+        for values in zip(*(self.decoded(name) for name in names)):
+            yield dict(zip(names, values))
+
+    def take(self, indices) -> "ColumnChunk":
+        """Return a new chunk holding only the rows at indices (a slice, index array or mask)."""
+        return ColumnChunk({name: column[indices] for name, column in self.columns.items()},
+                           self.schema, self.dictionaries)
+
+
+class ColumnReader:
+    """
+    Streams a CSV file as ColumnChunks.
+
+    Parameters:
+        path (str): the CSV file to read
+        schema (dict or callable): column name -> type, or a function building it from the header.
+            Types are int32, int64, float64, category and timestamp. Unknown columns are category.
+        chunk_size (int): rows per chunk
+        start, end (float): optional, read only rows with start <= transit_timestamp < end (Unix seconds),
+            transit_timestamp being the first column
+    """
+
+    def __init__(self, path: str, schema=SUBWAY_SCHEMA, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 start: float = None, end: float = None):
+        self.path = path
+        self.schema = schema
+        self.chunk_size = chunk_size
+        self.start = start
+        self.end = end
+        # one Dictionary per category column, shared by all chunks of this reader
+        self.dictionaries = {}
+        self.header = None
+        self.rows_read = 0
+        # row number in the file (0 is the first row after the header) of the first row read,
+        # and of the first row of the chunk last yielded
+        self.first_row = 0
+        self.chunk_row = 0
+
+    def __iter__(self):
+        with open(self.path, 'r', newline='', encoding='utf-8-sig') as input_file:
+            reader = csv.reader(input_file)
+            self.header = next(reader)
+            schema = self.schema(self.header) if callable(self.schema) else self.schema
+            schema = {name: schema.get(name, 'category') for name in self.header}
+            for name, kind in schema.items():
+                if kind == 'category':
+                    self.dictionaries.setdefault(name, Dictionary())
+            ranged = self.start is not None or self.end is not None
+            if ranged:
+                reader = csv.reader(self.range_lines())
+
+            while True:
+                rows = list(islice(reader, self.chunk_size))
+                if not rows:
+                    break
+                self.chunk_row = self.first_row + self.rows_read
+                self.rows_read += len(rows)
+                chunk = self.build_chunk(rows, schema)
+                if ranged:
+                    # the byte range is whole timestamps, this only drops rows of an unsorted file
+                    timestamps = chunk[self.header[0]]
+                    keep = np.ones(len(chunk), dtype=bool)
+                    if self.start is not None:
+                        keep &= timestamps >= self.start
+                    if self.end is not None:
+                        keep &= timestamps < self.end
+                    if not keep.all():
+                        chunk = chunk.take(keep)
+                    if not len(chunk):
+                        continue
+                yield chunk
+
+    def range_lines(self):
+        """Yield the text lines of the rows in [start, end), read from the memory mapped file."""
+        index = time_index(self.path)
+        first, last = index.byte_range(self.start, self.end)
+        if last <= first:
+            return
+        if index.is_sorted and self.start is not None:
+            self.first_row = index.position(self.start)[1]
+        with open(self.path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            mapped.seek(first)
+            while mapped.tell() < last:
+                yield mapped.readline().decode('utf-8')
+
+    def build_chunk(self, rows: list, schema: dict) -> ColumnChunk:
+        """Transpose a list of CSV rows into typed column arrays."""
+        count = len(rows)
+        columns = {}
+        for (name, kind), values in zip(schema.items(), zip(*rows)):
+            if kind == 'category':
+                encode = self.dictionaries[name].encode
+                columns[name] = np.fromiter(map(encode, values), dtype=np.int32, count=count)
+            elif kind == 'timestamp':
+                columns[name] = np.fromiter(map(parse_timestamp, values), dtype=np.int64, count=count)
+            elif kind == 'float64':
+                columns[name] = np.fromiter(map(float, values), dtype=np.float64, count=count)
+            else:
+                columns[name] = np.fromiter(map(parse_int, values), dtype=kind, count=count)
+        return ColumnChunk(columns, schema, self.dictionaries)
+
+
+def read_subway(path: str = 'MTA_SubwayW1Feb22.csv', chunk_size: int = DEFAULT_CHUNK_SIZE,
+                start: float = None, end: float = None) -> ColumnReader:
+    """Reader for the hourly ridership file used by ProducerV1 and ProducerV2."""
+    return ColumnReader(path, SUBWAY_SCHEMA, chunk_size, start, end)
+
+
+def read_alerts(path: str = 'Data_MTAAlerts.csv', chunk_size: int = DEFAULT_CHUNK_SIZE,
+                start: float = None, end: float = None) -> ColumnReader:
+    """Reader for the per station ridership file used by ProducerV3."""
+    return ColumnReader(path, alerts_schema, chunk_size, start, end)
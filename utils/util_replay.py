@@ -0,0 +1,119 @@
+"""
+Replay speed control for the producers.
+
+The producers used to call time.sleep(60) (or 10) at fixed points in main to simulate the
+passing of an hour. This module paces a replay by the transit_timestamp of each row instead:
+
+1. speed = 1 replays in real time, an hour of data takes an hour.
+2. speed = 3600 replays an hour of data every second.
+3. speed = None (or "max") sends everything as fast as possible.
+
+The first event timestamp is anchored to a time.monotonic() reading and every later event is
+scheduled relative to that anchor, so rounding in individual sleeps never adds up to drift
+over a long replay and wall clock changes do not affect the pace.
+"""
+
+import time
+from datetime import datetime
+
+# Format of transit_timestamp in MTA_SubwayW1Feb22.csv and Data_MTAAlerts.csv, e.g. 02/01/22 0:00:00
+TIMESTAMP_FORMAT = "%m/%d/%y %H:%M:%S"
+
+# The same few hundred timestamps repeat on every row, strptime is only called once for each.
+_parsed_timestamps = {}
+_formatted_timestamps = {}
+
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+def parse_timestamp(transit_timestamp: str) -> float:
+    """Convert a transit_timestamp string into Unix seconds."""
+    seconds = _parsed_timestamps.get(transit_timestamp)
+    if seconds is None:
+        seconds = datetime.strptime(transit_timestamp, TIMESTAMP_FORMAT).timestamp()
+        _parsed_timestamps[transit_timestamp] = seconds
+    return seconds
+
+
+def format_timestamp(seconds) -> str:
+    """Turn Unix seconds back into the transit_timestamp text used in the CSVs, e.g. 02/01/22 0:00:00"""
+    seconds = int(seconds)
+    text = _formatted_timestamps.get(seconds)
+    if text is None:
+        moment = datetime.fromtimestamp(seconds)
+        text = f"{moment:%m/%d/%y} {moment.hour}:{moment:%M:%S}"
+        _formatted_timestamps[seconds] = text
+    return text
+
+
+def parse_speed(text: str):
+    """
+    Read a replay speed from the command line.
+    "max" (or 0) means as fast as possible, "realtime" means 1, anything else is a multiplier.
+    """
+    text = str(text).strip().lower()
+    if text in ("max", "fast", "none", "0"):
+        return None
+    if text in ("realtime", "real", "1x"):
+        return 1.0
+    speed = float(text.rstrip("x"))
+    if speed < 0:
+        raise ValueError(f"Replay speed must be positive, got {text}")
+    return speed or None
+
+
+class ReplayClock:
+    """
+    Paces a replay so that events are sent at speed times the rate they happened.
+
+    Parameters:
+        speed (float): replay multiplier, 1 for real time, None to send as fast as possible
+    """
+
+    def __init__(self, speed: float = 1.0):
+        self.speed = speed or None
+        # (event seconds, monotonic seconds) of the first event
+        self.anchor = None
+        # seconds the replay has fallen behind schedule, for logging
+        self.lag = 0.0
+
+    def wait_until(self, event_time, sleep=time.sleep):
+        """
+        Sleep until the event with this timestamp is due.
+
+        Parameters:
+            event_time (str or float): a transit_timestamp string or Unix seconds
+            sleep (callable): how to wait, e.g. BatchPublisher.sleep to keep its connection busy meanwhile
+        """
+        delay = self.delay(event_time)
+        if delay > 0:
+            sleep(delay)
+
+    def delay(self, event_time) -> float:
+        """
+        Seconds until the event with this timestamp is due, without sleeping.
+        Used directly by the asyncio producer, which awaits asyncio.sleep(delay) instead.
+        """
+        if self.speed is None:
+            return 0.0
+        if isinstance(event_time, str):
+            event_time = parse_timestamp(event_time)
+        now = time.monotonic()
+        if self.anchor is None:
+            self.anchor = (event_time, now)
+            return 0.0
+        first_event, first_monotonic = self.anchor
+        due = first_monotonic + (event_time - first_event) / self.speed
+        delay = due - now
+        if delay > 0:
+            self.lag = 0.0
+            return delay
+        # behind schedule: send straight away and let the next events catch up
+        self.lag = -delay
+        return 0.0
+
+    def reset(self):
+        """Forget the anchor, the next event starts a new schedule."""
+        self.anchor = None
+        self.lag = 0.0
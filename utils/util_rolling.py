@@ -0,0 +1,225 @@
+"""
+O(1) rolling statistics for a station's window.
+
+The alert check in ConsumeV3 only compared the oldest and newest reading. RollingStats keeps the
+sum, mean, variance, min and max of everything currently in the window, each updated in constant
+time per reading so the cost per message does not grow with the window length:
+
+1. sum and mean: a running sum, plus on add and minus on evict.
+2. variance: Welford's method, with the matching update for removing the oldest value.
+3. min and max: monotonic deques. Each value is pushed and popped at most once,
+   so both are amortized O(1).
+
+Readings leave the window oldest first, either automatically (maxlen, a count based window)
+or when the caller evicts them (a time based window).
+
+EventTimeWindow is the time based window: "the last N seconds by transit_timestamp" instead of
+"the last N readings", so a missing hour or a duplicate cannot stretch or squeeze the window.
+
+1. Readings are held back until the watermark (the newest timestamp seen minus the allowed
+   lateness) passes them, so readings up to allowed_lateness seconds out of order are put back
+   in timestamp order. Readings older than the watermark, and duplicates, are dropped and counted.
+2. Released readings go into a RollingStats and readings older than the window are evicted from
+   the front. Each reading is evicted once, so eviction is amortized O(1) per message.
+"""
+
+import heapq
+import math
+from collections import deque
+
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+class RollingStats:
+    """
+    Rolling sum, mean, variance, min and max over a first in first out window.
+
+    Parameters:
+        maxlen (int): evict the oldest reading once the window holds this many, None to evict by hand
+    """
+
+    def __init__(self, maxlen: int = None):
+        self.maxlen = maxlen
+        self.items = deque()
+        self.total = 0.0
+        self.mean = 0.0
+        # sum of squared differences from the mean (Welford's M2)
+        self.m2 = 0.0
+        # (sequence number, value) pairs, values increasing in min_deque and decreasing in max_deque
+        self.min_deque = deque()
+        self.max_deque = deque()
+        # sequence number of the next reading added, and of the oldest reading still held
+        self.added = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, value):
+        """Add the newest reading, evicting the oldest first if the window is full."""
+        if self.maxlen is not None and len(self.items) >= self.maxlen:
+            self.evict()
+        self.items.append(value)
+        self.total += value
+
+        # Welford's update for one more value
+        count = len(self.items)
+        delta = value - self.mean
+        self.mean += delta / count
+        self.m2 += delta * (value - self.mean)
+
+        # drop the values this one makes irrelevant, they can never be the min/max again
+        sequence = self.added
+        while self.min_deque and self.min_deque[-1][1] >= value:
+            self.min_deque.pop()
+        self.min_deque.append((sequence, value))
+        while self.max_deque and self.max_deque[-1][1] <= value:
+            self.max_deque.pop()
+        self.max_deque.append((sequence, value))
+        self.added += 1
+
+    def evict(self):
+        """Remove the oldest reading and return it."""
+        value = self.items.popleft()
+        self.total -= value
+
+        # Welford's update run backwards to remove one value
+        count = len(self.items)
+        if count == 0:
+            self.mean = 0.0
+            self.m2 = 0.0
+        else:
+            delta = value - self.mean
+            self.mean -= delta / count
+            self.m2 -= delta * (value - self.mean)
+            # rounding can leave a tiny negative number when every value is equal
+            self.m2 = max(self.m2, 0.0)
+
+        sequence = self.evicted
+        if self.min_deque and self.min_deque[0][0] == sequence:
+            self.min_deque.popleft()
+        if self.max_deque and self.max_deque[0][0] == sequence:
+            self.max_deque.popleft()
+        self.evicted += 1
+        return value
+
+    @property
+    def oldest(self):
+        return self.items[0] if self.items else None
+
+    @property
+    def newest(self):
+        return self.items[-1] if self.items else None
+
+    @property
+    def variance(self) -> float:
+        """Sample variance of the window, 0 with fewer than two readings."""
+        count = len(self.items)
+        return self.m2 / (count - 1) if count > 1 else 0.0
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.variance)
+
+    @property
+    def min(self):
+        return self.min_deque[0][1] if self.min_deque else None
+
+    @property
+    def max(self):
+        return self.max_deque[0][1] if self.max_deque else None
+
+    def zscore(self, value) -> float:
+        """How many standard deviations value is from the window mean, 0 if the window has no spread."""
+        std = self.std
+        return (value - self.mean) / std if std > 0 else 0.0
+
+    def summary(self) -> dict:
+        """Every statistic at once, for logging."""
+        return {'count': len(self.items), 'sum': self.total, 'mean': self.mean, 'std': self.std,
+                'min': self.min, 'max': self.max}
+
+
+class EventTimeWindow:
+    """
+    A window over the last span seconds of event time, with a watermark for out of order readings.
+
+    Parameters:
+        span (int): window length in seconds, a reading is held while newest - span < timestamp
+        allowed_lateness (int): how many seconds behind the newest reading a reading may arrive and still count
+    """
+
+    def __init__(self, span: int, allowed_lateness: int = 0):
+        self.span = span
+        self.allowed_lateness = allowed_lateness
+        self.stats = RollingStats()
+        self.times = deque()
+        # timestamp of the first reading put into the window
+        self.first = None
+        # readings waiting for the watermark, a heap of (timestamp, value)
+        self.pending = []
+        # newest timestamp seen and newest timestamp released into the window
+        self.max_seen = None
+        self.released = None
+        # readings dropped for arriving at or before the newest released timestamp:
+        # duplicates repeat that exact timestamp, late counts the rest
+        self.late = 0
+        self.duplicates = 0
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def full(self) -> bool:
+        """True once the window spans its whole length, span seconds after the first reading."""
+        return self.first is not None and self.times[-1] - self.first >= self.span
+
+    @property
+    def watermark(self):
+        """Readings at or before this timestamp are final, None until the first reading."""
+        return None if self.max_seen is None else self.max_seen - self.allowed_lateness
+
+    def push(self, timestamp: int, value) -> list:
+        """
+        Take one reading in arrival order and return the (timestamp, value) readings the watermark
+        has released, oldest first. The caller puts each of them into the window with append.
+        """
+        if self.released is not None and timestamp <= self.released:
+            if timestamp == self.released:
+                self.duplicates += 1
+            else:
+                self.late += 1
+            return []
+        if self.max_seen is None or timestamp > self.max_seen:
+            self.max_seen = timestamp
+        heapq.heappush(self.pending, (timestamp, value))
+        return self.release(self.watermark)
+
+    def release(self, watermark) -> list:
+        """Take every pending reading at or before watermark off the heap, oldest first."""
+        released = []
+        while self.pending and self.pending[0][0] <= watermark:
+            timestamp, value = heapq.heappop(self.pending)
+            if timestamp == self.released:
+                # the same timestamp arrived twice while both were pending
+                self.duplicates += 1
+                continue
+            self.released = timestamp
+            released.append((timestamp, value))
+        return released
+
+    def flush(self) -> list:
+        """Release every pending reading, e.g. at shutdown when no later reading will move the watermark."""
+        return self.release(self.max_seen) if self.pending else []
+
+    def append(self, timestamp: int, value):
+        """Put a released reading into the window and evict what has fallen out of it."""
+        if self.first is None:
+            self.first = timestamp
+        self.times.append(timestamp)
+        self.stats.add(value)
+        # evict from the front, every reading is evicted at most once
+        while self.times[0] <= timestamp - self.span:
+            self.times.popleft()
+            self.stats.evict()
@@ -0,0 +1,130 @@
+"""
+Streaming hourly rollup of ridership per station.
+
+Data_MTAAlerts.csv, the input of ProducerV3, holds ridership summed per station per hour and
+was made by hand from the output of the line consumers. HourlyRollup builds the same sums from
+the record stream as it arrives:
+
+1. Records are added a RECORDS message at a time (see utils/util_wire.py). Each batch is grouped
+   by (hour, station) in one vectorized step and the sums are added to a hash table:
+   hour -> {station id: [ridership, transfers]}.
+2. Every source (a line queue) has its own watermark, the newest transit_timestamp it has sent
+   minus allowed_lateness. An hour is closed once every source's watermark has passed its end,
+   so the records of a line queue that is a little behind the others are not dropped.
+   A source with gaps (a Line without riders for a few hours) would hold every hour open until it
+   sends again, the caller marks a source that has gone quiet with quiet(source) and it stops
+   holding back the watermark until its next record.
+3. close_ready() takes the closed hours out of the table, oldest first. Records that arrive for
+   an hour that is already closed are counted in late and dropped.
+4. Memory stays bounded: only open hours are held, and when more than max_open_hours are open the
+   oldest is closed anyway (counted in forced). close_all() closes everything, for the end of a
+   stream or a source that has gone quiet.
+
+"""
+
+import numpy as np
+
+HOUR = 3600
+
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+class HourlyRollup:
+    """
+    Ridership and transfer sums per (hour, station) for the hours that are still open.
+
+    Parameters:
+        sources (list): names of the sources records come from, every one holds back the watermark
+        allowed_lateness (int): seconds a record may be behind the newest of its source and still count
+        max_open_hours (int): most hours held at once, the oldest is closed when there are more
+    """
+
+    def __init__(self, sources: list, allowed_lateness: int = 0, max_open_hours: int = 48):
+        self.allowed_lateness = allowed_lateness
+        self.max_open_hours = max_open_hours
+        # source -> newest transit_timestamp it has sent, None until its first record
+        self.newest = {source: None for source in sources}
+        # sources that do not hold back the watermark until they send again
+        self.quiet_sources = set()
+        # hour (Unix seconds) -> {station id: [ridership, transfers]}
+        self.table = {}
+        # hours before this one are closed
+        self.closed_through = None
+        self.records = 0
+        self.late = 0
+        self.forced = 0
+
+    def watermark(self):
+        """Hours ending at or before this are complete, None until every source has sent a record or gone quiet."""
+        active = [newest for source, newest in self.newest.items() if source not in self.quiet_sources]
+        if not active or None in active:
+            return None
+        return min(active) - self.allowed_lateness
+
+    def quiet(self, source: str):
+        """Stop waiting for source until it sends again."""
+        self.quiet_sources.add(source)
+
+    def add(self, source: str, timestamps, station_ids, ridership, transfers):
+        """Add a batch of records from source, arrays of equal length in any order."""
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        if not len(timestamps):
+            return
+        self.quiet_sources.discard(source)
+        newest = int(timestamps.max())
+        if self.newest.get(source) is None or newest > self.newest[source]:
+            self.newest[source] = newest
+        self.records += len(timestamps)
+
+        hours = timestamps - timestamps % HOUR
+        station_ids = np.asarray(station_ids, dtype=np.int64)
+        ridership = np.asarray(ridership, dtype=np.int64)
+        transfers = np.asarray(transfers, dtype=np.int64)
+        if self.closed_through is not None:
+            keep = hours >= self.closed_through
+            if not keep.all():
+                self.late += int(len(keep) - keep.sum())
+                hours, station_ids, ridership, transfers = hours[keep], station_ids[keep], ridership[keep], transfers[keep]
+                if not len(hours):
+                    return
+
+        # one group per (hour, station), summed with bincount instead of a Python loop over records
+        unique_hours, hour_codes = np.unique(hours, return_inverse=True)
+        unique_stations, station_codes = np.unique(station_ids, return_inverse=True)
+        codes = hour_codes * len(unique_stations) + station_codes
+        size = len(unique_hours) * len(unique_stations)
+        counts = np.bincount(codes, minlength=size)
+        ridership_sums = np.bincount(codes, weights=ridership, minlength=size)
+        transfer_sums = np.bincount(codes, weights=transfers, minlength=size)
+        for code in np.flatnonzero(counts).tolist():
+            hour = int(unique_hours[code // len(unique_stations)])
+            station_id = int(unique_stations[code % len(unique_stations)])
+            sums = self.table.setdefault(hour, {}).setdefault(station_id, [0, 0])
+            sums[0] += int(ridership_sums[code])
+            sums[1] += int(transfer_sums[code])
+
+    def close_hour(self, hour: int) -> tuple:
+        """Take one hour out of the table, returns (hour, {station id: (ridership, transfers)})."""
+        stations = self.table.pop(hour)
+        self.closed_through = max(self.closed_through or 0, hour + HOUR)
+        return hour, {station_id: tuple(sums) for station_id, sums in stations.items()}
+
+    def close_ready(self) -> list:
+        """Close every hour the watermark has passed, and the oldest ones past max_open_hours, oldest first."""
+        watermark = self.watermark()
+        closed = []
+        while self.table:
+            hour = min(self.table)
+            if watermark is not None and hour + HOUR <= watermark:
+                closed.append(self.close_hour(hour))
+            elif len(self.table) > self.max_open_hours:
+                self.forced += 1
+                closed.append(self.close_hour(hour))
+            else:
+                break
+        return closed
+
+    def close_all(self) -> list:
+        """Close every open hour, oldest first."""
+        return [self.close_hour(hour) for hour in sorted(self.table)]
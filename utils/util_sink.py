@@ -0,0 +1,123 @@
+"""
+Buffered CSV output for the line consumers.
+
+The V2 line consumers used to open their CSV in append mode, build a new csv.DictWriter, check
+file.tell() for the header and write a single row, on every record of every message. CsvSink
+opens the file once for the life of the consumer and buffers rows instead:
+
+1. Rows are written with one writerows call when the buffer holds max_rows rows or max_messages
+   messages, when the oldest buffered row is max_delay seconds old, or when the sink is closed.
+2. Each buffered message keeps its delivery tag. A flush returns the tags of the messages it wrote,
+   and the consumer acks only those, so a message is never acked before its rows reach the file
+   (at least once delivery: after a crash the unacked messages are redelivered).
+3. The header is written once, when the file is empty, as before.
+4. Rows may also arrive already formatted as CSV text (add_text), e.g. from the worker pool in
+   utils/util_pool.py. Text and rows are written in the order they were added.
+
+"""
+
+import csv
+import os
+import time
+
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+class CsvSink:
+    """
+    A CSV file that stays open and takes rows a message at a time.
+
+    Parameters:
+        path (str): the CSV file, appended to
+        fieldnames (list): the column headers
+        max_rows (int): flush once this many rows are buffered
+        max_messages (int): flush once this many messages are buffered, keep it at or below the prefetch count
+        max_delay (float): seconds a row may wait in the buffer before poll flushes it
+        fsync (bool): also ask the OS to write the file to disk before the messages are acked
+        logger: optional logger for a line per flush
+    """
+
+    def __init__(self, path: str, fieldnames: list, max_rows: int = 1000, max_messages: int = 100,
+                 max_delay: float = 1.0, fsync: bool = False, logger=None):
+        self.path = path
+        self.max_rows = max_rows
+        self.max_messages = max_messages
+        self.max_delay = max_delay
+        self.fsync = fsync
+        self.logger = logger
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=fieldnames)
+        if self.file.tell() == 0:
+            self.writer.writeheader()
+        # buffered lists of rows and pieces of CSV text, in the order they were added
+        self.pieces = []
+        self.buffered_rows = 0
+        self.delivery_tags = []
+        # time.monotonic() when the oldest buffered message arrived
+        self.first_buffered = None
+        self.rows_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, rows: list, delivery_tag=None) -> list:
+        """
+        Buffer the rows of one message.
+        Returns the delivery tags that are now safe to ack, empty unless this triggered a flush.
+        """
+        return self.buffer(rows, len(rows), delivery_tag)
+
+    def add_text(self, text: str, row_count: int, delivery_tag=None) -> list:
+        """Buffer rows of one message that are already formatted as CSV text, see add."""
+        return self.buffer(text, row_count, delivery_tag)
+
+    def buffer(self, piece, row_count: int, delivery_tag) -> list:
+        """Buffer a list of rows or a piece of CSV text and flush if the buffer is full."""
+        if not self.delivery_tags:
+            self.first_buffered = time.monotonic()
+        if row_count:
+            self.pieces.append(piece)
+            self.buffered_rows += row_count
+        if delivery_tag is not None:
+            self.delivery_tags.append(delivery_tag)
+        if self.buffered_rows >= self.max_rows or len(self.delivery_tags) >= self.max_messages:
+            return self.flush()
+        return []
+
+    def poll(self) -> list:
+        """Flush if the oldest buffered message has waited max_delay seconds, returns the tags to ack."""
+        if self.first_buffered is not None and time.monotonic() - self.first_buffered >= self.max_delay:
+            return self.flush()
+        return []
+
+    def flush(self) -> list:
+        """Write every buffered row and return the delivery tags of the messages they came from."""
+        for piece in self.pieces:
+            if isinstance(piece, str):
+                self.file.write(piece)
+            else:
+                self.writer.writerows(piece)
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        if self.logger and self.buffered_rows:
+            self.logger.info(f"Flushed {self.buffered_rows} rows from {len(self.delivery_tags)} messages to {self.path}")
+        self.rows_written += self.buffered_rows
+        delivery_tags = self.delivery_tags
+        self.pieces = []
+        self.buffered_rows = 0
+        self.delivery_tags = []
+        self.first_buffered = None
+        return delivery_tags
+
+    def close(self) -> list:
+        """Flush and close the file, returns the tags of the last messages written."""
+        if self.file.closed:
+            return []
+        delivery_tags = self.flush()
+        self.file.close()
+        return delivery_tags
@@ -0,0 +1,294 @@
+"""
+Columnar, partitioned output store for the line consumers.
+
+Data_MTA_Line<X>.csv holds 13 text columns per row, including the Georeference WKT string that
+repeats latitude and longitude, and every query has to parse the whole file again. ColumnStore
+keeps the same records as typed NumPy columns instead:
+
+1. Records are partitioned by Line and by the date of their transit_timestamp, and written as
+   append-only segments: one .npy file per column, rows sorted by transit_timestamp.
+2. Numbers keep the types of the wire format (utils/util_wire.py). String columns are stored as
+   their uint16 dictionary codes, with the strings in the segment's dictionaries.json.
+   Georeference is left out, latitude and longitude hold the same point.
+3. Each Line has a small manifest.json listing its segments with their date, row count and first
+   and last transit_timestamp. It is replaced atomically after a segment is written and flushed to
+   disk, so a reader never sees a segment that is half written, even after a crash, and a consumer
+   only writes its own Lines' manifests.
+4. Readers pick the segments of a Line and time range from the manifests and memory map just the
+   columns they ask for. Inside a segment the time range is found with a binary search on the
+   memory mapped transit_timestamp column, nothing else is read.
+
+ColumnSink takes records a message at a time like CsvSink (utils/util_sink.py) and returns the
+delivery tags of the messages whose records are in a written segment, so those are acked.
+
+Layout:
+
+    <root>/line=7/manifest.json
+    <root>/line=7/date=2022-02-01/segment-000001/transit_timestamp.npy, ridership.npy, ..., dictionaries.json
+
+Usage:
+
+    from utils.util_store import ColumnStore
+    store = ColumnStore('Data_MTA_Store')
+    ridership = store.read_column('ridership', line='7', start=parse_timestamp('02/03/22 6:00:00'))
+
+"""
+
+import datetime
+import json
+import os
+import pathlib
+import time
+
+import numpy as np
+
+from utils.util_wire import RECORD_DTYPE, STRING_COLUMNS
+
+# The columns kept, in the order of the wire format
+STORE_COLUMNS = [name for name in RECORD_DTYPE.names if name != 'Georeference']
+STORE_STRING_COLUMNS = [name for name in STRING_COLUMNS if name in STORE_COLUMNS]
+
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+def partition_name(line: str) -> str:
+    """Directory of a Line, e.g. 7 -> line=7. Slashes in a Line name would make a subdirectory."""
+    return 'line=' + line.replace('/', '_')
+
+
+def fsync_directory(path: pathlib.Path):
+    """Flush a directory's entries to disk, so files created or renamed in it survive a crash (POSIX only)."""
+    if os.name != 'posix':
+        return
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def write_json(path: pathlib.Path, payload):
+    """
+    Write a JSON file through a temporary file and os.replace, readers see the old or the new file.
+    The file and the rename are flushed to disk, like util_checkpoint.write_durable.
+    """
+    temporary = path.with_name(path.name + '.tmp')
+    with open(temporary, 'w') as file:
+        json.dump(payload, file, indent=1)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+    fsync_directory(path.parent)
+
+
+class ColumnStore:
+    """
+    The partitioned column files under one directory.
+
+    Parameters:
+        root (str): the store's directory, created when the first segment is written
+    """
+
+    def __init__(self, root: str):
+        self.root = pathlib.Path(root)
+        # Line -> its manifest, loaded when first needed
+        self.manifests = {}
+
+    def manifest(self, line: str) -> dict:
+        """The manifest of one Line, empty if nothing has been written for it."""
+        if line not in self.manifests:
+            path = self.root / partition_name(line) / 'manifest.json'
+            if path.exists():
+                with open(path) as file:
+                    self.manifests[line] = json.load(file)
+            else:
+                self.manifests[line] = {'line': line, 'columns': {}, 'segments': []}
+        return self.manifests[line]
+
+    def lines(self) -> list:
+        """Every Line with a manifest on disk."""
+        lines = []
+        for path in sorted(self.root.glob('line=*/manifest.json')):
+            with open(path) as file:
+                lines.append(json.load(file)['line'])
+        return lines
+
+    def write(self, line: str, records: np.ndarray, dictionaries: dict) -> list:
+        """
+        Write records of one Line (a RECORDS array, see utils/util_wire.py) as one new segment per date.
+        dictionaries are the WireDecoder's dictionaries the string codes refer to.
+        Returns the manifest entries of the new segments.
+        """
+        if not len(records):
+            return []
+        records = records[np.argsort(records['transit_timestamp'], kind='stable')]
+        timestamps = records['transit_timestamp']
+        # the date of every distinct timestamp, in local time like the transit_timestamp text
+        unique_times, first_rows = np.unique(timestamps, return_index=True)
+        dates = [datetime.date.fromtimestamp(int(seconds)).isoformat() for seconds in unique_times.tolist()]
+        strings = {name: dictionaries[name].values for name in STORE_STRING_COLUMNS}
+
+        manifest = self.manifest(line)
+        entries = []
+        # a segment starts wherever the date changes
+        first_rows = first_rows.tolist()
+        starts = [(first_rows[i], dates[i]) for i in range(len(dates)) if i == 0 or dates[i] != dates[i - 1]]
+        ends = [row for row, date in starts[1:]] + [len(records)]
+        for (start, date), end in zip(starts, ends):
+            part = records[start:end]
+            number = len(manifest['segments']) + 1
+            relative = f"{partition_name(line)}/date={date}/segment-{number:06d}"
+            directory = self.root / relative
+            directory.mkdir(parents=True, exist_ok=True)
+            for name in STORE_COLUMNS:
+                with open(directory / f"{name}.npy", 'wb') as file:
+                    np.save(file, np.ascontiguousarray(part[name]))
+                    file.flush()
+                    os.fsync(file.fileno())
+            with open(directory / 'dictionaries.json', 'w') as file:
+                json.dump(strings, file, separators=(',', ':'))
+                file.flush()
+                os.fsync(file.fileno())
+            # the segment's files, and the new segment and date directories, are on disk before the
+            # manifest lists them, the consumer acks the segment's messages once write returns
+            for written in (directory, directory.parent, directory.parent.parent):
+                fsync_directory(written)
+            entry = {'path': relative, 'date': date, 'rows': len(part),
+                     'start': int(part['transit_timestamp'][0]), 'end': int(part['transit_timestamp'][-1])}
+            manifest['segments'].append(entry)
+            entries.append(entry)
+        manifest['columns'] = {name: RECORD_DTYPE[name].str for name in STORE_COLUMNS}
+        write_json(self.root / partition_name(line) / 'manifest.json', manifest)
+        return entries
+
+    def segments(self, line: str = None, start: float = None, end: float = None) -> list:
+        """Manifest entries of the segments holding records of line (every Line if None) in [start, end)."""
+        lines = [line] if line is not None else self.lines()
+        found = []
+        for name in lines:
+            for entry in self.manifest(name)['segments']:
+                if (start is None or entry['end'] >= start) and (end is None or entry['start'] < end):
+                    found.append(entry)
+        return sorted(found, key=lambda entry: (entry['start'], entry['path']))
+
+    def segment_rows(self, entry: dict, start: float = None, end: float = None) -> slice:
+        """The rows of a segment in [start, end), by binary search on its memory mapped timestamps."""
+        if start is None and end is None:
+            return slice(0, entry['rows'])
+        timestamps = np.load(self.root / entry['path'] / 'transit_timestamp.npy', mmap_mode='r')
+        first = 0 if start is None else int(np.searchsorted(timestamps, start, side='left'))
+        last = len(timestamps) if end is None else int(np.searchsorted(timestamps, end, side='left'))
+        return slice(first, last)
+
+    def column_parts(self, name: str, line: str = None, start: float = None, end: float = None) -> list:
+        """Memory mapped slices of one column, one per segment, only these pages are read when used."""
+        if name not in STORE_COLUMNS:
+            raise KeyError(f"{name} is not stored, the columns are {', '.join(STORE_COLUMNS)}")
+        parts = []
+        for entry in self.segments(line, start, end):
+            rows = self.segment_rows(entry, start, end)
+            if rows.stop > rows.start:
+                parts.append(np.load(self.root / entry['path'] / f"{name}.npy", mmap_mode='r')[rows])
+        return parts
+
+    def read_column(self, name: str, line: str = None, start: float = None, end: float = None) -> np.ndarray:
+        """One column for line and the transit_timestamp range [start, end), segment by segment, oldest first."""
+        parts = self.column_parts(name, line, start, end)
+        if not parts:
+            return np.empty(0, dtype=RECORD_DTYPE[name])
+        return np.concatenate(parts)
+
+    def read_strings(self, name: str, line: str = None, start: float = None, end: float = None) -> list:
+        """A string column decoded with each segment's dictionary."""
+        values = []
+        for entry in self.segments(line, start, end):
+            rows = self.segment_rows(entry, start, end)
+            if rows.stop <= rows.start:
+                continue
+            codes = np.load(self.root / entry['path'] / f"{name}.npy", mmap_mode='r')[rows]
+            with open(self.root / entry['path'] / 'dictionaries.json') as file:
+                strings = json.load(file)[name]
+            values.extend(strings[code] for code in codes.tolist())
+        return values
+
+
+class ColumnSink:
+    """
+    Takes one Line's records a message at a time and writes them to a ColumnStore in segments.
+
+    Parameters:
+        store (ColumnStore): where the segments go
+        line (str): the Line of every record added
+        max_rows (int): write a segment once this many records are buffered
+        max_messages (int): write once this many messages are buffered, keep it at or below the prefetch count
+        max_delay (float): seconds a record may wait in the buffer before poll writes it
+        logger: optional logger for a line per write
+    """
+
+    def __init__(self, store: ColumnStore, line: str, max_rows: int = 100000, max_messages: int = 100,
+                 max_delay: float = 1.0, logger=None):
+        self.store = store
+        self.line = line
+        self.path = str(store.root / partition_name(line))
+        self.max_rows = max_rows
+        self.max_messages = max_messages
+        self.max_delay = max_delay
+        self.logger = logger
+        self.parts = []
+        self.buffered_rows = 0
+        self.delivery_tags = []
+        # the dictionaries the buffered codes refer to
+        self.dictionaries = None
+        self.first_buffered = None
+        self.rows_written = 0
+        self.closed = False
+
+    def add_records(self, records: np.ndarray, dictionaries: dict, delivery_tag=None) -> list:
+        """
+        Buffer the records of one message, None for a message without records.
+        Returns the delivery tags that are now safe to ack, empty unless this triggered a write.
+        """
+        delivery_tags = []
+        # codes only mean something with their dictionaries, a new producer run may ship different ones
+        if records is not None and self.dictionaries is not None and dictionaries is not self.dictionaries:
+            delivery_tags.extend(self.flush())
+        if not self.delivery_tags:
+            self.first_buffered = time.monotonic()
+        if records is not None and len(records):
+            self.parts.append(records)
+            self.buffered_rows += len(records)
+            self.dictionaries = dictionaries
+        if delivery_tag is not None:
+            self.delivery_tags.append(delivery_tag)
+        if self.buffered_rows >= self.max_rows or len(self.delivery_tags) >= self.max_messages:
+            delivery_tags.extend(self.flush())
+        return delivery_tags
+
+    def poll(self) -> list:
+        """Write if the oldest buffered message has waited max_delay seconds, returns the tags to ack."""
+        if self.first_buffered is not None and time.monotonic() - self.first_buffered >= self.max_delay:
+            return self.flush()
+        return []
+
+    def flush(self) -> list:
+        """Write every buffered record and return the delivery tags of the messages they came from."""
+        if self.parts:
+            entries = self.store.write(self.line, np.concatenate(self.parts), self.dictionaries)
+            if self.logger:
+                self.logger.info(f"Wrote {self.buffered_rows} rows from {len(self.delivery_tags)} messages "
+                                 f"to {len(entries)} segments in {self.path}")
+        self.rows_written += self.buffered_rows
+        delivery_tags = self.delivery_tags
+        self.parts = []
+        self.buffered_rows = 0
+        self.delivery_tags = []
+        self.first_buffered = None
+        return delivery_tags
+
+    def close(self) -> list:
+        """Write what is buffered, returns the tags of the last messages written."""
+        if self.closed:
+            return []
+        self.closed = True
+        return self.flush()
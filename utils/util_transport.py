@@ -0,0 +1,658 @@
+"""
+Pluggable transport for the producers and consumers: RabbitMQ through pika, or an in-memory broker.
+
+Every producer, consumer and benchmark needs a RabbitMQ server on localhost. open_connection(host)
+picks the transport from the host name instead, so the same code runs without a network:
+
+1. A normal host name ("localhost", "10.0.0.5") opens a pika.BlockingConnection, as before.
+2. "memory://" uses a MemoryBroker inside this process. Producer and consumer can run on
+   different threads, or one after the other, and share the broker's queues.
+3. "memory://127.0.0.1:5673" connects to a MemoryBroker in another process, started with
+   start_broker(address) or from the command line:
+
+       python -m utils.util_transport 127.0.0.1:5673
+
+MemoryConnection and MemoryChannel copy the parts of pika's BlockingConnection and BlockingChannel
+the repo uses (queue_declare, basic_publish, basic_consume, basic_ack, basic_nack, basic_qos,
+basic_get, tx_select/tx_commit, confirm_delivery, call_later, process_data_events), and delivery
+callbacks get the same pika.spec.Basic.Deliver and pika.BasicProperties objects. The broker keeps
+the rules the consumers rely on:
+
+- basic_qos(prefetch_count): a channel holds at most prefetch_count unacknowledged messages.
+- delivery tags count up per channel, and basic_ack(multiple=True) acks every tag up to it.
+- a message that is nacked with requeue, or still unacked when its channel or connection closes,
+  goes back to the front of its queue and is delivered again with redelivered=True.
+- tx_commit publishes the messages of a transaction together, an uncommitted transaction is dropped.
+- in confirm mode with an ack callback, process_data_events acks the messages published since the last ack.
+
+The broker also times every message from being accepted to being acknowledged (take_latencies),
+which benchmarks/bench_pipeline.py reports as publish-to-ack latency.
+
+The asyncio producer and consumer (utils/util_aio.py) still need RabbitMQ.
+"""
+
+import heapq
+import itertools
+import multiprocessing
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from multiprocessing.managers import BaseManager
+
+import pika
+
+MEMORY_SCHEME = "memory://"
+# shared secret of the broker process, it only listens for the producers and consumers of this repo
+AUTHKEY = b"mta-memory-broker"
+
+# the in-process broker, and one proxy per (process id, address) for brokers in other processes
+_local_broker = None
+_remote_brokers = {}
+
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+def open_connection(host: str = "localhost"):
+    """
+    Open a connection to the broker named by host.
+    Returns a pika.BlockingConnection, or a MemoryConnection for a memory:// host.
+    """
+    if host.startswith(MEMORY_SCHEME):
+        return MemoryConnection(get_broker(host))
+    return pika.BlockingConnection(pika.ConnectionParameters(host=host))
+
+
+def is_memory(host: str) -> bool:
+    """True if host names an in-memory broker."""
+    return host.startswith(MEMORY_SCHEME)
+
+
+def confirm_channel(channel):
+    """
+    The channel to turn publisher confirms on with an ack_nack_callback, and to publish on without waiting.
+
+    pika's BlockingChannel.confirm_delivery() takes no callback and makes every basic_publish wait for
+    its ack. The asynchronous pika.channel.Channel underneath it does both, but BlockingChannel keeps
+    it in the private attribute _impl. This is the one place the repo uses it, checked here so another
+    pika version fails with a clear error instead of somewhere inside the publisher. requirements.txt
+    pins the pika version this was written against. A MemoryChannel supports both itself.
+    """
+    if isinstance(channel, MemoryChannel):
+        return channel
+    impl = getattr(channel, '_impl', None)
+    if not isinstance(impl, pika.channel.Channel):
+        raise RuntimeError(f"pika {pika.__version__} does not keep the pika.channel.Channel of a BlockingChannel "
+                           f"in _impl, install the version in requirements.txt")
+    return impl
+
+
+def parse_address(address: str) -> tuple:
+    """Turn "host:port" into a (host, port) tuple."""
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def get_broker(host: str = MEMORY_SCHEME):
+    """The MemoryBroker for a memory:// host, in this process or a proxy to the broker process."""
+    global _local_broker
+    address = host[len(MEMORY_SCHEME):].strip("/")
+    if not address:
+        if _local_broker is None:
+            _local_broker = MemoryBroker()
+        return _local_broker
+    # proxies hold a socket, a forked child opens its own
+    key = (multiprocessing.current_process().pid, address)
+    if key not in _remote_brokers:
+        manager = _BrokerClient(address=parse_address(address), authkey=AUTHKEY)
+        try:
+            manager.connect()
+        except OSError as e:
+            raise pika.exceptions.AMQPConnectionError(f"no memory broker on {address}: {e}")
+        _remote_brokers[key] = manager.broker()
+    return _remote_brokers[key]
+
+
+def serve_broker(address: str):
+    """Run a MemoryBroker for other processes on address ("host:port") until the process is stopped."""
+    broker = MemoryBroker()
+    _BrokerServer.register("broker", callable=lambda: broker)
+    manager = _BrokerServer(address=parse_address(address), authkey=AUTHKEY)
+    manager.get_server().serve_forever()
+
+
+def start_broker(address: str, timeout: float = 10.0) -> multiprocessing.Process:
+    """
+    Start serve_broker in a daemon process and wait until it accepts connections.
+    Returns the process, terminate() it to stop the broker.
+    """
+    process = multiprocessing.Process(target=serve_broker, args=(address,), daemon=True)
+    process.start()
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            manager = _BrokerClient(address=parse_address(address), authkey=AUTHKEY)
+            manager.connect()
+            return process
+        except OSError:
+            if time.monotonic() > deadline or not process.is_alive():
+                process.terminate()
+                raise pika.exceptions.AMQPConnectionError(f"memory broker on {address} did not start")
+            time.sleep(0.05)
+
+
+class _BrokerServer(BaseManager):
+    pass
+
+
+class _BrokerClient(BaseManager):
+    pass
+
+
+_BrokerClient.register("broker")
+
+
+class MemoryBroker:
+    """
+    Queues and channel state of the in-memory broker. Thread safe, every method takes the lock,
+    so it can be used from several threads or served to other processes by serve_broker.
+
+    Deliveries are handed out as (consumer tag, delivery tag, redelivered, queue, body, properties).
+    """
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        # queue name -> deque of (body, properties, redelivered, time.monotonic() when published)
+        self.queues = {}
+        # channel id -> channel state, see open_channel
+        self.channels = {}
+        self.channel_ids = itertools.count(1)
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Zero the counters and latencies, e.g. between benchmark runs on one broker."""
+        with self.lock:
+            self.published = 0
+            self.delivered = 0
+            self.redelivered = 0
+            self.acked = 0
+            # seconds from publish to ack of every acknowledged message, see take_latencies
+            self.latencies = []
+            self.first_publish = None
+            self.last_ack = None
+
+    def queue_declare(self, queue: str) -> int:
+        """Create a queue if it does not exist, returns its message count."""
+        with self.lock:
+            return len(self.queues.setdefault(queue, deque()))
+
+    def queue_delete(self, queue: str) -> int:
+        """Delete a queue and cancel its consumers, returns the messages it held."""
+        with self.lock:
+            messages = self.queues.pop(queue, ())
+            for state in self.channels.values():
+                for consumer_tag, (consumer_queue, _) in list(state["consumers"].items()):
+                    if consumer_queue == queue:
+                        del state["consumers"][consumer_tag]
+            return len(messages)
+
+    def queue_purge(self, queue: str) -> int:
+        """Drop the ready messages of a queue, returns how many."""
+        with self.lock:
+            messages = self.queues.get(queue)
+            count = len(messages or ())
+            if messages:
+                messages.clear()
+            return count
+
+    def message_count(self, queue: str) -> int:
+        with self.lock:
+            return len(self.queues.get(queue, ()))
+
+    def publish(self, queue: str, body: bytes, properties=None) -> bool:
+        """
+        Add a message to the end of a queue. As with RabbitMQ's default exchange a message for a
+        queue that was never declared is dropped, returns False then.
+        """
+        return self.publish_many([(queue, body, properties)]) == 1
+
+    def publish_many(self, messages: list) -> int:
+        """Publish (queue, body, properties) messages together, returns how many were routed."""
+        routed = 0
+        with self.lock:
+            now = time.monotonic()
+            for queue, body, properties in messages:
+                if queue in self.queues:
+                    self.queues[queue].append((bytes(body), properties, False, now))
+                    routed += 1
+            self.published += routed
+            if routed and self.first_publish is None:
+                self.first_publish = now
+            if routed:
+                self.lock.notify_all()
+        return routed
+
+    def open_channel(self) -> int:
+        """Register a channel, returns its id."""
+        with self.lock:
+            channel_id = next(self.channel_ids)
+            self.channels[channel_id] = {
+                "prefetch": 0,
+                # consumer tag -> (queue, auto_ack), in the order they were added
+                "consumers": OrderedDict(),
+                # delivery tag -> (queue, body, properties, published) not yet acknowledged
+                "unacked": OrderedDict(),
+                "next_tag": 1,
+            }
+            return channel_id
+
+    def close_channel(self, channel_id: int):
+        """Forget a channel, its unacknowledged messages go back to their queues."""
+        with self.lock:
+            state = self.channels.pop(channel_id, None)
+            if state is not None:
+                self._requeue(list(state["unacked"].values()))
+
+    def _requeue(self, messages: list):
+        """Put unacked messages back at the front of their queues, in order, keeping their publish time."""
+        for queue, body, properties, published in reversed(messages):
+            if queue in self.queues:
+                self.queues[queue].appendleft((body, properties, True, published))
+                self.redelivered += 1
+        if messages:
+            self.lock.notify_all()
+
+    def basic_qos(self, channel_id: int, prefetch_count: int):
+        with self.lock:
+            self.channels[channel_id]["prefetch"] = prefetch_count
+            self.lock.notify_all()
+
+    def basic_consume(self, channel_id: int, queue: str, consumer_tag: str, auto_ack: bool = False):
+        with self.lock:
+            if queue not in self.queues:
+                raise pika.exceptions.ChannelClosedByBroker(404, f"NOT_FOUND - no queue '{queue}'")
+            self.channels[channel_id]["consumers"][consumer_tag] = (queue, auto_ack)
+            self.lock.notify_all()
+
+    def basic_cancel(self, channel_id: int, consumer_tag: str):
+        with self.lock:
+            self.channels[channel_id]["consumers"].pop(consumer_tag, None)
+
+    def _take(self, state: dict, queue: str, consumer_tag: str, auto_ack: bool) -> tuple:
+        """Move the first message of queue to a channel, lock held."""
+        body, properties, redelivered, published = self.queues[queue].popleft()
+        delivery_tag = state["next_tag"]
+        state["next_tag"] += 1
+        if auto_ack:
+            self._acked([(queue, body, properties, published)])
+        else:
+            state["unacked"][delivery_tag] = (queue, body, properties, published)
+        self.delivered += 1
+        return consumer_tag, delivery_tag, redelivered, queue, body, properties
+
+    def _ready(self, channel_id: int) -> list:
+        """
+        Take the messages channel_id may have now, lock held: round robin over its consumers,
+        stopping when the prefetch window is full.
+        """
+        state = self.channels.get(channel_id)
+        if state is None:
+            return []
+        deliveries = []
+        while True:
+            taken = False
+            for consumer_tag, (queue, auto_ack) in state["consumers"].items():
+                if state["prefetch"] and len(state["unacked"]) >= state["prefetch"]:
+                    return deliveries
+                if self.queues.get(queue):
+                    deliveries.append(self._take(state, queue, consumer_tag, auto_ack))
+                    taken = True
+            if not taken:
+                return deliveries
+
+    def fetch(self, channel_ids: list, timeout: float = 0) -> dict:
+        """
+        Wait up to timeout seconds until a message can be delivered to one of channel_ids.
+        Returns channel id -> list of deliveries, empty if none arrived in time.
+        """
+        deadline = time.monotonic() + (timeout or 0)
+        with self.lock:
+            while True:
+                deliveries = {}
+                for channel_id in channel_ids:
+                    ready = self._ready(channel_id)
+                    if ready:
+                        deliveries[channel_id] = ready
+                remaining = deadline - time.monotonic()
+                if deliveries or remaining <= 0:
+                    return deliveries
+                self.lock.wait(remaining)
+
+    def basic_get(self, channel_id: int, queue: str, auto_ack: bool = False):
+        """Take one message from queue, returns a delivery or None if the queue is empty."""
+        with self.lock:
+            if queue not in self.queues:
+                raise pika.exceptions.ChannelClosedByBroker(404, f"NOT_FOUND - no queue '{queue}'")
+            if not self.queues[queue]:
+                return None
+            return self._take(self.channels[channel_id], queue, "", auto_ack)
+
+    def _settle(self, channel_id: int, delivery_tag: int, multiple: bool) -> list:
+        """Remove acknowledged or rejected tags from the unacked messages, lock held."""
+        unacked = self.channels[channel_id]["unacked"]
+        if not multiple:
+            message = unacked.pop(delivery_tag, None)
+            return [] if message is None else [message]
+        settled = []
+        while unacked:
+            tag = next(iter(unacked))
+            if delivery_tag and tag > delivery_tag:
+                break
+            settled.append(unacked.pop(tag))
+        return settled
+
+    def _acked(self, messages: list):
+        """Count acknowledged messages and time them, lock held."""
+        if messages:
+            now = time.monotonic()
+            self.latencies.extend(now - message[3] for message in messages)
+            self.acked += len(messages)
+            self.last_ack = now
+
+    def basic_ack(self, channel_id: int, delivery_tag: int, multiple: bool = False):
+        with self.lock:
+            settled = self._settle(channel_id, delivery_tag, multiple)
+            if settled:
+                self._acked(settled)
+                # a free prefetch slot may let another delivery through
+                self.lock.notify_all()
+
+    def basic_nack(self, channel_id: int, delivery_tag: int, multiple: bool = False, requeue: bool = True):
+        with self.lock:
+            settled = self._settle(channel_id, delivery_tag, multiple)
+            if requeue:
+                self._requeue(settled)
+            elif settled:
+                self.lock.notify_all()
+
+    def take_latencies(self) -> list:
+        """Return the publish-to-ack seconds recorded since the last call and start a new list."""
+        with self.lock:
+            latencies = self.latencies
+            self.latencies = []
+            return latencies
+
+    def stats(self) -> dict:
+        """Message counters, the depth of every queue and the queues that have a consumer."""
+        with self.lock:
+            return {"published": self.published, "delivered": self.delivered,
+                    "redelivered": self.redelivered, "acked": self.acked,
+                    "unacked": sum(len(state["unacked"]) for state in self.channels.values()),
+                    "first_publish": self.first_publish, "last_ack": self.last_ack,
+                    "queues": {queue: len(messages) for queue, messages in self.queues.items()},
+                    "consuming": sorted({queue for state in self.channels.values()
+                                         for queue, _ in state["consumers"].values()})}
+
+
+class MemoryConnection:
+    """
+    A connection to a MemoryBroker with the BlockingConnection methods the repo uses.
+
+    Parameters:
+        broker: a MemoryBroker, or a proxy to one in another process
+    """
+
+    # longest single wait on the broker, so timers and a KeyboardInterrupt are not held up
+    poll_interval = 0.05
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.channels = {}
+        # heap of (monotonic due time, sequence, callback)
+        self.timers = []
+        self.timer_ids = itertools.count()
+        self.is_open = True
+
+    @property
+    def is_closed(self):
+        return not self.is_open
+
+    def channel(self) -> "MemoryChannel":
+        if not self.is_open:
+            raise pika.exceptions.ConnectionWrongStateError("connection is closed")
+        channel = MemoryChannel(self)
+        self.channels[channel.channel_number] = channel
+        return channel
+
+    def call_later(self, delay: float, callback):
+        """Run callback once, delay seconds from now, from process_data_events."""
+        timer_id = next(self.timer_ids)
+        heapq.heappush(self.timers, (time.monotonic() + delay, timer_id, callback))
+        return timer_id
+
+    def remove_timeout(self, timer_id):
+        self.timers = [timer for timer in self.timers if timer[1] != timer_id]
+        heapq.heapify(self.timers)
+
+    def run_timers(self) -> int:
+        """Run the timers that are due, returns how many ran."""
+        count = 0
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            heapq.heappop(self.timers)[2]()
+            count += 1
+        return count
+
+    def process_data_events(self, time_limit: float = 0):
+        """
+        Run due timers and deliver waiting messages to the consumer callbacks.
+        As with pika, returns once something was handled or time_limit seconds have passed,
+        time_limit=None waits for the first event.
+        """
+        deadline = None if time_limit is None else time.monotonic() + time_limit
+        while self.is_open:
+            handled = self.run_timers()
+            handled += sum(channel.send_confirms() for channel in list(self.channels.values()))
+            wait = self.poll_interval
+            if handled:
+                wait = 0
+            if self.timers:
+                wait = min(wait, max(self.timers[0][0] - time.monotonic(), 0))
+            if deadline is not None:
+                wait = min(wait, max(deadline - time.monotonic(), 0))
+            consuming = [number for number, channel in self.channels.items() if channel.consumers]
+            if consuming:
+                deliveries = self.broker.fetch(consuming, wait)
+                for channel_number, ready in deliveries.items():
+                    channel = self.channels.get(channel_number)
+                    for delivery in ready:
+                        channel.deliver(delivery)
+                        handled += 1
+            elif wait:
+                time.sleep(wait)
+            if handled or (deadline is not None and time.monotonic() >= deadline):
+                return
+
+    def sleep(self, duration: float):
+        """Process events for duration seconds, like BlockingConnection.sleep."""
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            self.process_data_events(time_limit=deadline - time.monotonic())
+
+    def close(self):
+        """Close every channel, their unacknowledged messages are redelivered."""
+        for channel in list(self.channels.values()):
+            channel.close()
+        self.timers = []
+        self.is_open = False
+
+
+class MemoryChannel:
+    """
+    A channel on a MemoryConnection with the BlockingChannel methods the repo uses.
+
+    Parameters:
+        connection: the MemoryConnection
+    """
+
+    def __init__(self, connection: MemoryConnection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.channel_number = self.broker.open_channel()
+        # consumer tag -> on_message_callback
+        self.consumers = {}
+        self.consumer_tags = itertools.count(1)
+        # messages of the open transaction, None when not in transaction mode
+        self.transaction = None
+        # confirm mode: the ack callback, the last delivery tag published and the last one acked
+        self.on_delivery_confirmed = None
+        self.published_tag = 0
+        self.acked_tag = 0
+        self.is_open = True
+
+    @property
+    def is_closed(self):
+        return not self.is_open
+
+    def check_open(self):
+        if not self.is_open:
+            raise pika.exceptions.ChannelWrongStateError("channel is closed")
+
+    def queue_declare(self, queue: str, durable: bool = False, **kwargs):
+        self.check_open()
+        count = self.broker.queue_declare(queue)
+        return pika.frame.Method(self.channel_number, pika.spec.Queue.DeclareOk(queue, count, 0))
+
+    def queue_delete(self, queue: str, **kwargs):
+        self.check_open()
+        count = self.broker.queue_delete(queue)
+        return pika.frame.Method(self.channel_number, pika.spec.Queue.DeleteOk(count))
+
+    def queue_purge(self, queue: str):
+        self.check_open()
+        count = self.broker.queue_purge(queue)
+        return pika.frame.Method(self.channel_number, pika.spec.Queue.PurgeOk(count))
+
+    def basic_qos(self, prefetch_size: int = 0, prefetch_count: int = 0, global_qos: bool = False):
+        self.check_open()
+        self.broker.basic_qos(self.channel_number, prefetch_count)
+
+    def confirm_delivery(self, ack_nack_callback=None, callback=None):
+        """
+        Publishes are accepted as soon as basic_publish returns. With ack_nack_callback, as on pika's
+        asynchronous Channel, the next process_data_events acks every publish so far with one multiple=True ack.
+        """
+        self.check_open()
+        self.on_delivery_confirmed = ack_nack_callback
+        if callback is not None:
+            callback(pika.frame.Method(self.channel_number, pika.spec.Confirm.SelectOk()))
+
+    def send_confirms(self) -> int:
+        """Ack the publishes since the last ack, returns 1 if there were any."""
+        if self.on_delivery_confirmed is None or self.acked_tag == self.published_tag:
+            return 0
+        self.acked_tag = self.published_tag
+        self.on_delivery_confirmed(pika.frame.Method(self.channel_number,
+                                                     pika.spec.Basic.Ack(self.acked_tag, multiple=True)))
+        return 1
+
+    def tx_select(self):
+        self.check_open()
+        self.transaction = []
+
+    def tx_commit(self):
+        self.check_open()
+        if self.transaction:
+            self.broker.publish_many(self.transaction)
+        self.transaction = []
+
+    def tx_rollback(self):
+        self.check_open()
+        self.transaction = []
+
+    def basic_publish(self, exchange: str, routing_key: str, body: bytes, properties=None, mandatory: bool = False):
+        """Publish to the queue routing_key, only the default exchange ("") exists."""
+        self.check_open()
+        if exchange:
+            raise pika.exceptions.ChannelClosedByBroker(404, f"NOT_FOUND - no exchange '{exchange}'")
+        if isinstance(body, str):
+            body = body.encode()
+        if self.transaction is not None:
+            self.transaction.append((routing_key, bytes(body), properties))
+        else:
+            self.broker.publish(routing_key, bytes(body), properties)
+        if self.on_delivery_confirmed is not None:
+            self.published_tag += 1
+
+    def basic_consume(self, queue: str, on_message_callback, auto_ack: bool = False, exclusive: bool = False,
+                      consumer_tag: str = None, arguments=None) -> str:
+        self.check_open()
+        consumer_tag = consumer_tag or f"ctag{self.channel_number}.{next(self.consumer_tags)}"
+        self.broker.basic_consume(self.channel_number, queue, consumer_tag, auto_ack)
+        self.consumers[consumer_tag] = on_message_callback
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag: str):
+        if self.consumers.pop(consumer_tag, None) is not None:
+            self.broker.basic_cancel(self.channel_number, consumer_tag)
+        return []
+
+    def basic_ack(self, delivery_tag: int = 0, multiple: bool = False):
+        self.check_open()
+        self.broker.basic_ack(self.channel_number, delivery_tag, multiple)
+
+    def basic_nack(self, delivery_tag: int = 0, multiple: bool = False, requeue: bool = True):
+        self.check_open()
+        self.broker.basic_nack(self.channel_number, delivery_tag, multiple, requeue)
+
+    def basic_reject(self, delivery_tag: int = 0, requeue: bool = True):
+        self.basic_nack(delivery_tag, False, requeue)
+
+    def basic_get(self, queue: str, auto_ack: bool = False):
+        """Returns (method, properties, body), or (None, None, None) when the queue is empty."""
+        self.check_open()
+        delivery = self.broker.basic_get(self.channel_number, queue, auto_ack)
+        if delivery is None:
+            return None, None, None
+        _, delivery_tag, redelivered, queue, body, properties = delivery
+        method = pika.spec.Basic.GetOk(delivery_tag, redelivered, "", queue, self.broker.message_count(queue))
+        return method, properties or pika.BasicProperties(), body
+
+    def deliver(self, delivery: tuple):
+        """Hand one delivery from the broker to its consumer callback."""
+        consumer_tag, delivery_tag, redelivered, queue, body, properties = delivery
+        callback = self.consumers.get(consumer_tag)
+        if callback is None:
+            # cancelled while the delivery was on its way, give it back
+            self.broker.basic_nack(self.channel_number, delivery_tag, False, True)
+            return
+        method = pika.spec.Basic.Deliver(consumer_tag, delivery_tag, redelivered, "", queue)
+        callback(self, method, properties or pika.BasicProperties(), body)
+
+    def start_consuming(self):
+        """Deliver messages until every consumer is cancelled or the channel is closed."""
+        while self.consumers and self.is_open:
+            self.connection.process_data_events(time_limit=None)
+
+    def stop_consuming(self):
+        for consumer_tag in list(self.consumers):
+            self.basic_cancel(consumer_tag)
+
+    def close(self):
+        """Close the channel, its unacknowledged messages are redelivered."""
+        if self.is_open:
+            self.consumers = {}
+            self.is_open = False
+            self.broker.close_channel(self.channel_number)
+            self.connection.channels.pop(self.channel_number, None)
+
+
+if __name__ == "__main__":
+    # run a broker for producers and consumers started with --host memory://<address>
+    address = sys.argv[1] if len(sys.argv) > 1 else "127.0.0.1:5673"
+    print(f"Memory broker listening on {address}, CTRL+C to stop")
+    try:
+        serve_broker(address)
+    except KeyboardInterrupt:
+        pass
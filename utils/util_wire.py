@@ -0,0 +1,482 @@
+"""
+Binary wire format for full subway records.
+
+ProducerV2 used to pickle a 13 key dict for every row. Pickle repeats every key name in every
+message, is slow to build, and pickle.loads will run whatever code a message asks it to, so it
+is not safe to read from a shared broker. This format builds on the struct.pack('=QI', ...)
+messages already used by ProducerV3:
+
+1. Every message starts with a small header: format version, message type, record count and state.
+2. A DICTIONARY message carries the strings (station names, fare classes, Line, ...) as JSON,
+   one list per column. It is shipped to a queue before the first records that need it and
+   again only when new strings appear.
+3. A RECORDS message carries many records back to back in a fixed 50 byte layout.
+   Strings are sent as their index in the dictionary.
+4. The decoder reads RECORDS with numpy.frombuffer straight from the message body, no copy.
+5. Most of a record never changes for a station: its name, Line, borough, transit_mode,
+   latitude, longitude and Georeference are fixed per station_complex_id. WireEncoder sends
+   those in a STATIONS message (the station dimension table, 30 bytes per station) once per queue
+   and again only when a station is new or its values changed. The records themselves go
+   as FACTS, 24 bytes each: transit_timestamp, station_complex_id, ridership, transfers,
+   payment_method and fare_class_category. WireDecoder keeps the stations in a dict and joins
+   them back in, so decode still returns full RECORDS arrays.
+   A chunk in which one station has two different sets of values is sent as RECORDS.
+6. The dictionary and station table a queue's records need are its state. Whenever either
+   changes the encoder starts a new state: a DICTIONARY and a STATIONS message with the whole
+   table, both carrying the new state id in their header, and every RECORDS and FACTS message
+   carries the id of the state it was encoded with. State ids are unique per producer run.
+7. The state travels ahead of its records in the queue, but a consumer that restarts, gets
+   messages redelivered, or is attached after another consumer has acked the state never sees
+   it. So the producer also keeps every state on the durable queue State-<queue>, and a
+   WireDecoder that meets a state id it does not hold reads that state from there
+   (fetch_state, the messages stay on the queue for the next consumer).
+
+ProducerV3's per station feeds use FRAME messages: the header count says how many
+(transit_timestamp, ridership) pairs follow, each one the same '=QI' struct ProducerV3 always sent.
+The frame size is negotiated: ConsumeV3 advertises the largest frame it wants on the
+V3 control queue and ProducerV3 sends frames no bigger than that.
+
+Record layout, little endian, no padding (struct format RECORD_FORMAT):
+
+    Q transit_timestamp   Unix seconds
+    I station_complex_id
+    I ridership
+    I transfers
+    d latitude
+    d longitude
+    H transit_mode, station_complex, Line, borough, payment_method,
+      fare_class_category, Georeference   (dictionary codes)
+
+STATIONS (STATION_FORMAT) and FACTS (FACT_FORMAT) split the same fields:
+
+    I station_complex_id, d latitude, d longitude,
+    H transit_mode, station_complex, Line, borough, Georeference
+    Q transit_timestamp, I station_complex_id, I ridership, I transfers,
+    H payment_method, fare_class_category
+
+"""
+
+import json
+import random
+import struct
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.util_reader import Dictionary, SUBWAY_SCHEMA
+from utils.util_replay import format_timestamp
+
+# Bump when the layout of a message type changes, decoders refuse versions they do not know.
+WIRE_VERSION = 2
+
+# Message header: version, message type, record count, state id (0 for FRAME and FRAME_SIZE)
+HEADER = struct.Struct('=BBIQ')
+
+# Message types
+DICTIONARY = 1
+RECORDS = 2
+FRAME = 3
+FRAME_SIZE = 4
+STATIONS = 5
+FACTS = 6
+
+# One record, see the module docstring
+RECORD_FORMAT = '=QIIIdd7H'
+RECORD_DTYPE = np.dtype([
+    ('transit_timestamp', '<u8'),
+    ('station_complex_id', '<u4'),
+    ('ridership', '<u4'),
+    ('transfers', '<u4'),
+    ('latitude', '<f8'),
+    ('longitude', '<f8'),
+    ('transit_mode', '<u2'),
+    ('station_complex', '<u2'),
+    ('Line', '<u2'),
+    ('borough', '<u2'),
+    ('payment_method', '<u2'),
+    ('fare_class_category', '<u2'),
+    ('Georeference', '<u2'),
+])
+assert RECORD_DTYPE.itemsize == struct.calcsize(RECORD_FORMAT)
+
+# The station dimension table, one row per station_complex_id
+STATION_FORMAT = '=Idd5H'
+STATION_DTYPE = np.dtype([
+    ('station_complex_id', '<u4'),
+    ('latitude', '<f8'),
+    ('longitude', '<f8'),
+    ('transit_mode', '<u2'),
+    ('station_complex', '<u2'),
+    ('Line', '<u2'),
+    ('borough', '<u2'),
+    ('Georeference', '<u2'),
+])
+assert STATION_DTYPE.itemsize == struct.calcsize(STATION_FORMAT)
+
+# What is left of a record once its station's columns are in the table
+FACT_FORMAT = '=QIIIHH'
+FACT_DTYPE = np.dtype([
+    ('transit_timestamp', '<u8'),
+    ('station_complex_id', '<u4'),
+    ('ridership', '<u4'),
+    ('transfers', '<u4'),
+    ('payment_method', '<u2'),
+    ('fare_class_category', '<u2'),
+])
+assert FACT_DTYPE.itemsize == struct.calcsize(FACT_FORMAT)
+
+# Columns a record takes from its station's row
+STATION_COLUMNS = [name for name in STATION_DTYPE.names if name != 'station_complex_id']
+
+# One station reading in a FRAME message, the struct ProducerV3 has always used
+FRAME_FORMAT = '=QI'
+FRAME_DTYPE = np.dtype([('transit_timestamp', '<u8'), ('ridership', '<u4')])
+assert FRAME_DTYPE.itemsize == struct.calcsize(FRAME_FORMAT)
+
+# Queue where ConsumeV3 advertises the frame size it wants
+FRAME_CONTROL_QUEUE = "Station-V3_control"
+
+# Decoders keep this many states, a queue only goes back to an older one after a producer restart
+max_states = 8
+
+# Dictionary encoded columns, in the order they appear in a record
+STRING_COLUMNS = [name for name in RECORD_DTYPE.names if SUBWAY_SCHEMA[name] == 'category']
+
+# Column order of the original CSV, used when records are turned back into rows
+CSV_COLUMNS = list(SUBWAY_SCHEMA)
+
+
+# Define Program functions
+#--------------------------------------------------------------------------
+
+def read_header(body: bytes):
+    """Return (message type, record count) after checking the format version."""
+    version, message_type, count, state = HEADER.unpack_from(body)
+    if version != WIRE_VERSION:
+        raise ValueError(f"Unsupported wire format version {version}, expected {WIRE_VERSION}")
+    return message_type, count
+
+
+def message_state(body: bytes) -> int:
+    """The state id in a message's header: the state it starts, or the one its records need."""
+    return HEADER.unpack_from(body)[3]
+
+
+def state_queue_name(queue_name: str) -> str:
+    """Where the producer keeps the states of a queue, e.g. Line-7_queue -> State-Line-7_queue"""
+    return f"State-{queue_name}"
+
+
+def is_state_message(body: bytes) -> bool:
+    """True for the DICTIONARY and STATIONS messages that make up a state."""
+    return read_header(body)[0] in (DICTIONARY, STATIONS)
+
+
+def encode_dictionary(dictionaries: dict, state: int = 0) -> bytes:
+    """Pack the string dictionaries of the string columns into a DICTIONARY message."""
+    payload = {name: dictionaries[name].values for name in STRING_COLUMNS}
+    body = json.dumps(payload, separators=(',', ':')).encode()
+    return HEADER.pack(WIRE_VERSION, DICTIONARY, len(payload), state) + body
+
+
+def encode_records(chunk, state: int = 0) -> bytes:
+    """
+    Pack every row of a ColumnChunk (from utils/util_reader.py) into one RECORDS message.
+    The chunk's category codes are written as they are, so the receiver needs the same dictionaries.
+    """
+    records = np.empty(len(chunk), dtype=RECORD_DTYPE)
+    for name in RECORD_DTYPE.names:
+        records[name] = chunk[name]
+    return HEADER.pack(WIRE_VERSION, RECORDS, len(records), state) + records.tobytes()
+
+
+def encode_records_array(records: np.ndarray, state: int = 0) -> bytes:
+    """Pack a RECORD_DTYPE array, e.g. facts joined with their stations, into one RECORDS message."""
+    return HEADER.pack(WIRE_VERSION, RECORDS, len(records), state) + records.tobytes()
+
+
+def station_table(chunk):
+    """
+    The station columns of every distinct station in a ColumnChunk, sorted by station_complex_id.
+    Returns None if a station has more than one set of values in the chunk.
+    """
+    columns = np.empty(len(chunk), dtype=STATION_DTYPE)
+    for name in STATION_DTYPE.names:
+        columns[name] = chunk[name]
+    table = np.unique(columns)
+    if len(np.unique(table['station_complex_id'])) != len(table):
+        return None
+    return table
+
+
+def encode_stations(table: np.ndarray, state: int = 0) -> bytes:
+    """Pack the station dimension table (STATION_DTYPE) of a state into one STATIONS message."""
+    return HEADER.pack(WIRE_VERSION, STATIONS, len(table), state) + table.tobytes()
+
+
+def encode_facts(chunk, state: int = 0) -> bytes:
+    """Pack the fact columns of every row of a ColumnChunk into one FACTS message."""
+    facts = np.empty(len(chunk), dtype=FACT_DTYPE)
+    for name in FACT_DTYPE.names:
+        facts[name] = chunk[name]
+    return HEADER.pack(WIRE_VERSION, FACTS, len(facts), state) + facts.tobytes()
+
+
+def encode_frame(timestamps, ridership) -> bytes:
+    """Pack matching sequences of Unix second timestamps and ridership counts into one FRAME message."""
+    readings = np.empty(len(timestamps), dtype=FRAME_DTYPE)
+    readings['transit_timestamp'] = timestamps
+    readings['ridership'] = ridership
+    return HEADER.pack(WIRE_VERSION, FRAME, len(readings), 0) + readings.tobytes()
+
+
+def decode_frame(body: bytes) -> np.ndarray:
+    """Return the readings of a FRAME message as a NumPy record array viewing body, nothing is copied."""
+    message_type, count = read_header(body)
+    if message_type != FRAME:
+        raise ValueError(f"Expected a FRAME message, got type {message_type}")
+    return np.frombuffer(body, dtype=FRAME_DTYPE, count=count, offset=HEADER.size)
+
+
+def iter_frame(body: bytes):
+    """Yield (transit_timestamp, ridership) tuples from a FRAME message without copying the body."""
+    message_type, count = read_header(body)
+    if message_type != FRAME:
+        raise ValueError(f"Expected a FRAME message, got type {message_type}")
+    end = HEADER.size + count * FRAME_DTYPE.itemsize
+    return struct.iter_unpack(FRAME_FORMAT, memoryview(body)[HEADER.size:end])
+
+
+def encode_frame_size(frame_size: int) -> bytes:
+    """The FRAME_SIZE message a consumer puts on the control queue."""
+    return HEADER.pack(WIRE_VERSION, FRAME_SIZE, frame_size, 0)
+
+
+def advertise_frame_size(channel, frame_size: int):
+    """
+    Consumer side of the negotiation: replace any old advert on the control queue with
+    the largest number of readings this consumer wants in one frame.
+    """
+    channel.queue_declare(queue=FRAME_CONTROL_QUEUE, durable=True)
+    channel.queue_purge(queue=FRAME_CONTROL_QUEUE)
+    channel.basic_publish(exchange="", routing_key=FRAME_CONTROL_QUEUE, body=encode_frame_size(frame_size))
+
+
+def negotiate_frame_size(channel, requested: int) -> int:
+    """
+    Producer side of the negotiation: read the consumer's advert (leaving it on the queue
+    for the next producer) and return the smaller of the two sizes.
+    Without an advert the producer's own size is used, frames carry their count so any size decodes.
+    """
+    channel.queue_declare(queue=FRAME_CONTROL_QUEUE, durable=True)
+    method, properties, body = channel.basic_get(queue=FRAME_CONTROL_QUEUE, auto_ack=False)
+    if method is None:
+        return requested
+    # put the advert back so it is still there for a restarted producer
+    channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+    message_type, advertised = read_header(body)
+    if message_type != FRAME_SIZE:
+        return requested
+    return max(1, min(requested, advertised))
+
+
+def fetch_state(channel, queue_name: str, state: int, attempts: int = 3, retry_delay: float = 0.5) -> list:
+    """
+    Consumer side of a missed state: read the DICTIONARY and STATIONS messages of one state of
+    queue_name from its state queue and put every message back for the next consumer.
+    Use a channel of its own, the nack below would also return unacked deliveries of a consuming channel.
+    Another consumer reading the queue at the same time hides its messages for a moment, so an
+    empty answer is tried again.
+    """
+    state_queue = state_queue_name(queue_name)
+    channel.queue_declare(queue=state_queue, durable=True)
+    for attempt in range(attempts):
+        bodies = []
+        last_tag = None
+        while True:
+            method, properties, body = channel.basic_get(queue=state_queue, auto_ack=False)
+            if method is None:
+                break
+            last_tag = method.delivery_tag
+            if message_state(body) == state:
+                bodies.append(bytes(body))
+        if last_tag is not None:
+            channel.basic_nack(delivery_tag=last_tag, multiple=True, requeue=True)
+        if bodies:
+            return bodies
+        time.sleep(retry_delay)
+    return []
+
+
+class WireEncoder:
+    """
+    Turns ColumnChunks into messages for a set of queues. Each queue gets a new state, the
+    dictionary and its station table, before the first records that need it and again whenever
+    the dictionary has grown or a station is new or has changed.
+
+    Parameters:
+        max_records (int): most records packed into one RECORDS or FACTS message
+        stations (bool): send STATIONS and FACTS, False sends full RECORDS
+    """
+
+    def __init__(self, max_records: int = 1000, stations: bool = True):
+        self.max_records = max_records
+        self.stations = stations
+        # the high 32 bits of every state id, so two runs never share one
+        self.run = random.getrandbits(32)
+        self.states = 0
+        # queue name -> its current state id
+        self.state = {}
+        # queue name -> dictionary sizes last shipped to it
+        self.shipped = {}
+        # queue name -> {station_complex_id: station row} last shipped to it
+        self.shipped_stations = {}
+
+    def encode(self, queue_name: str, chunk) -> list:
+        """
+        Return the message bodies to publish to queue_name for the rows in chunk.
+        A new state comes first, is_state_message tells its messages apart.
+        """
+        messages = []
+        sizes = tuple(len(chunk.dictionaries[name]) for name in STRING_COLUMNS)
+        table = station_table(chunk) if self.stations else None
+        shipped = self.shipped_stations.setdefault(queue_name, {})
+        changed = []
+        if table is not None:
+            rows = table.tolist()
+            changed = [row for row in rows if shipped.get(row[0]) != row]
+        if queue_name not in self.state or self.shipped.get(queue_name) != sizes or changed:
+            self.states += 1
+            self.state[queue_name] = (self.run << 32) | self.states
+            self.shipped[queue_name] = sizes
+            shipped.update((row[0], row) for row in changed)
+            messages.append(encode_dictionary(chunk.dictionaries, self.state[queue_name]))
+            if shipped:
+                stations = np.array(sorted(shipped.values()), dtype=STATION_DTYPE)
+                messages.append(encode_stations(stations, self.state[queue_name]))
+
+        state = self.state[queue_name]
+        encode = encode_records if table is None else encode_facts
+        for start in range(0, len(chunk), self.max_records):
+            messages.append(encode(chunk.take(slice(start, start + self.max_records)), state))
+        return messages
+
+
+class WireState:
+    """
+    One state of a queue: the dictionaries and the station table its records were encoded with.
+
+    Parameters:
+        dictionary_body (bytes): the DICTIONARY message, the worker pool sends it on as it is
+    """
+
+    def __init__(self, dictionary_body: bytes):
+        self.dictionary_body = dictionary_body
+        payload = json.loads(bytes(dictionary_body[HEADER.size:]))
+        self.dictionaries = {name: Dictionary(values) for name, values in payload.items()}
+        # the stations sorted by id for the join, empty until the STATIONS message arrives
+        self.station_ids = np.empty(0, dtype=STATION_DTYPE['station_complex_id'])
+        self.station_rows = np.empty(0, dtype=STATION_DTYPE)
+
+    def set_stations(self, table: np.ndarray):
+        table = np.sort(table, order='station_complex_id')
+        self.station_ids = table['station_complex_id']
+        self.station_rows = table
+
+
+class WireDecoder:
+    """
+    Reads DICTIONARY, STATIONS, RECORDS and FACTS messages from one queue.
+    Holds the last max_states states, so records can be joined back to their strings and
+    facts to their stations, and the state of the last records decoded as the current one.
+
+    Parameters:
+        fetch_state (callable): optional, called with a state id the decoder has not seen and
+            returns that state's messages, e.g. functools.partial(fetch_state, channel, queue_name)
+    """
+
+    def __init__(self, fetch_state=None):
+        self.fetch_state = fetch_state
+        # state id -> WireState, oldest first
+        self.states = OrderedDict()
+        self.state = None
+        # the current state's dictionaries and DICTIONARY message
+        self.dictionaries = {}
+        self.dictionary_body = None
+
+    def decode(self, body: bytes):
+        """
+        Decode one message body.
+        Returns a NumPy record array for RECORDS messages (a view on body) and FACTS messages
+        (joined with the station table), None for DICTIONARY and STATIONS messages.
+        """
+        message_type, count = read_header(body)
+        state = message_state(body)
+        if message_type == DICTIONARY:
+            self.states[state] = WireState(bytes(body))
+            while len(self.states) > max_states:
+                self.states.popitem(last=False)
+            self.use(state)
+            return None
+        if message_type == STATIONS:
+            # without its DICTIONARY (acked before a restart) the state is fetched whole when needed
+            if state in self.states:
+                self.states[state].set_stations(np.frombuffer(body, dtype=STATION_DTYPE, count=count,
+                                                              offset=HEADER.size))
+            return None
+        if message_type == RECORDS:
+            self.use(state)
+            return np.frombuffer(body, dtype=RECORD_DTYPE, count=count, offset=HEADER.size)
+        if message_type == FACTS:
+            self.use(state)
+            return self.join(np.frombuffer(body, dtype=FACT_DTYPE, count=count, offset=HEADER.size))
+        raise ValueError(f"Unknown message type {message_type}")
+
+    def use(self, state: int):
+        """Make state the current one, reading it from the state queue if it was missed."""
+        if state not in self.states and self.fetch_state is not None:
+            for body in self.fetch_state(state):
+                self.decode(body)
+        if state not in self.states:
+            raise ValueError(f"Records need state {state:#x}, which neither came ahead of them nor is on the "
+                             f"state queue, see utils/util_wire.py")
+        self.state = state
+        self.dictionaries = self.states[state].dictionaries
+        self.dictionary_body = self.states[state].dictionary_body
+
+    def join(self, facts: np.ndarray) -> np.ndarray:
+        """Full records for facts, each station's columns looked up by station_complex_id."""
+        current = self.states[self.state]
+        ids = facts['station_complex_id']
+        positions = np.searchsorted(current.station_ids, ids)
+        found = positions < len(current.station_ids)
+        found[found] = current.station_ids[positions[found]] == ids[found]
+        if not found.all():
+            missing = sorted(set(ids[~found].tolist()))
+            raise ValueError(f"Records for stations {missing} are not in the station table of state {self.state:#x}")
+        records = np.empty(len(facts), dtype=RECORD_DTYPE)
+        for name in FACT_DTYPE.names:
+            records[name] = facts[name]
+        for name in STATION_COLUMNS:
+            records[name] = current.station_rows[name][positions]
+        return records
+
+    def rows(self, records: np.ndarray):
+        """Yield each record as a subway_data dict with the same keys and values as the CSV."""
+        columns = {}
+        for name in CSV_COLUMNS:
+            values = records[name].tolist()
+            if name in self.dictionaries:
+                strings = self.dictionaries[name].values
+                values = [strings[code] for code in values]
+            elif name == 'transit_timestamp':
+                values = [format_timestamp(seconds) for seconds in values]
+            columns[name] = values
+        for values in zip(*columns.values()):
+            yield dict(zip(CSV_COLUMNS, values))
+
+    def decode_rows(self, body: bytes) -> list:
+        """Decode a message straight into subway_data dicts, an empty list for DICTIONARY and STATIONS messages."""
+        records = self.decode(body)
+        return [] if records is None else list(self.rows(records))